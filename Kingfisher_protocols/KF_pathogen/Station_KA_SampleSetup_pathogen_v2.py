@@ -1,8 +1,10 @@
 import math
 from opentrons.types import Point
 from opentrons import protocol_api
+from opentrons.protocol_api.labware import get_labware_definition
 import time
 import os
+import numpy as np
 from timeit import default_timer as timer
 import json
 from datetime import datetime
@@ -29,6 +31,11 @@ NUM_SAMPLES = NUM_SAMPLES - 1 # PC is in last well (no sample)
 
 air_gap_vol = 15
 run_id = $run_id
+# Homing policy: the tips are dropped without homing the plunger, which is homed before
+# picking up a tip once home_every tips were dropped (1: before every tip, as a drop with
+# home_after) and before every tip of the precise_steps
+home_every = 8
+precise_steps = []
 volume_sample = 460
 x_offset = [0,0]
 
@@ -62,10 +69,70 @@ def run(ctx: protocol_api.ProtocolContext):
         file_path = folder_path + '/KA_SampleSetup_pathogen_time_log.txt'
 
     # Define Reagents as objects with their properties
+    class ReservoirState:
+        '''
+        Live volume of every well of a reagent, used by calc_height to choose the well.
+        policy: how the well for the next aspiration is chosen
+            'fewest_switches': stay in the current well while it can serve the volume,
+                     then move to the fullest well, the one that lasts the longest
+            'drain': stay in the current well while it can serve the volume, then move
+                     to the emptiest well that can, to use the leftovers first
+            'fullest': always the well with the highest volume
+            'round_robin': the next well (in order) that can serve the volume
+        '''
+        __slots__ = ['volumes', 'policy', 'current', 'switches', 'used']
+
+        def __init__(self, num_wells, volume_per_well, policy = 'fewest_switches'):
+            self.volumes = np.full(num_wells, float(volume_per_well))
+            self.policy = policy
+            self.current = 0
+            self.switches = 0
+            self.used = np.zeros(num_wells, dtype = bool)
+
+        def select(self, aspirate_volume):
+            '''
+            Index of the well for [aspirate_volume]. If no well has enough volume left
+            the fullest one is returned.
+            '''
+            candidates = np.flatnonzero(self.volumes >= aspirate_volume)
+            if len(candidates) == 0:
+                well = int(np.argmax(self.volumes))
+            elif self.policy == 'fullest':
+                well = int(np.argmax(self.volumes))
+            elif self.policy == 'round_robin':
+                after = candidates[candidates > self.current]
+                well = int(after[0]) if len(after) > 0 else int(candidates[0])
+            elif self.volumes[self.current] >= aspirate_volume:
+                well = self.current
+            elif self.policy == 'drain':
+                well = int(candidates[np.argmin(self.volumes[candidates])])
+            else:
+                well = int(np.argmax(self.volumes))
+            if well != self.current:
+                self.switches += 1
+                self.current = well
+            return well
+
+        def aspirate(self, well, volume):
+            '''
+            Remove [volume] from [well] and return the volume left in it
+            '''
+            self.volumes[well] -= volume
+            self.used[well] = True
+            return float(self.volumes[well])
+
+        def stranded(self):
+            '''
+            Volumes left in the wells that were aspirated from and then left. A well
+            the policy comes back to is not stranded any more.
+            '''
+            return [float(v) for i, v in enumerate(self.volumes)
+                    if self.used[i] and i != self.current]
+
     class Reagent:
         def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
                      reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
+                      tip_recycling = 'none', policy = 'fewest_switches'):
             self.name = name
             self.flow_rate_aspirate = flow_rate_aspirate
             self.flow_rate_dispense = flow_rate_dispense
@@ -80,6 +147,7 @@ def run(ctx: protocol_api.ProtocolContext):
             self.unused=[]
             self.tip_recycling = tip_recycling
             self.vol_well_original = reagent_reservoir_volume / num_wells
+            self.wells = ReservoirState(num_wells, self.vol_well_original, policy)
 
     Samples = Reagent(name = 'Samples',
                       flow_rate_aspirate = 1,
@@ -161,34 +229,108 @@ def run(ctx: protocol_api.ProtocolContext):
         if blow_out == True:
             pipet.blow_out(location.top(z=-2))  # Blow out
 
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
+    class LiquidLevel:
+        '''
+        Volume to height lookup table for the wells of a labware.
+        The table is built once from the labware definition and each query is an O(1)
+        interpolation, so all the stations share the same height formula.
+        shape: bottom of the well. 'flat', 'cone', 'sphere', 'prism' (triangular trough,
+        as in 12 well reservoirs) or 'v' (square pyramid, as in KingFisher deepwells).
+        If None, it is read from wellBottomShape in the labware definition.
+        h_bottom: height of the bottom shape in mm (radius of the well for 'sphere' if None)
+        resolution: number of points of the lookup table
+        '''
+        def __init__(self, labware, shape = None, h_bottom = None, resolution = 1000):
+            definition = get_labware_definition(labware.load_name)
+            well = definition['wells'][definition['ordering'][0][0]]
+            if well['shape'] == 'circular':
+                self.area = math.pi * well['diameter']**2 / 4
+                radius = well['diameter'] / 2
+            else:
+                self.area = well['xDimension'] * well['yDimension']
+                radius = min(well['xDimension'], well['yDimension']) / 2
+            if shape == None:
+                bottom = definition['groups'][0]['metadata'].get('wellBottomShape', 'flat')
+                if bottom == 'u':
+                    shape = 'sphere'
+                elif bottom == 'v':
+                    shape = 'cone' if well['shape'] == 'circular' else 'v'
+                else:
+                    shape = 'flat'
+            if h_bottom == None:
+                h_bottom = radius if shape == 'sphere' else 0
+            if shape == 'flat' or h_bottom <= 0:
+                shape, h_bottom = 'flat', 0
+            self.shape = shape
+            self.h_bottom = min(h_bottom, well['depth'])
+            self.depth = well['depth']
+            self.max_volume = self.volume(self.depth)
+            # Heights sampled on an evenly spaced volume axis, so a query is an index lookup
+            heights = np.linspace(0, self.depth, resolution * 4)
+            volumes = np.array([self.volume(h) for h in heights])
+            self.step = self.max_volume / (resolution - 1)
+            self.table = np.interp(np.arange(resolution) * self.step, volumes, heights)
+
+        def volume(self, height):
+            '''
+            Volume in µl contained in a well filled up to [height] mm from its bottom
+            '''
+            hb = self.h_bottom
+            h = min(height, hb)
+            if self.shape == 'flat':
+                v = 0
+            elif self.shape in ['cone', 'v']:  # area grows with the square of the height
+                v = self.area * h**3 / (3 * hb**2)
+            elif self.shape == 'prism':  # area grows linearly with the height
+                v = self.area * h**2 / (2 * hb)
+            else:  # sphere cap with a base of [area] at [h_bottom]
+                r_sphere = (self.area / math.pi + hb**2) / (2 * hb)
+                v = math.pi * h**2 * (3 * r_sphere - h) / 3
+            return v + self.area * max(height - hb, 0)
+
+        def height(self, volume):
+            '''
+            Height in mm from the bottom of the well of the surface of [volume] µl
+            '''
+            if volume <= 0:
+                return 0
+            if volume >= self.max_volume:
+                return self.depth
+            position = volume / self.step
+            i = int(position)
+            return float(self.table[i] + (self.table[i + 1] - self.table[i]) * (position - i))
+
+    def calc_height(reagent, aspirate_volume, min_height = 0.5, immersion = 1):
+        '''
+        Aspiration height for [aspirate_volume] of [reagent].
+        The well is chosen by reagent.wells (ReservoirState) and the height is taken
+        from the reagent.level table (LiquidLevel), [immersion] mm below the surface
+        that will remain after aspirating.
+        '''
         nonlocal ctx
         ctx.comment('Remaining volume ' + str(reagent.vol_well) +
                     '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
+        well = reagent.wells.select(aspirate_volume)
+        if well != reagent.col:
+            reagent.unused = reagent.wells.stranded()
             ctx.comment('Next column should be picked')
+            ctx.comment('Stranded volume of ' + reagent.name + ': ' + str(sum(reagent.unused)))
             ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
+            # column selector position; chosen by the reservoir policy
+            reagent.col = well
             ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
             col_change = True
         else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
             col_change = False
+        if reagent.wells.volumes[well] < aspirate_volume:
+            ctx.comment('Not enough volume of ' + reagent.name + ' left in any well')
+        reagent.vol_well = reagent.wells.aspirate(well, aspirate_volume)
+        ctx.comment('Remaining volume:' + str(reagent.vol_well))
+        height = reagent.level.height(reagent.vol_well) - immersion
+        ctx.comment('Calculated height is ' + str(height))
+        if height < min_height:
+            height = min_height
+        ctx.comment('Used height is ' + str(height))
         return height, col_change
 
     ##########
@@ -201,8 +343,21 @@ def run(ctx: protocol_api.ProtocolContext):
                 resuming.')
                 pip.reset_tipracks()
                 tip_track['counts'][pip] = 0
+        # Homing policy: home the plunger when it is due, before the new tip
+        drops = tip_track['drops'][pip]
+        if drops >= home_every or (drops > 0 and STEP in precise_steps):
+            ctx.comment('Homing ' + str(pip) + ' plunger after ' + str(drops) + ' drops')
+            pip.home_plunger()
+            tip_track['drops'][pip] = 0
         pip.pick_up_tip()
 
+    def drop(pip):
+        '''
+        Drop the tip without homing the plunger, pick_up homes it when it is due
+        '''
+        pip.drop_tip(home_after = False)
+        tip_track['drops'][pip] += 1
+
     ####################################
     # load labware and modules
 
@@ -247,7 +402,8 @@ def run(ctx: protocol_api.ProtocolContext):
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': {p1000: 0},  # p1000: 0},
-        'maxes': {p1000: len(tips1000) * 96}  # ,p20: len(tips20)*96,
+        'maxes': {p1000: len(tips1000) * 96},  # ,p20: len(tips20)*96,
+        'drops': {p1000: 0}
     }
 
     ############################################################################
@@ -272,7 +428,7 @@ def run(ctx: protocol_api.ProtocolContext):
             # Mix the sample AFTER dispensing
             #custom_mix(p1000, reagent = Samples, location = d, vol = volume_sample, rounds = 2, blow_out = True, mix_height = 15)
             # Drop tip and update counter
-            p1000.drop_tip()
+            drop(p1000)
             tip_track['counts'][p1000] += 1
 
         # Time statistics
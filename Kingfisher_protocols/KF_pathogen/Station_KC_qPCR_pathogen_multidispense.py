@@ -1,6 +1,7 @@
 import math
 from opentrons.types import Point
 from opentrons import protocol_api
+from opentrons.protocol_api.labware import get_labware_definition
 import time
 import os
 import numpy as np
@@ -31,13 +32,18 @@ NUM_SAMPLES = NUM_SAMPLES - 1 #Remove last sample (PC), done manually
 air_gap_vol = 5
 air_gap_sample = 2
 run_id = $run_id
+# Homing policy: the tips are dropped without homing the plunger, which is homed before
+# picking up a tip once home_every tips were dropped (1: before every tip, as a drop with
+# home_after) and before every tip of the precise_steps
+home_every = 4
+precise_steps = []  # the 5 ul sample tips are homed every home_every drops too
 
 # Tune variables
-size_transfer = 5  # Number of wells the distribute function will fill
 volume_mmix = 20  # Volume of transfered master mix
 volume_sample = 5  # Volume of the sample
 volume_mmix_available = (NUM_SAMPLES * 1.1 * volume_mmix)  # Total volume of first screwcap
-extra_dispensal = 10  # Extra volume for master mix in each distribute transfer
+extra_dispensal = 10  # Disposal volume for master mix in each distribute transfer, blown out back to the tube
+conditioning_vol = 0  # Volume dispensed back to the tube right after aspirating (0 = no conditioning)
 diameter_screwcap = 8.25  # Diameter of the screwcap
 temperature = 25  # Temperature of temp module
 volume_cone = 50  # Volume in ul that fit in the screwcap cone
@@ -65,17 +71,77 @@ def run(ctx: protocol_api.ProtocolContext):
             STEPS[s]['wait_time'] = 0
 
     #Folder and file_path for log time
-    folder_path = '/var/lib/jupyter/notebooks/'+run_id'
+    folder_path = '/var/lib/jupyter/notebooks/'+run_id
     if not ctx.is_simulating():
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         file_path = folder_path + '/KC_qPCR_time_log.txt'
 
     # Define Reagents as objects with their properties
+    class ReservoirState:
+        '''
+        Live volume of every well of a reagent, used by calc_height to choose the well.
+        policy: how the well for the next aspiration is chosen
+            'fewest_switches': stay in the current well while it can serve the volume,
+                     then move to the fullest well, the one that lasts the longest
+            'drain': stay in the current well while it can serve the volume, then move
+                     to the emptiest well that can, to use the leftovers first
+            'fullest': always the well with the highest volume
+            'round_robin': the next well (in order) that can serve the volume
+        '''
+        __slots__ = ['volumes', 'policy', 'current', 'switches', 'used']
+
+        def __init__(self, num_wells, volume_per_well, policy = 'fewest_switches'):
+            self.volumes = np.full(num_wells, float(volume_per_well))
+            self.policy = policy
+            self.current = 0
+            self.switches = 0
+            self.used = np.zeros(num_wells, dtype = bool)
+
+        def select(self, aspirate_volume):
+            '''
+            Index of the well for [aspirate_volume]. If no well has enough volume left
+            the fullest one is returned.
+            '''
+            candidates = np.flatnonzero(self.volumes >= aspirate_volume)
+            if len(candidates) == 0:
+                well = int(np.argmax(self.volumes))
+            elif self.policy == 'fullest':
+                well = int(np.argmax(self.volumes))
+            elif self.policy == 'round_robin':
+                after = candidates[candidates > self.current]
+                well = int(after[0]) if len(after) > 0 else int(candidates[0])
+            elif self.volumes[self.current] >= aspirate_volume:
+                well = self.current
+            elif self.policy == 'drain':
+                well = int(candidates[np.argmin(self.volumes[candidates])])
+            else:
+                well = int(np.argmax(self.volumes))
+            if well != self.current:
+                self.switches += 1
+                self.current = well
+            return well
+
+        def aspirate(self, well, volume):
+            '''
+            Remove [volume] from [well] and return the volume left in it
+            '''
+            self.volumes[well] -= volume
+            self.used[well] = True
+            return float(self.volumes[well])
+
+        def stranded(self):
+            '''
+            Volumes left in the wells that were aspirated from and then left. A well
+            the policy comes back to is not stranded any more.
+            '''
+            return [float(v) for i, v in enumerate(self.volumes)
+                    if self.used[i] and i != self.current]
+
     class Reagent:
         def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
                      reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
+                      tip_recycling = 'none', policy = 'fewest_switches'):
             self.name = name
             self.flow_rate_aspirate = flow_rate_aspirate
             self.flow_rate_dispense = flow_rate_dispense
@@ -90,6 +156,7 @@ def run(ctx: protocol_api.ProtocolContext):
             self.unused=[]
             self.tip_recycling = tip_recycling
             self.vol_well_original = reagent_reservoir_volume / num_wells
+            self.wells = ReservoirState(num_wells, self.vol_well_original, policy)
 
     # Reagents and their characteristics
     MMIX = Reagent(name = 'Master Mix',
@@ -126,19 +193,55 @@ def run(ctx: protocol_api.ProtocolContext):
         for i in range(0, len(l), n):
             yield l[i:i + n]
 
-    def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
-        # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
-        pipette.aspirate((len(dest) * volume) +
-                         extra_dispensal, src.bottom(pickup_height))
-        pipette.touch_tip(speed=20, v_offset=-5)
-        pipette.move_to(src.top(z=5))
-        pipette.aspirate(20)  # air gap
-        for d in dest:
-            pipette.dispense(20, d.top())
+    def plan_multi_dispense(dests, volume, max_vol, tip_capacity = None,
+                            conditioning_vol = 0, disposal_vol = 0, air_gap_vol = 0):
+        '''
+        Divide [dests] in the minimum number of balanced groups that can be served with
+        a single aspiration each, given the pipette [max_vol] and the [tip_capacity].
+        The conditioning volume and the air gap are never in the tip at the same time.
+        '''
+        if tip_capacity == None:
+            tip_capacity = max_vol
+        free_vol = (min(max_vol, tip_capacity) - disposal_vol -
+                    max(conditioning_vol, air_gap_vol))
+        per_trip = max(int(free_vol // volume), 1)
+        num_trips = math.ceil(len(dests) / per_trip)
+        return list(divide_destinations(dests, math.ceil(len(dests) / num_trips)))
+
+    def distribute_custom(pipette, reagent, volume, src, dest, waste_pool, pickup_height,
+                          conditioning_vol = 0, disposal_vol = 0, air_gap_vol = 0,
+                          disp_height = 0, touch_tip = True, blow_out = True):
+        '''
+        Multi-dispense [volume] to every well (or column, with a multichannel) of [dest]
+        from a single aspiration in [src].
+        conditioning_vol: aspirated in excess and dispensed back to [src] before the
+        first dispense, so all the dispenses start with the plunger going down
+        disposal_vol: kept in the tip after the last dispense and blown out in [waste_pool]
+        air_gap_vol: air gap taken before moving to each destination (0 for none)
+        blow_out: if False, the disposal volume stays in the tip (with no air gap after
+        the last dispense) to be used in the next aspiration of the same reagent
+        Returns the volume dispensed per channel.
+        '''
+        pipette.aspirate(len(dest) * volume + conditioning_vol + disposal_vol,
+                         src.bottom(pickup_height), rate = reagent.flow_rate_aspirate)
+        if conditioning_vol > 0:
+            pipette.dispense(conditioning_vol, src.bottom(pickup_height),
+                             rate = reagent.flow_rate_dispense)
+        if touch_tip == True:
+            pipette.touch_tip(speed=20, v_offset=-5)
+        if air_gap_vol > 0:
+            pipette.move_to(src.top(z=5))
+            pipette.aspirate(air_gap_vol)  # air gap
+        for i, d in enumerate(dest):
+            if air_gap_vol > 0:
+                pipette.dispense(air_gap_vol, d.top())
             drop = d.top(z = disp_height)
-            pipette.dispense(volume, drop)
-            pipette.move_to(d.top(z=5))
-            pipette.aspirate(20)  # air gap
+            pipette.dispense(volume, drop, rate = reagent.flow_rate_dispense)
+            if air_gap_vol > 0 and (blow_out == True or i < len(dest) - 1):
+                pipette.move_to(d.top(z=5))
+                pipette.aspirate(air_gap_vol)  # air gap
+        if blow_out == False:
+            return (len(dest) * volume)
         try:
             pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
         except:
@@ -199,36 +302,126 @@ def run(ctx: protocol_api.ProtocolContext):
         if blow_out == True:
             pipet.blow_out(location.top(z=-2))  # Blow out
 
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
+    class LiquidLevel:
+        '''
+        Volume to height lookup table for the wells of a labware.
+        The table is built once from the labware definition and each query is an O(1)
+        interpolation, so all the stations share the same height formula.
+        shape: bottom of the well. 'flat', 'cone', 'sphere', 'prism' (triangular trough,
+        as in 12 well reservoirs) or 'v' (square pyramid, as in KingFisher deepwells).
+        If None, it is read from wellBottomShape in the labware definition.
+        h_bottom: height of the bottom shape in mm (radius of the well for 'sphere' if None)
+        resolution: number of points of the lookup table
+        '''
+        def __init__(self, labware, shape = None, h_bottom = None, resolution = 1000):
+            definition = get_labware_definition(labware.load_name)
+            well = definition['wells'][definition['ordering'][0][0]]
+            if well['shape'] == 'circular':
+                self.area = math.pi * well['diameter']**2 / 4
+                radius = well['diameter'] / 2
+            else:
+                self.area = well['xDimension'] * well['yDimension']
+                radius = min(well['xDimension'], well['yDimension']) / 2
+            if shape == None:
+                bottom = definition['groups'][0]['metadata'].get('wellBottomShape', 'flat')
+                if bottom == 'u':
+                    shape = 'sphere'
+                elif bottom == 'v':
+                    shape = 'cone' if well['shape'] == 'circular' else 'v'
+                else:
+                    shape = 'flat'
+            if h_bottom == None:
+                h_bottom = radius if shape == 'sphere' else 0
+            if shape == 'flat' or h_bottom <= 0:
+                shape, h_bottom = 'flat', 0
+            self.shape = shape
+            self.h_bottom = min(h_bottom, well['depth'])
+            self.depth = well['depth']
+            self.max_volume = self.volume(self.depth)
+            # Heights sampled on an evenly spaced volume axis, so a query is an index lookup
+            heights = np.linspace(0, self.depth, resolution * 4)
+            volumes = np.array([self.volume(h) for h in heights])
+            self.step = self.max_volume / (resolution - 1)
+            self.table = np.interp(np.arange(resolution) * self.step, volumes, heights)
+
+        def volume(self, height):
+            '''
+            Volume in µl contained in a well filled up to [height] mm from its bottom
+            '''
+            hb = self.h_bottom
+            h = min(height, hb)
+            if self.shape == 'flat':
+                v = 0
+            elif self.shape in ['cone', 'v']:  # area grows with the square of the height
+                v = self.area * h**3 / (3 * hb**2)
+            elif self.shape == 'prism':  # area grows linearly with the height
+                v = self.area * h**2 / (2 * hb)
+            else:  # sphere cap with a base of [area] at [h_bottom]
+                r_sphere = (self.area / math.pi + hb**2) / (2 * hb)
+                v = math.pi * h**2 * (3 * r_sphere - h) / 3
+            return v + self.area * max(height - hb, 0)
+
+        def height(self, volume):
+            '''
+            Height in mm from the bottom of the well of the surface of [volume] µl
+            '''
+            if volume <= 0:
+                return 0
+            if volume >= self.max_volume:
+                return self.depth
+            position = volume / self.step
+            i = int(position)
+            return float(self.table[i] + (self.table[i + 1] - self.table[i]) * (position - i))
+
+    def calc_height(reagent, aspirate_volume, min_height = 0.5, immersion = 1):
+        '''
+        Aspiration height for [aspirate_volume] of [reagent].
+        The well is chosen by reagent.wells (ReservoirState) and the height is taken
+        from the reagent.level table (LiquidLevel), [immersion] mm below the surface
+        that will remain after aspirating.
+        '''
         nonlocal ctx
         ctx.comment('Remaining volume ' + str(reagent.vol_well) +
                     '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
+        well = reagent.wells.select(aspirate_volume)
+        if well != reagent.col:
+            reagent.unused = reagent.wells.stranded()
             ctx.comment('Next column should be picked')
+            ctx.comment('Stranded volume of ' + reagent.name + ': ' + str(sum(reagent.unused)))
             ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
+            # column selector position; chosen by the reservoir policy
+            reagent.col = well
             ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
             col_change = True
         else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
             col_change = False
+        if reagent.wells.volumes[well] < aspirate_volume:
+            ctx.comment('Not enough volume of ' + reagent.name + ' left in any well')
+        reagent.vol_well = reagent.wells.aspirate(well, aspirate_volume)
+        ctx.comment('Remaining volume:' + str(reagent.vol_well))
+        height = reagent.level.height(reagent.vol_well) - immersion
+        ctx.comment('Calculated height is ' + str(height))
+        if height < min_height:
+            height = min_height
+        ctx.comment('Used height is ' + str(height))
         return height, col_change
 
+    def pick_up(pip):
+        # Homing policy: home the plunger when it is due, before the new tip
+        drops = tip_track['drops'][pip]
+        if drops >= home_every or (drops > 0 and STEP in precise_steps):
+            ctx.comment('Homing ' + str(pip) + ' plunger after ' + str(drops) + ' drops')
+            pip.home_plunger()
+            tip_track['drops'][pip] = 0
+        pip.pick_up_tip()
+
+    def drop(pip):
+        '''
+        Drop the tip without homing the plunger, pick_up homes it when it is due
+        '''
+        pip.drop_tip(home_after = False)
+        tip_track['drops'][pip] += 1
+
     ####################################
     # load labware and modules
     # 24 well rack
@@ -269,15 +462,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ################################################################################
     # Declare which reagents are in each reservoir as well as deepwell and elution plate
     MMIX.reagent_reservoir = tuberack.rows()[0][:MMIX.num_wells] # 1 row, 2 columns (first ones)
+    MMIX.level = LiquidLevel(tuberack, shape = 'cone', h_bottom = MMIX.h_cono)
     ctx.comment('Wells in: '+ str(tuberack.rows()[0][:MMIX.num_wells]) + ' element: '+str(MMIX.reagent_reservoir[MMIX.col]))
     # setup up sample sources and destinations
     samples = source_plate.wells()[:NUM_SAMPLES]
     samples_multi = source_plate.rows()[0][:num_cols]
     pcr_wells = qpcr_plate.wells()[:NUM_SAMPLES]
     pcr_wells_multi = qpcr_plate.rows()[0][:num_cols]
-    # Divide destination wells in small groups for P300 pipette
-    dests = list(divide_destinations(pcr_wells, size_transfer))
-
 
     # pipettes
     m20 = ctx.load_instrument(
@@ -285,10 +476,20 @@ def run(ctx: protocol_api.ProtocolContext):
     p300 = ctx.load_instrument(
         'p300_single_gen2', mount='left', tip_racks=tips200)
 
+    # Divide destination wells in the fewest groups that fit in a P300 tip
+    dests = plan_multi_dispense(pcr_wells, volume_mmix, p300.max_volume,
+                                tip_capacity = tips200[0].wells()[0].max_volume,
+                                conditioning_vol = conditioning_vol,
+                                disposal_vol = extra_dispensal, air_gap_vol = air_gap_vol)
+    ctx.comment('Master Mix distributed in ' + str(len(dests)) + ' aspirations of up to ' +
+                str(len(dests[0])) + ' wells')
+
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': {p300: 0,
-                   m20: 0}
+                   m20: 0},
+        'drops': {p300: 0,
+                  m20: 0}
     }
 
     ############################################################################
@@ -297,18 +498,20 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute'] == True:
         start = datetime.now()
-        p300.pick_up_tip()
+        pick_up(p300)
 
         used_vol=[]
         for dest in dests:
-            aspirate_volume=volume_mmix * len(dest) + extra_dispensal
-            [pickup_height,col_change]=calc_height(MMIX, area_section_screwcap, aspirate_volume)
+            aspirate_volume = (volume_mmix * len(dest) + conditioning_vol +
+                               extra_dispensal) * p300.channels
+            [pickup_height,col_change]=calc_height(MMIX, aspirate_volume)
             used_vol_temp = distribute_custom(
-            p300, volume = volume_mmix, src = MMIX.reagent_reservoir[MMIX.col], dest = dest,
+            p300, MMIX, volume = volume_mmix, src = MMIX.reagent_reservoir[MMIX.col], dest = dest,
             waste_pool = MMIX.reagent_reservoir[MMIX.col], pickup_height = pickup_height,
-            extra_dispensal = extra_dispensal)
+            conditioning_vol = conditioning_vol, disposal_vol = extra_dispensal,
+            air_gap_vol = air_gap_vol)
             used_vol.append(used_vol_temp)
-        p300.drop_tip()
+        drop(p300)
         tip_track['counts'][p300]+=1
         #MMIX.unused_two = MMIX.vol_well
 
@@ -328,13 +531,13 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('pcr_wells')
         #Loop over defined wells
         for s, d in zip(samples_multi, pcr_wells_multi):
-            m20.pick_up_tip()
+            pick_up(m20)
             #Source samples
             move_vol_multichannel(m20, reagent = Samples, source = s, dest = d,
             vol = volume_sample, air_gap_vol = air_gap_sample, x_offset = x_offset,
                    pickup_height = 0.2, disp_height = -10, rinse = False,
                    blow_out=True, touch_tip=False)
-            m20.drop_tip()
+            drop(m20)
             tip_track['counts'][m20]+=8
 
         end = datetime.now()
@@ -369,6 +572,7 @@ def run(ctx: protocol_api.ProtocolContext):
         gpio.set_rail_lights(False)
     gpio.set_button_light(0, 1, 0)
     ctx.comment('Finished! \nMove plate to PCR')
+    ctx.comment('Master Mix tube switches: ' + str(MMIX.wells.switches))
 
     if STEPS[1]['Execute'] == True:
         total_used_vol = np.sum(used_vol)
@@ -378,7 +582,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     str(total_needed_volume + extra_dispensal*len(dests)) +'\u03BCl')
         ctx.comment('Used Master Mix volumes per run are: ' + str(used_vol) + '\u03BCl.')
         ctx.comment('Master Mix Volume remaining in tubes is: ' +
-                    format(np.sum(MMIX.unused)+extra_dispensal*len(dests)+MMIX.vol_well) + '\u03BCl.')
+                    format(np.sum(MMIX.wells.volumes)+extra_dispensal*len(dests)) + '\u03BCl.')
         ctx.comment('200 ul Used tips in total: ' + str(tip_track['counts'][p300]))
         ctx.comment('200 ul Used racks in total: ' + str(tip_track['counts'][p300] / 96))
 
@@ -1,6 +1,7 @@
 import math
-from opentrons.types import Point
+from opentrons.types import Point, Location
 from opentrons import protocol_api
+from opentrons.protocol_api.labware import get_labware_definition
 import time
 import os
 import numpy as np
@@ -26,12 +27,26 @@ metadata = {
 ##################
 NUM_SAMPLES = 96
 NUM_SAMPLES = NUM_SAMPLES - 1 #Remove last sample (PC), done manually
+# Tip reuse rules, checked in order for two consecutive uses of a pipette: the first one
+# that matches tells if the tip is kept ('reuse') or dropped ('new'). Conditions:
+# 'sample_contact' (either use touches sample), 'same_reagent' (same reagent and source)
+# and 'any'. [['any', 'new']] changes the tip after every use.
+TIP_RULES = [['sample_contact', 'new'],
+             ['same_reagent', 'reuse'],
+             ['any', 'new']]
+low_arc = False  # Move between labware over the labware near the path
+low_arc_clearance = 10  # mm over the labware in low arcs
+low_arc_margin = 15  # mm around the wells of a labware that low arcs keep clear of
+# Homing policy: the tips are dropped without homing the plunger, which is homed before
+# picking up a tip once home_every tips were dropped (1: before every tip, as a drop with
+# home_after) and before every tip of the precise_steps
+home_every = 4
+precise_steps = [3]  # Elution buffer
 
 air_gap_vol = 15
 air_gap_vol_elutionbuffer = 5
 
 x_offset = [0,0]
-multi_well_rack_area = 8.2 * 71.2  # Cross section of the 12 well reservoir
 num_cols = math.ceil(NUM_SAMPLES / 8)  # Columns we are working on
 
 
@@ -55,11 +70,73 @@ def run(ctx: protocol_api.ProtocolContext):
             os.mkdir(folder_path)
         file_path = folder_path + '/KB_PlateFilling_viral_path2_time_log.txt'
 
+    footprints = {}  # of the labware, for low_arc_move
+
     # Define Reagents as objects with their properties
+    class ReservoirState:
+        '''
+        Live volume of every well of a reagent, used by calc_height to choose the well.
+        policy: how the well for the next aspiration is chosen
+            'fewest_switches': stay in the current well while it can serve the volume,
+                     then move to the fullest well, the one that lasts the longest
+            'drain': stay in the current well while it can serve the volume, then move
+                     to the emptiest well that can, to use the leftovers first
+            'fullest': always the well with the highest volume
+            'round_robin': the next well (in order) that can serve the volume
+        '''
+        __slots__ = ['volumes', 'policy', 'current', 'switches', 'used']
+
+        def __init__(self, num_wells, volume_per_well, policy = 'fewest_switches'):
+            self.volumes = np.full(num_wells, float(volume_per_well))
+            self.policy = policy
+            self.current = 0
+            self.switches = 0
+            self.used = np.zeros(num_wells, dtype = bool)
+
+        def select(self, aspirate_volume):
+            '''
+            Index of the well for [aspirate_volume]. If no well has enough volume left
+            the fullest one is returned.
+            '''
+            candidates = np.flatnonzero(self.volumes >= aspirate_volume)
+            if len(candidates) == 0:
+                well = int(np.argmax(self.volumes))
+            elif self.policy == 'fullest':
+                well = int(np.argmax(self.volumes))
+            elif self.policy == 'round_robin':
+                after = candidates[candidates > self.current]
+                well = int(after[0]) if len(after) > 0 else int(candidates[0])
+            elif self.volumes[self.current] >= aspirate_volume:
+                well = self.current
+            elif self.policy == 'drain':
+                well = int(candidates[np.argmin(self.volumes[candidates])])
+            else:
+                well = int(np.argmax(self.volumes))
+            if well != self.current:
+                self.switches += 1
+                self.current = well
+            return well
+
+        def aspirate(self, well, volume):
+            '''
+            Remove [volume] from [well] and return the volume left in it
+            '''
+            self.volumes[well] -= volume
+            self.used[well] = True
+            return float(self.volumes[well])
+
+        def stranded(self):
+            '''
+            Volumes left in the wells that were aspirated from and then left. A well
+            the policy comes back to is not stranded any more.
+            '''
+            return [float(v) for i, v in enumerate(self.volumes)
+                    if self.used[i] and i != self.current]
+
     class Reagent:
         def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
                      reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
+                      tip_recycling = 'none', policy = 'fewest_switches'):
             self.name = name
             self.flow_rate_aspirate = flow_rate_aspirate
             self.flow_rate_dispense = flow_rate_dispense
@@ -74,6 +151,7 @@ def run(ctx: protocol_api.ProtocolContext):
             self.unused=[]
             self.tip_recycling = tip_recycling
             self.vol_well_original = reagent_reservoir_volume / num_wells
+            self.wells = ReservoirState(num_wells, self.vol_well_original, policy)
 
 
     # Reagents and their characteristics
@@ -113,6 +191,72 @@ def run(ctx: protocol_api.ProtocolContext):
 
     ##################
     # Custom functions
+    def footprint(labware):
+        '''
+        [x min, x max, y min, y max, top] of [labware], low_arc_margin mm around its wells
+        '''
+        if labware not in footprints:
+            points = [w.top().point for w in labware.wells()]
+            footprints[labware] = [min([p.x for p in points]) - low_arc_margin,
+                                   max([p.x for p in points]) + low_arc_margin,
+                                   min([p.y for p in points]) - low_arc_margin,
+                                   max([p.y for p in points]) + low_arc_margin,
+                                   labware.highest_z]
+        return footprints[labware]
+
+    def low_arc_move(pipet, well):
+        '''
+        Move [pipet] over [well] in direct moves, low_arc_clearance mm over the highest
+        labware near the straight path (the channels of a multichannel reach 9 mm per
+        channel to the front), instead of the arc over the highest labware of the deck.
+        The locations are of the end of the tip, so the length of the tip is included.
+        The next command in [well] goes straight down. Moves within a labware and runs
+        with more than one pipette (the cached location may be of the other one) keep
+        the arcs of the robot.
+        '''
+        start = ctx.location_cache
+        if low_arc == False or start == None or len(ctx.loaded_instruments) > 1:
+            return
+        a = start.point
+        b = well.top().point
+        x0, x1, y0, y1, top = footprint(well.parent)
+        if x0 <= a.x <= x1 and y0 <= a.y <= y1:
+            return
+        reach = 9 * (pipet.channels - 1)
+        steps = int(math.hypot(b.x - a.x, b.y - a.y) / 5) + 1
+        path = [[a.x + (b.x - a.x) * i / steps, a.y + (b.y - a.y) * i / steps]
+                for i in range(steps + 1)]
+        for labware in ctx.loaded_labwares.values():
+            x0, x1, y0, y1, z = footprint(labware)
+            if z > top and any([x0 <= x <= x1 and y0 <= y <= y1 + reach for x, y in path]):
+                top = z
+        safe = max(top + low_arc_clearance, a.z)
+        pipet.move_to(Location(Point(a.x, a.y, safe), start.labware), force_direct = True)
+        pipet.move_to(Location(Point(b.x, b.y, safe), well), force_direct = True)
+
+    def tip_rule(a, b):
+        '''
+        Action of the first rule of TIP_RULES that matches the tip uses [a] and [b]
+        '''
+        for condition, action in TIP_RULES:
+            if condition == 'any' or \
+                    (condition == 'sample_contact' and (a[4] == True or b[4] == True)) or \
+                    (condition == 'same_reagent' and a[2] is b[2] and a[3] == b[3]):
+                return action
+        return 'new'
+
+    def tip_schedule(uses):
+        '''
+        Minimal tip schedule of the tip [uses], [name, pipette, reagent, source, contact
+        with sample] in the order they run. Returns {name: True if the tip is kept for
+        the next use of the same pipette}.
+        '''
+        keep = {}
+        for i, use in enumerate(uses):
+            following = [u for u in uses[i + 1:] if u[1] is use[1]]
+            keep[use[0]] = len(following) > 0 and tip_rule(use, following[0]) == 'reuse'
+        return keep
+
     def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
                        pickup_height, rinse, disp_height, blow_out, touch_tip):
         '''
@@ -122,6 +266,7 @@ def run(ctx: protocol_api.ProtocolContext):
         disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
         blow_out, touch_tip: if True they will be done after dispensing
         '''
+        low_arc_move(pipet, source)
         # Rinse before aspirating
         if rinse == True:
             custom_mix(pipet, reagent, location = source, vol = vol,
@@ -134,6 +279,7 @@ def run(ctx: protocol_api.ProtocolContext):
             pipet.aspirate(air_gap_vol, source.top(z = -2),
                            rate = reagent.flow_rate_aspirate)  # air gap
         # GO TO DESTINATION
+        low_arc_move(pipet, dest)
         drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
         pipet.dispense(vol + air_gap_vol, drop,
                        rate = reagent.flow_rate_dispense)  # dispense all
@@ -167,36 +313,136 @@ def run(ctx: protocol_api.ProtocolContext):
         if blow_out == True:
             pipet.blow_out(location.top(z=-2))  # Blow out
 
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
+    class LiquidLevel:
+        '''
+        Volume to height lookup table for the wells of a labware.
+        The table is built once from the labware definition and each query is an O(1)
+        interpolation, so all the stations share the same height formula.
+        shape: bottom of the well. 'flat', 'cone', 'sphere', 'prism' (triangular trough,
+        as in 12 well reservoirs) or 'v' (square pyramid, as in KingFisher deepwells).
+        If None, it is read from wellBottomShape in the labware definition.
+        h_bottom: height of the bottom shape in mm (radius of the well for 'sphere' if None)
+        resolution: number of points of the lookup table
+        '''
+        def __init__(self, labware, shape = None, h_bottom = None, resolution = 1000):
+            definition = get_labware_definition(labware.load_name)
+            well = definition['wells'][definition['ordering'][0][0]]
+            if well['shape'] == 'circular':
+                self.area = math.pi * well['diameter']**2 / 4
+                radius = well['diameter'] / 2
+            else:
+                self.area = well['xDimension'] * well['yDimension']
+                radius = min(well['xDimension'], well['yDimension']) / 2
+            if shape == None:
+                bottom = definition['groups'][0]['metadata'].get('wellBottomShape', 'flat')
+                if bottom == 'u':
+                    shape = 'sphere'
+                elif bottom == 'v':
+                    shape = 'cone' if well['shape'] == 'circular' else 'v'
+                else:
+                    shape = 'flat'
+            if h_bottom == None:
+                h_bottom = radius if shape == 'sphere' else 0
+            if shape == 'flat' or h_bottom <= 0:
+                shape, h_bottom = 'flat', 0
+            self.shape = shape
+            self.h_bottom = min(h_bottom, well['depth'])
+            self.depth = well['depth']
+            self.max_volume = self.volume(self.depth)
+            # Heights sampled on an evenly spaced volume axis, so a query is an index lookup
+            heights = np.linspace(0, self.depth, resolution * 4)
+            volumes = np.array([self.volume(h) for h in heights])
+            self.step = self.max_volume / (resolution - 1)
+            self.table = np.interp(np.arange(resolution) * self.step, volumes, heights)
+
+        def volume(self, height):
+            '''
+            Volume in µl contained in a well filled up to [height] mm from its bottom
+            '''
+            hb = self.h_bottom
+            h = min(height, hb)
+            if self.shape == 'flat':
+                v = 0
+            elif self.shape in ['cone', 'v']:  # area grows with the square of the height
+                v = self.area * h**3 / (3 * hb**2)
+            elif self.shape == 'prism':  # area grows linearly with the height
+                v = self.area * h**2 / (2 * hb)
+            else:  # sphere cap with a base of [area] at [h_bottom]
+                r_sphere = (self.area / math.pi + hb**2) / (2 * hb)
+                v = math.pi * h**2 * (3 * r_sphere - h) / 3
+            return v + self.area * max(height - hb, 0)
+
+        def height(self, volume):
+            '''
+            Height in mm from the bottom of the well of the surface of [volume] µl
+            '''
+            if volume <= 0:
+                return 0
+            if volume >= self.max_volume:
+                return self.depth
+            position = volume / self.step
+            i = int(position)
+            return float(self.table[i] + (self.table[i + 1] - self.table[i]) * (position - i))
+
+    def calc_height(reagent, aspirate_volume, min_height = 0.5, immersion = 1):
+        '''
+        Aspiration height for [aspirate_volume] of [reagent].
+        The well is chosen by reagent.wells (ReservoirState) and the height is taken
+        from the reagent.level table (LiquidLevel), [immersion] mm below the surface
+        that will remain after aspirating.
+        '''
         nonlocal ctx
         ctx.comment('Remaining volume ' + str(reagent.vol_well) +
                     '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
+        well = reagent.wells.select(aspirate_volume)
+        if well != reagent.col:
+            reagent.unused = reagent.wells.stranded()
             ctx.comment('Next column should be picked')
+            ctx.comment('Stranded volume of ' + reagent.name + ': ' + str(sum(reagent.unused)))
             ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
+            # column selector position; chosen by the reservoir policy
+            reagent.col = well
             ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
             col_change = True
         else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
             col_change = False
+        if reagent.wells.volumes[well] < aspirate_volume:
+            ctx.comment('Not enough volume of ' + reagent.name + ' left in any well')
+        reagent.vol_well = reagent.wells.aspirate(well, aspirate_volume)
+        ctx.comment('Remaining volume:' + str(reagent.vol_well))
+        height = reagent.level.height(reagent.vol_well) - immersion
+        ctx.comment('Calculated height is ' + str(height))
+        if height < min_height:
+            height = min_height
+        ctx.comment('Used height is ' + str(height))
         return height, col_change
 
+    def divide_volume(volume, max_vol, air_gap_vol = 0, tip_capacity = None,
+                      disposal_vol = 0):
+        '''
+        Split [volume] in the minimum number of transfers (trips) of similar volume.
+        max_vol: maximum volume of the pipette
+        air_gap_vol, disposal_vol: volume taken in each trip that is not dispensed
+        tip_capacity: volume of the tips; the trip is limited by the smallest of both
+        '''
+        if tip_capacity == None:
+            tip_capacity = max_vol
+        trip_vol = min(max_vol, tip_capacity) - air_gap_vol - disposal_vol
+        if trip_vol < 1:
+            # The trips are rounded up to whole µl, so none would fit
+            raise ValueError('A trip of ' + str(min(max_vol, tip_capacity)) +
+                             ' µl has no room left for liquid after ' +
+                             str(air_gap_vol) + ' µl of air gap and ' +
+                             str(disposal_vol) + ' µl of disposal volume')
+        num_transfers = math.ceil(volume / trip_vol)
+        while math.ceil(volume / num_transfers) > trip_vol:
+            num_transfers += 1
+        vol_roundup = math.ceil(volume / num_transfers)
+        last_vol = volume - vol_roundup * (num_transfers - 1)
+        vol_list = [vol_roundup for v in range(1, num_transfers)]
+        vol_list.append(last_vol)
+        return vol_list
+
     ##########
     # pick up tip and if there is none left, prompt user for a new rack
     def pick_up(pip):
@@ -207,7 +453,20 @@ def run(ctx: protocol_api.ProtocolContext):
                 resuming.')
                 pip.reset_tipracks()
                 tip_track['counts'][pip] = 0
+        # Homing policy: home the plunger when it is due, before the new tip
+        drops = tip_track['drops'][pip]
+        if drops >= home_every or (drops > 0 and STEP in precise_steps):
+            ctx.comment('Homing ' + str(pip) + ' plunger after ' + str(drops) + ' drops')
+            pip.home_plunger()
+            tip_track['drops'][pip] = 0
         pip.pick_up_tip()
+
+    def drop(pip):
+        '''
+        Drop the tip without homing the plunger, pick_up homes it when it is due
+        '''
+        pip.drop_tip(home_after = False)
+        tip_track['drops'][pip] += 1
     ##########
 
     def find_side(col):
@@ -250,20 +509,23 @@ def run(ctx: protocol_api.ProtocolContext):
         'kf_96_wellplate_2400ul', '4', 'EtOH 80% Deepwell plate')
 
     ############################################
-    ElutionBuffer_1000ul_plate = ctx.load_labware(
-        'kingfisher_std_96_wellplate_550ul', '6', 'Elution Buffer 550 ul STD plate')
+    ElutionBuffer_50ul_plate = ctx.load_labware(
+        'kingfisher_std_96_wellplate_550ul', '6', 'Elution Buffer 50 ul STD plate')
 
 
 ####################################
     # Load tip_racks
     tips300 = [ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filter tiprack')
                for slot in ['8']]
+    # The racks hold 200µl filter tips, loaded with the 300ul tiprack definition
+    tip_capacity = 200
 
 ################################################################################
     # Declare which reagents are in each reservoir as well as deepwell and elution plate
     WashBuffer.reagent_reservoir = WashBuffer_reservoir.wells()[0]
     Ethanol80.reagent_reservoir = Ethanol80_reservoir.wells()[0]
     ElutionBuffer.reagent_reservoir = reagent_res.rows()[0][0]
+    ElutionBuffer.level = LiquidLevel(reagent_res, shape = 'prism', h_bottom = ElutionBuffer.h_cono)
 
     # columns in destination plates to be filled depending the number of samples
     wb_destination = WashBuffer_1000ul_plate.rows()[0][:num_cols]
@@ -277,9 +539,16 @@ def run(ctx: protocol_api.ProtocolContext):
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': {m300: 0},
-        'maxes': {m300: len(tips300)*96}
+        'maxes': {m300: len(tips300)*96},
+        'drops': {m300: 0}
     }
 
+    # Tip schedule: a tip is kept for the next step when TIP_RULES allow it
+    tip_uses = [[s, m300, reagent, reagent.reagent_reservoir, False]
+                for s, reagent in [[1, WashBuffer], [2, Ethanol80], [3, ElutionBuffer]]
+                if STEPS[s]['Execute'] == True]
+    keep_tip = tip_schedule(tip_uses)
+
     ############################################################################
     # STEP 1 Filling with WashBuffer plate
     ############################################################################
@@ -290,7 +559,10 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
         ctx.comment('###############################################')
 
-        wash_buffer_vol = [170, 170, 170, 170, 170, 150]
+        wash_buffer_vol = divide_volume(1000, m300.max_volume, air_gap_vol = air_gap_vol,
+                                        tip_capacity = tip_capacity)
+        ctx.comment('Volume plan: ' + str(wash_buffer_vol) + ' µl, ' +
+                    str(len(wash_buffer_vol)) + ' trips per column')
         rinse = False  # Only first time
 
         ########
@@ -308,8 +580,9 @@ def run(ctx: protocol_api.ProtocolContext):
                                air_gap_vol = air_gap_vol, x_offset = x_offset,
                                pickup_height = 1, rinse = rinse, disp_height = -2,
                                blow_out = True, touch_tip = True)
-        m300.drop_tip(home_after=True)
-        tip_track['counts'][m300] += 8
+        if keep_tip[STEP] == False:
+            drop(m300)
+            tip_track['counts'][m300] += 8
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
@@ -326,7 +599,10 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
         ctx.comment('###############################################')
 
-        wash_buffer_vol = [170, 170, 170, 170, 170, 150]
+        wash_buffer_vol = divide_volume(1000, m300.max_volume, air_gap_vol = air_gap_vol,
+                                        tip_capacity = tip_capacity)
+        ctx.comment('Volume plan: ' + str(wash_buffer_vol) + ' µl, ' +
+                    str(len(wash_buffer_vol)) + ' trips per column')
         rinse = False  # Only first time
 
         ########
@@ -344,8 +620,9 @@ def run(ctx: protocol_api.ProtocolContext):
                                air_gap_vol = air_gap_vol, x_offset = x_offset,
                                pickup_height = 1, rinse = rinse, disp_height = -2,
                                blow_out = True, touch_tip = True)
-        m300.drop_tip(home_after=True)
-        tip_track['counts'][m300] += 8
+        if keep_tip[STEP] == False:
+            drop(m300)
+            tip_track['counts'][m300] += 8
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
@@ -372,7 +649,7 @@ def run(ctx: protocol_api.ProtocolContext):
             for transfer_vol in ElutionBuffer_vol:
                 # Calculate pickup_height based on remaining volume and shape of container
                 [pickup_height, change_col] = calc_height(
-                    ElutionBuffer, multi_well_rack_area, transfer_vol * 8)
+                    ElutionBuffer, transfer_vol * 8)
                 ctx.comment(
                     'Aspirate from Reservoir column: ' + str(ElutionBuffer.col))
                 ctx.comment('Pickup height is ' + str(pickup_height))
@@ -381,8 +658,9 @@ def run(ctx: protocol_api.ProtocolContext):
                               air_gap_vol = air_gap_vol_elutionbuffer, x_offset = x_offset,
                               pickup_height = pickup_height, rinse = False, disp_height = -2,
                               blow_out = True, touch_tip = False)
-        m300.drop_tip(home_after=True)
-        tip_track['counts'][m300] += 8
+        if keep_tip[STEP] == False:
+            drop(m300)
+            tip_track['counts'][m300] += 8
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
@@ -1,6 +1,7 @@
 import math
 from opentrons.types import Point
 from opentrons import protocol_api
+from opentrons.protocol_api.labware import get_labware_definition
 import time
 import os
 import numpy as np
@@ -28,11 +29,25 @@ metadata = {
 ##################
 NUM_SAMPLES = 96
 NUM_SAMPLES = NUM_SAMPLES - 1 #Remove last sample (PC), done manually
+# Tip reuse rules, checked in order for two consecutive uses of a pipette: the first one
+# that matches tells if the tip is kept ('reuse') or dropped ('new'). Conditions:
+# 'sample_contact' (either use touches sample), 'same_reagent' (same reagent and source)
+# and 'any'. [['any', 'new']] changes the tip after every use.
+TIP_RULES = [['sample_contact', 'new'],
+             ['same_reagent', 'reuse'],
+             ['any', 'new']]
+# Homing policy: the tips are dropped without homing the plunger, which is homed before
+# picking up a tip once home_every tips were dropped (1: before every tip, as a drop with
+# home_after) and before every tip of the precise_steps
+home_every = 4
+precise_steps = [1]  # 5 ul of MS2
 
 air_gap_vol = 15
 MS_vol = 10
 air_gap_vol_MS = 2
 height_MS = -35
+sample_volume = 400  # µl of sample in the deepwells, from station A
+contact_margin = 2  # mm over the sample surface of a dispense without contact
 temperature = 10
 
 x_offset = [0, 0]
@@ -49,7 +64,6 @@ area_section_screwcap = (np.pi * diameter_screwcap**2) / 4
 h_cone = (volume_cone * 3 / area_section_screwcap)
 screwcap_cross_section_area = math.pi * \
     diameter_screwcap**2 / 4  # screwcap cross secion area
-multi_well_rack_area = 8.2 * 71.2  # Cross section of the 12 well reservoir
 deepwell_cross_section_area = L_deepwell**2  # deepwell cross secion area
 num_cols = math.ceil(NUM_SAMPLES / 8)  # Columns we are working on
 
@@ -76,10 +90,70 @@ def run(ctx: protocol_api.ProtocolContext):
         file_path = folder_path + '/Station_KB_sample_prep_viral_path2_time_log.txt'
 
     # Define Reagents as objects with their properties
+    class ReservoirState:
+        '''
+        Live volume of every well of a reagent, used by calc_height to choose the well.
+        policy: how the well for the next aspiration is chosen
+            'fewest_switches': stay in the current well while it can serve the volume,
+                     then move to the fullest well, the one that lasts the longest
+            'drain': stay in the current well while it can serve the volume, then move
+                     to the emptiest well that can, to use the leftovers first
+            'fullest': always the well with the highest volume
+            'round_robin': the next well (in order) that can serve the volume
+        '''
+        __slots__ = ['volumes', 'policy', 'current', 'switches', 'used']
+
+        def __init__(self, num_wells, volume_per_well, policy = 'fewest_switches'):
+            self.volumes = np.full(num_wells, float(volume_per_well))
+            self.policy = policy
+            self.current = 0
+            self.switches = 0
+            self.used = np.zeros(num_wells, dtype = bool)
+
+        def select(self, aspirate_volume):
+            '''
+            Index of the well for [aspirate_volume]. If no well has enough volume left
+            the fullest one is returned.
+            '''
+            candidates = np.flatnonzero(self.volumes >= aspirate_volume)
+            if len(candidates) == 0:
+                well = int(np.argmax(self.volumes))
+            elif self.policy == 'fullest':
+                well = int(np.argmax(self.volumes))
+            elif self.policy == 'round_robin':
+                after = candidates[candidates > self.current]
+                well = int(after[0]) if len(after) > 0 else int(candidates[0])
+            elif self.volumes[self.current] >= aspirate_volume:
+                well = self.current
+            elif self.policy == 'drain':
+                well = int(candidates[np.argmin(self.volumes[candidates])])
+            else:
+                well = int(np.argmax(self.volumes))
+            if well != self.current:
+                self.switches += 1
+                self.current = well
+            return well
+
+        def aspirate(self, well, volume):
+            '''
+            Remove [volume] from [well] and return the volume left in it
+            '''
+            self.volumes[well] -= volume
+            self.used[well] = True
+            return float(self.volumes[well])
+
+        def stranded(self):
+            '''
+            Volumes left in the wells that were aspirated from and then left. A well
+            the policy comes back to is not stranded any more.
+            '''
+            return [float(v) for i, v in enumerate(self.volumes)
+                    if self.used[i] and i != self.current]
+
     class Reagent:
         def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
                      reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
+                      tip_recycling = 'none', policy = 'fewest_switches'):
             self.name = name
             self.flow_rate_aspirate = flow_rate_aspirate
             self.flow_rate_dispense = flow_rate_dispense
@@ -94,6 +168,7 @@ def run(ctx: protocol_api.ProtocolContext):
             self.unused=[]
             self.tip_recycling = tip_recycling
             self.vol_well_original = reagent_reservoir_volume / num_wells
+            self.wells = ReservoirState(num_wells, self.vol_well_original, policy)
 
 
     # Reagents and their characteristics
@@ -132,6 +207,39 @@ def run(ctx: protocol_api.ProtocolContext):
     Beads.vol_well = Beads.vol_well_original
     MS.vol_well = MS.reagent_reservoir_volume
 
+    def tip_rule(a, b):
+        '''
+        Action of the first rule of TIP_RULES that matches the tip uses [a] and [b]
+        '''
+        for condition, action in TIP_RULES:
+            if condition == 'any' or \
+                    (condition == 'sample_contact' and (a[4] == True or b[4] == True)) or \
+                    (condition == 'same_reagent' and a[2] is b[2] and a[3] == b[3]):
+                return action
+        return 'new'
+
+    def tip_schedule(uses):
+        '''
+        Minimal tip schedule of the tip [uses], [name, pipette, reagent, source, contact
+        with sample] in the order they run. Returns {name: True if the tip is kept for
+        the next use of the same pipette}.
+        '''
+        keep = {}
+        for i, use in enumerate(uses):
+            following = [u for u in uses[i + 1:] if u[1] is use[1]]
+            keep[use[0]] = len(following) > 0 and tip_rule(use, following[0]) == 'reuse'
+        return keep
+
+    def sample_contact(well, disp_height, touch_tip):
+        '''
+        True if a dispense [disp_height] mm from the top of [well] reaches the sample in
+        it (sample_volume µl, with contact_margin mm over its surface) or if the tip
+        touches the walls of the well
+        '''
+        depth = well.top().point.z - well.bottom().point.z
+        surface = LiquidLevel(well.parent).height(sample_volume)
+        return touch_tip == True or depth + disp_height < surface + contact_margin
+
     def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
                        pickup_height, rinse, disp_height, blow_out, touch_tip):
         '''
@@ -186,34 +294,108 @@ def run(ctx: protocol_api.ProtocolContext):
         if blow_out == True:
             pipet.blow_out(location.top(z=-2))  # Blow out
 
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
+    class LiquidLevel:
+        '''
+        Volume to height lookup table for the wells of a labware.
+        The table is built once from the labware definition and each query is an O(1)
+        interpolation, so all the stations share the same height formula.
+        shape: bottom of the well. 'flat', 'cone', 'sphere', 'prism' (triangular trough,
+        as in 12 well reservoirs) or 'v' (square pyramid, as in KingFisher deepwells).
+        If None, it is read from wellBottomShape in the labware definition.
+        h_bottom: height of the bottom shape in mm (radius of the well for 'sphere' if None)
+        resolution: number of points of the lookup table
+        '''
+        def __init__(self, labware, shape = None, h_bottom = None, resolution = 1000):
+            definition = get_labware_definition(labware.load_name)
+            well = definition['wells'][definition['ordering'][0][0]]
+            if well['shape'] == 'circular':
+                self.area = math.pi * well['diameter']**2 / 4
+                radius = well['diameter'] / 2
+            else:
+                self.area = well['xDimension'] * well['yDimension']
+                radius = min(well['xDimension'], well['yDimension']) / 2
+            if shape == None:
+                bottom = definition['groups'][0]['metadata'].get('wellBottomShape', 'flat')
+                if bottom == 'u':
+                    shape = 'sphere'
+                elif bottom == 'v':
+                    shape = 'cone' if well['shape'] == 'circular' else 'v'
+                else:
+                    shape = 'flat'
+            if h_bottom == None:
+                h_bottom = radius if shape == 'sphere' else 0
+            if shape == 'flat' or h_bottom <= 0:
+                shape, h_bottom = 'flat', 0
+            self.shape = shape
+            self.h_bottom = min(h_bottom, well['depth'])
+            self.depth = well['depth']
+            self.max_volume = self.volume(self.depth)
+            # Heights sampled on an evenly spaced volume axis, so a query is an index lookup
+            heights = np.linspace(0, self.depth, resolution * 4)
+            volumes = np.array([self.volume(h) for h in heights])
+            self.step = self.max_volume / (resolution - 1)
+            self.table = np.interp(np.arange(resolution) * self.step, volumes, heights)
+
+        def volume(self, height):
+            '''
+            Volume in µl contained in a well filled up to [height] mm from its bottom
+            '''
+            hb = self.h_bottom
+            h = min(height, hb)
+            if self.shape == 'flat':
+                v = 0
+            elif self.shape in ['cone', 'v']:  # area grows with the square of the height
+                v = self.area * h**3 / (3 * hb**2)
+            elif self.shape == 'prism':  # area grows linearly with the height
+                v = self.area * h**2 / (2 * hb)
+            else:  # sphere cap with a base of [area] at [h_bottom]
+                r_sphere = (self.area / math.pi + hb**2) / (2 * hb)
+                v = math.pi * h**2 * (3 * r_sphere - h) / 3
+            return v + self.area * max(height - hb, 0)
+
+        def height(self, volume):
+            '''
+            Height in mm from the bottom of the well of the surface of [volume] µl
+            '''
+            if volume <= 0:
+                return 0
+            if volume >= self.max_volume:
+                return self.depth
+            position = volume / self.step
+            i = int(position)
+            return float(self.table[i] + (self.table[i + 1] - self.table[i]) * (position - i))
+
+    def calc_height(reagent, aspirate_volume, min_height = 0.5, immersion = 1):
+        '''
+        Aspiration height for [aspirate_volume] of [reagent].
+        The well is chosen by reagent.wells (ReservoirState) and the height is taken
+        from the reagent.level table (LiquidLevel), [immersion] mm below the surface
+        that will remain after aspirating.
+        '''
         nonlocal ctx
         ctx.comment('Remaining volume ' + str(reagent.vol_well) +
                     '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
+        well = reagent.wells.select(aspirate_volume)
+        if well != reagent.col:
+            reagent.unused = reagent.wells.stranded()
             ctx.comment('Next column should be picked')
+            ctx.comment('Stranded volume of ' + reagent.name + ': ' + str(sum(reagent.unused)))
             ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
+            # column selector position; chosen by the reservoir policy
+            reagent.col = well
             ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
             col_change = True
         else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
             col_change = False
+        if reagent.wells.volumes[well] < aspirate_volume:
+            ctx.comment('Not enough volume of ' + reagent.name + ' left in any well')
+        reagent.vol_well = reagent.wells.aspirate(well, aspirate_volume)
+        ctx.comment('Remaining volume:' + str(reagent.vol_well))
+        height = reagent.level.height(reagent.vol_well) - immersion
+        ctx.comment('Calculated height is ' + str(height))
+        if height < min_height:
+            height = min_height
+        ctx.comment('Used height is ' + str(height))
         return height, col_change
 
 
@@ -222,6 +404,22 @@ def run(ctx: protocol_api.ProtocolContext):
         for i in range(0, len(l), n):
             yield l[i:i + n]
 
+    def pick_up(pip):
+        # Homing policy: home the plunger when it is due, before the new tip
+        drops = tip_track['drops'][pip]
+        if drops >= home_every or (drops > 0 and STEP in precise_steps):
+            ctx.comment('Homing ' + str(pip) + ' plunger after ' + str(drops) + ' drops')
+            pip.home_plunger()
+            tip_track['drops'][pip] = 0
+        pip.pick_up_tip()
+
+    def drop(pip):
+        '''
+        Drop the tip without homing the plunger, pick_up homes it when it is due
+        '''
+        pip.drop_tip(home_after = False)
+        tip_track['drops'][pip] += 1
+
     ####################################
     # load labware and modules
     # 12 well rack
@@ -275,17 +473,29 @@ def run(ctx: protocol_api.ProtocolContext):
 
     tip_track = {
         'counts': {m300: 0, m20: 0},
-        'maxes': {m300: len(tips200) * 96, m20: len(tips20) * 96}
+        'maxes': {m300: len(tips200) * 96, m20: len(tips20) * 96},
+        'drops': {m300: 0, m20: 0}
     }
 
     # Divide destination wells in small groups for P300 pipette
     # Declare which reagents are in each reservoir as well as deepwell and elution plate
     #destinations = list(divide_destinations(sample_plate.wells()[:NUM_SAMPLES], size_transfer))
     Beads.reagent_reservoir = reagent_res.rows()[0][:Beads.num_wells]  # 1 row, 4 columns (first ones)
+    Beads.level = LiquidLevel(reagent_res, shape = 'prism', h_bottom = Beads.h_cono)
     work_destinations = sample_plate.wells()[:NUM_SAMPLES]
     work_destinations_cols = sample_plate.rows()[0][:num_cols]
     ms_origins = ms_plate.rows()[0][0]  # 1 row, 1 columns
 
+    # Tip schedule: every column of MS2 is a use of m20, the beads steps use m300
+    tip_uses = []
+    if STEPS[1]['Execute'] == True:
+        ms_contact = sample_contact(work_destinations_cols[0], height_MS, True)
+        tip_uses += [[('MS2', i), m20, MS, ms_origins, ms_contact] for i in range(num_cols)]
+    beads_contact = sample_contact(work_destinations_cols[0], -2, False)
+    tip_uses += [[s, m300, Beads, Beads.reagent_reservoir, beads_contact]
+                 for s in [2] if STEPS[s]['Execute'] == True]
+    keep_tip = tip_schedule(tip_uses)
+
     ############################################################################
     # STEP 1: Transfer MS
     ############################################################################
@@ -295,15 +505,17 @@ def run(ctx: protocol_api.ProtocolContext):
         start = datetime.now()
         ctx.comment('ms_wells')
         #Loop over defined wells
-        for d in work_destinations_cols:
-            m20.pick_up_tip()
+        for i, d in enumerate(work_destinations_cols):
+            if not m20.hw_pipette['has_tip']:
+                pick_up(m20)
             #Source samples
             move_vol_multichannel(m20, reagent = MS, source = ms_origins, dest = d,
             vol = MS_vol, air_gap_vol = air_gap_vol_MS, x_offset = x_offset,
-                   pickup_height = 1, disp_height = -35, rinse = False,
+                   pickup_height = 1, disp_height = height_MS, rinse = False,
                    blow_out=True, touch_tip=True)
-            m20.drop_tip()
-            tip_track['counts'][m20]+=8
+            if keep_tip[('MS2', i)] == False:
+                drop(m20)
+                tip_track['counts'][m20]+=8
 
         end = datetime.now()
         time_taken = (end - start)
@@ -324,11 +536,11 @@ def run(ctx: protocol_api.ProtocolContext):
         rinse = True
         for i in range(num_cols):
             if not m300.hw_pipette['has_tip']:
-                m300.pick_up_tip()
+                pick_up(m300)
             for j, transfer_vol in enumerate(beads_transfer_vol):
                 # Calculate pickup_height based on remaining volume and shape of container
                 [pickup_height, change_col] = calc_height(
-                    Beads, multi_well_rack_area, transfer_vol * 8, min_height = 1)
+                    Beads, transfer_vol * 8, min_height = 1)
                 if change_col == True:  # If we switch column because there is not enough volume left in current reservoir column we mix new column
                     ctx.comment(
                         'Mixing new reservoir column: ' + str(Beads.col))
@@ -346,8 +558,9 @@ def run(ctx: protocol_api.ProtocolContext):
                                       pickup_height=pickup_height, disp_height = -2,
                                       rinse=rinse, blow_out = False, touch_tip=False)
 
-        m300.drop_tip(home_after=False)
-        tip_track['counts'][m300] += 8
+        if keep_tip[STEP] == False:
+            drop(m300)
+            tip_track['counts'][m300] += 8
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
@@ -379,3 +592,4 @@ def run(ctx: protocol_api.ProtocolContext):
         time.sleep(0.3)
     gpio.set_button_light(0, 1, 0)
     ctx.comment('Finished! \nMove plate to KingFisher')
+    ctx.comment('Beads reservoir column switches: ' + str(Beads.wells.switches))
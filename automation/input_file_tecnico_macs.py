@@ -8,12 +8,19 @@ import pandas as pd
 import string
 import math
 import time
+import json
+import glob
+import subprocess
 homedir = os.path.expanduser("~")
 main_path = '/Volumes/opentrons/'
 code_path = main_path + 'code/covid19clinic/automation/'
 KF_path = code_path + 'KF_config/'
 KFVP_path = code_path + 'KFVP_config/'
 excel = main_path + 'barcode_template/muestras.xlsx'
+overage_file = code_path + 'reagent_overage.json'
+# Volume per sample of master mix, beads and isopropanol of each protocol (in KFVP
+# it is actually a buffer, not isopropanol)
+reagent_volumes = {'KF': [20, 10, 250], 'KFVP': [20, 20, 530]}
 
 
 
@@ -34,8 +41,32 @@ def select_protocol_type(p1, p2):
             print('Please, try again')
     return pr,p
 
-def rep_data(n, name, f, d, run_name):
+# Fraction of master mix and beads loaded over the volume the stations transfer.
+# The 1.1x rule plus the security volume of each well is the minimum; the overage
+# computed for each number of samples by general_scripts/reagent_overage.py is used
+# when it is bigger. The sample counts missing in its table keep the 1.1x rule
+def reagent_overage(protocol, num_samples):
+    mmix_volume, beads_volume, isoprop_volume = reagent_volumes[protocol]
+    security_volume_mmix = 50
+    security_volume_beads = 800
+    mmix_vol = num_samples * 1.1 * mmix_volume
+    mmix_vol = mmix_vol + security_volume_mmix * math.ceil(mmix_vol/2000)
+    bead_vol = (beads_volume + isoprop_volume) * 8 * math.ceil(num_samples/8)
+    overage = {'mmix': mmix_vol / (num_samples * mmix_volume) - 1,
+               'beads': 0.1 + security_volume_beads * math.ceil(num_samples / 32) / bead_vol}
+    if os.path.isfile(overage_file):
+        table = json.load(open(overage_file)).get(protocol, {})
+        for reagent in overage:
+            if str(num_samples) in table.get(reagent, {}):
+                overage[reagent] = max(overage[reagent], table[reagent][str(num_samples)])
+            else:
+                print('Aviso: no hay exceso calculado de '+reagent+' para '+str(num_samples)+' muestras en '+overage_file+', se usa la regla del 1.1x: '+str(round(overage[reagent], 3)))
+    return overage
+
+def rep_data(n, name, f, d, run_name, overage):
     d=d.replace('$num_samples', str(n))
+    d=d.replace('$mmix_overage', str(overage['mmix']))
+    d=d.replace('$beads_overage', str(overage['beads']))
     d=d.replace('$technician', '\'' + str(name) + '\'')
     d=d.replace('$date', '\'' + str(f) + '\'')
     d=d.replace('$run_id','\'' + str(run_name) + '\'')
@@ -101,6 +132,7 @@ def main():
 
     # select the type of protocol to be run
     [protocol, protocol_path]=select_protocol_type(KF_path, KFVP_path)
+    overage = reagent_overage(protocol, num_samples)
     #determine output path
     run_name = str(dia_registro)+'_OT'+str(id)+'_'+protocol
     final_path=os.path.join(main_path+'RUNS/',run_name)
@@ -120,7 +152,7 @@ def main():
             fin = open(protocol_path+file, "rt") # open file and copy protocol
             data = fin.read()
             fin.close()
-            final_protocol=rep_data(num_samples, tec_name, t_registro, data, run_name) #replace data
+            final_protocol=rep_data(num_samples, tec_name, t_registro, data, run_name, overage) #replace data
             position=file.find('_',12) # find _ position after the name and get value
             filename=str(dia_registro)+'_'+file[:position]+'_OT'+str(id)+'.py' # assign a filename date + station name + id
             for i in range(0,5): #Try up to 5 times with 1 sec delay
@@ -144,27 +176,28 @@ def main():
             fout.write(final_protocol)
             fout.close()
 
+    # Check the scripts (placeholders, undefined names, STEPS, labware) and simulate them
+    # to validate them, in the simulation daemon if it is running; known configurations
+    # come from the cache
+    preflight = subprocess.run(['python3', code_path+'../general_scripts/preflight_scripts.py', final_path], check=False)
+    if preflight.returncode != 0:
+        print('Error: la comprobación de los scripts ha fallado (código '+str(preflight.returncode)+'), revisa los errores de arriba antes de cargar los scripts en los robots')
+    simulation = subprocess.run(['python3', code_path+'../general_scripts/simulation_daemon.py'] + sorted(glob.glob(final_path+'/scripts/*.py')), check=False)
+    if simulation.returncode != 0:
+        print('Error: la simulación de los scripts ha fallado (código '+str(simulation.returncode)+'), los scripts marcados arriba no se pueden ejecutar en los robots')
+
     if protocol=='KF':
         # Volumes for KF pathogen stations
-        security_volume_mmix = 50
-        security_volume_beads = 800
-        mmix_volume = 20
-        beads_volume = 10
-        isoprop_volume = 250
-
-        #Calculate needed volumes and wells in stations B and C
-        bead_vol = beads_volume * 8 * math.ceil(num_samples/8) * 1.1
-        isoprop_vol = isoprop_volume * 8 * math.ceil(num_samples/8) * 1.1
-        num_wells = math.ceil(num_samples / 32) #Number of wells needed
+        mmix_volume, beads_volume, isoprop_volume = reagent_volumes[protocol]
 
-        #Add security volume according to proportion
-        bead_vol = bead_vol + (security_volume_beads/(beads_volume + isoprop_volume)) * beads_volume * num_wells #Add security volume in each well
-        isoprop_vol = isoprop_vol + (security_volume_beads/(beads_volume + isoprop_volume)) * isoprop_volume * num_wells #Add security volume in each well
+        #Calculate needed volumes and wells in stations B and C, with the overage the stations are loaded with
+        bead_vol = beads_volume * 8 * math.ceil(num_samples/8) * (1 + overage['beads'])
+        isoprop_vol = isoprop_volume * 8 * math.ceil(num_samples/8) * (1 + overage['beads'])
+        num_wells = math.ceil(num_samples / 32) #Number of wells needed
         total_bead = bead_vol + isoprop_vol
 
-        mmix_vol = (num_samples * 1.1 * mmix_volume)
+        mmix_vol = num_samples * mmix_volume * (1 + overage['mmix'])
         num_wells_mmix = math.ceil(mmix_vol/2000) # Number of wells needed
-        mmix_vol = mmix_vol + (security_volume_mmix) * num_wells_mmix # Add security volume in each well
         reac1_vol = mmix_vol / 20 * 6.25
         reac2_vol = mmix_vol / 20 * 1.25
         nfree_vol = mmix_vol / 20 * 12.5
@@ -193,24 +226,16 @@ def main():
         f2.close()
     elif protocol=='KFVP':
         # Volumes for KFVP pathogen stations
-        security_volume_mmix = 50
-        security_volume_beads = 800
-        mmix_volume = 20
-        beads_volume = 20
-        isoprop_volume = 530 #It's actually a buffer, not isoprop
-        #Calculate needed volumes and wells in stations B and C
-        bead_vol = beads_volume * 8 * math.ceil(num_samples/8) * 1.1
-        isoprop_vol = isoprop_volume * 8 * math.ceil(num_samples/8) * 1.1
-        num_wells = math.ceil(num_samples / 32) #Number of wells needed
+        mmix_volume, beads_volume, isoprop_volume = reagent_volumes[protocol]
 
-        #Add security volume according to proportion
-        bead_vol = bead_vol + (security_volume_beads/(beads_volume + isoprop_volume)) * beads_volume * num_wells #Add security volume in each well
-        isoprop_vol = isoprop_vol + (security_volume_beads/(beads_volume + isoprop_volume)) * isoprop_volume * num_wells #Add security volume in each well
+        #Calculate needed volumes and wells in stations B and C, with the overage the stations are loaded with
+        bead_vol = beads_volume * 8 * math.ceil(num_samples/8) * (1 + overage['beads'])
+        isoprop_vol = isoprop_volume * 8 * math.ceil(num_samples/8) * (1 + overage['beads'])
+        num_wells = math.ceil(num_samples / 32) #Number of wells needed
         total_bead = bead_vol + isoprop_vol
 
-        mmix_vol = (num_samples * 1.1 * mmix_volume)
+        mmix_vol = num_samples * mmix_volume * (1 + overage['mmix'])
         num_wells_mmix = math.ceil(mmix_vol/2000) # Number of wells needed
-        mmix_vol = mmix_vol + (security_volume_mmix) * num_wells_mmix # Add security volume in each well
         reac1_vol = mmix_vol / 20 * 6.25
         reac2_vol = mmix_vol / 20 * 1.25
         nfree_vol = mmix_vol / 20 * 12.5
@@ -1,10 +1,70 @@
 #How to activate simulator
 #opentrons_simulate /Users/covid19warriors/Documents/covid19clinic/Station\ B/Station_B_S2_Aitor_JL_v1.py -L /Users/covid19warriors/Desktop/labware2
 
+class ReservoirState:
+    '''
+    Live volume of every well of a reagent, used by calc_height to choose the well.
+    policy: how the well for the next aspiration is chosen
+        'fewest_switches': stay in the current well while it can serve the volume,
+                 then move to the fullest well, the one that lasts the longest
+        'drain': stay in the current well while it can serve the volume, then move
+                 to the emptiest well that can, to use the leftovers first
+        'fullest': always the well with the highest volume
+        'round_robin': the next well (in order) that can serve the volume
+    '''
+    __slots__ = ['volumes', 'policy', 'current', 'switches', 'used']
+
+    def __init__(self, num_wells, volume_per_well, policy = 'fewest_switches'):
+        self.volumes = np.full(num_wells, float(volume_per_well))
+        self.policy = policy
+        self.current = 0
+        self.switches = 0
+        self.used = np.zeros(num_wells, dtype = bool)
+
+    def select(self, aspirate_volume):
+        '''
+        Index of the well for [aspirate_volume]. If no well has enough volume left
+        the fullest one is returned.
+        '''
+        candidates = np.flatnonzero(self.volumes >= aspirate_volume)
+        if len(candidates) == 0:
+            well = int(np.argmax(self.volumes))
+        elif self.policy == 'fullest':
+            well = int(np.argmax(self.volumes))
+        elif self.policy == 'round_robin':
+            after = candidates[candidates > self.current]
+            well = int(after[0]) if len(after) > 0 else int(candidates[0])
+        elif self.volumes[self.current] >= aspirate_volume:
+            well = self.current
+        elif self.policy == 'drain':
+            well = int(candidates[np.argmin(self.volumes[candidates])])
+        else:
+            well = int(np.argmax(self.volumes))
+        if well != self.current:
+            self.switches += 1
+            self.current = well
+        return well
+
+    def aspirate(self, well, volume):
+        '''
+        Remove [volume] from [well] and return the volume left in it
+        '''
+        self.volumes[well] -= volume
+        self.used[well] = True
+        return float(self.volumes[well])
+
+    def stranded(self):
+        '''
+        Volumes left in the wells that were aspirated from and then left. A well
+        the policy comes back to is not stranded any more.
+        '''
+        return [float(v) for i, v in enumerate(self.volumes)
+                if self.used[i] and i != self.current]
+
 class Reagent:
     def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
                  reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                  tip_recycling = 'none'):
+                  tip_recycling = 'none', policy = 'fewest_switches'):
         self.name = name
         self.flow_rate_aspirate = flow_rate_aspirate
         self.flow_rate_dispense = flow_rate_dispense
@@ -19,6 +79,7 @@ class Reagent:
         self.unused=[]
         self.tip_recycling = tip_recycling
         self.vol_well_original = reagent_reservoir_volume / num_wells
+        self.wells = ReservoirState(num_wells, self.vol_well_original, policy)
 
 
 #Reagents and their characteristics
@@ -86,6 +147,10 @@ water = reagent_res.rows()[0][-1] # 1 row, 1 column (last one) full of water
 work_destinations = deepwell_plate.rows()[0][:Elution.num_wells]
 final_destinations = elution_plate.rows()[0][:Elution.num_wells]
 
+# Volume to height tables used by calc_height
+Beads.level = LiquidLevel(reagent_res, shape = 'prism', h_bottom = Beads.h_cono)
+Elution.level = LiquidLevel(elution_plate, shape = 'sphere', h_bottom = Elution.h_cono)
+
 tip_recycle = [ctx.load_labware('opentrons_96_tiprack_300ul', '5', '200µl filter tiprack')]
 
 pipette.pick_up_tip(tip_recycle[reagent.tip_recycling])
@@ -145,60 +210,193 @@ x_offset, source_height = 3):
     if blow_out == True:
         pipet.blow_out(location.top(z=-2))  # Blow out
 
-def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.5):
+class LiquidLevel:
+    '''
+    Volume to height lookup table for the wells of a labware.
+    The table is built once from the labware definition and each query is an O(1)
+    interpolation, so all the stations share the same height formula.
+    shape: bottom of the well. 'flat', 'cone', 'sphere', 'prism' (triangular trough,
+    as in 12 well reservoirs) or 'v' (square pyramid, as in KingFisher deepwells).
+    If None, it is read from wellBottomShape in the labware definition.
+    h_bottom: height of the bottom shape in mm (radius of the well for 'sphere' if None)
+    resolution: number of points of the lookup table
+    '''
+    def __init__(self, labware, shape = None, h_bottom = None, resolution = 1000):
+        definition = get_labware_definition(labware.load_name)
+        well = definition['wells'][definition['ordering'][0][0]]
+        if well['shape'] == 'circular':
+            self.area = math.pi * well['diameter']**2 / 4
+            radius = well['diameter'] / 2
+        else:
+            self.area = well['xDimension'] * well['yDimension']
+            radius = min(well['xDimension'], well['yDimension']) / 2
+        if shape == None:
+            bottom = definition['groups'][0]['metadata'].get('wellBottomShape', 'flat')
+            if bottom == 'u':
+                shape = 'sphere'
+            elif bottom == 'v':
+                shape = 'cone' if well['shape'] == 'circular' else 'v'
+            else:
+                shape = 'flat'
+        if h_bottom == None:
+            h_bottom = radius if shape == 'sphere' else 0
+        if shape == 'flat' or h_bottom <= 0:
+            shape, h_bottom = 'flat', 0
+        self.shape = shape
+        self.h_bottom = min(h_bottom, well['depth'])
+        self.depth = well['depth']
+        self.max_volume = self.volume(self.depth)
+        # Heights sampled on an evenly spaced volume axis, so a query is an index lookup
+        heights = np.linspace(0, self.depth, resolution * 4)
+        volumes = np.array([self.volume(h) for h in heights])
+        self.step = self.max_volume / (resolution - 1)
+        self.table = np.interp(np.arange(resolution) * self.step, volumes, heights)
+
+    def volume(self, height):
+        '''
+        Volume in µl contained in a well filled up to [height] mm from its bottom
+        '''
+        hb = self.h_bottom
+        h = min(height, hb)
+        if self.shape == 'flat':
+            v = 0
+        elif self.shape in ['cone', 'v']:  # area grows with the square of the height
+            v = self.area * h**3 / (3 * hb**2)
+        elif self.shape == 'prism':  # area grows linearly with the height
+            v = self.area * h**2 / (2 * hb)
+        else:  # sphere cap with a base of [area] at [h_bottom]
+            r_sphere = (self.area / math.pi + hb**2) / (2 * hb)
+            v = math.pi * h**2 * (3 * r_sphere - h) / 3
+        return v + self.area * max(height - hb, 0)
+
+    def height(self, volume):
+        '''
+        Height in mm from the bottom of the well of the surface of [volume] µl
+        '''
+        if volume <= 0:
+            return 0
+        if volume >= self.max_volume:
+            return self.depth
+        position = volume / self.step
+        i = int(position)
+        return float(self.table[i] + (self.table[i + 1] - self.table[i]) * (position - i))
+
+def calc_height(reagent, aspirate_volume, min_height = 0.5, immersion = 1):
+    '''
+    Aspiration height for [aspirate_volume] of [reagent].
+    The well is chosen by reagent.wells (ReservoirState) and the height is taken
+    from the reagent.level table (LiquidLevel), [immersion] mm below the surface
+    that will remain after aspirating.
+    '''
     nonlocal ctx
     ctx.comment('Remaining volume ' + str(reagent.vol_well) +
                 '< needed volume ' + str(aspirate_volume) + '?')
-    if reagent.vol_well < aspirate_volume:
-        reagent.unused.append(reagent.vol_well)
+    well = reagent.wells.select(aspirate_volume)
+    if well != reagent.col:
+        reagent.unused = reagent.wells.stranded()
         ctx.comment('Next column should be picked')
+        ctx.comment('Stranded volume of ' + reagent.name + ': ' + str(sum(reagent.unused)))
         ctx.comment('Previous to change: ' + str(reagent.col))
-        # column selector position; intialize to required number
-        reagent.col = reagent.col + 1
+        # column selector position; chosen by the reservoir policy
+        reagent.col = well
         ctx.comment(str('After change: ' + str(reagent.col)))
-        reagent.vol_well = reagent.vol_well_original
-        ctx.comment('New volume:' + str(reagent.vol_well))
-        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                #- reagent.h_cono
-        reagent.vol_well = reagent.vol_well - aspirate_volume
-        ctx.comment('Remaining volume:' + str(reagent.vol_well))
-        if height < min_height:
-            height = min_height
         col_change = True
     else:
-        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-        reagent.vol_well = reagent.vol_well - aspirate_volume
-        ctx.comment('Calculated height is ' + str(height))
-        if height < min_height:
-            height = min_height
-        ctx.comment('Used height is ' + str(height))
         col_change = False
+    if reagent.wells.volumes[well] < aspirate_volume:
+        ctx.comment('Not enough volume of ' + reagent.name + ' left in any well')
+    reagent.vol_well = reagent.wells.aspirate(well, aspirate_volume)
+    ctx.comment('Remaining volume:' + str(reagent.vol_well))
+    height = reagent.level.height(reagent.vol_well) - immersion
+    ctx.comment('Calculated height is ' + str(height))
+    if height < min_height:
+        height = min_height
+    ctx.comment('Used height is ' + str(height))
     return height, col_change
 
-def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
-    # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
-    pipette.aspirate((len(dest) * volume) +
-                     extra_dispensal, src.bottom(pickup_height))
-    pipette.touch_tip(speed=20, v_offset=-5)
-    pipette.move_to(src.top(z=5))
-    pipette.aspirate(5)  # air gap
-    for d in dest:
-        pipette.dispense(5, d.top())
+def divide_destinations(l, n):
+    # Divide the list of destinations in size n lists.
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+def plan_multi_dispense(dests, volume, max_vol, tip_capacity = None,
+                        conditioning_vol = 0, disposal_vol = 0, air_gap_vol = 0):
+    '''
+    Divide [dests] in the minimum number of balanced groups that can be served with
+    a single aspiration each, given the pipette [max_vol] and the [tip_capacity].
+    The conditioning volume and the air gap are never in the tip at the same time.
+    '''
+    if tip_capacity == None:
+        tip_capacity = max_vol
+    free_vol = (min(max_vol, tip_capacity) - disposal_vol -
+                max(conditioning_vol, air_gap_vol))
+    per_trip = max(int(free_vol // volume), 1)
+    num_trips = math.ceil(len(dests) / per_trip)
+    return list(divide_destinations(dests, math.ceil(len(dests) / num_trips)))
+
+def distribute_custom(pipette, reagent, volume, src, dest, waste_pool, pickup_height,
+                      conditioning_vol = 0, disposal_vol = 0, air_gap_vol = 0,
+                      disp_height = 0, touch_tip = True, blow_out = True):
+    '''
+    Multi-dispense [volume] to every well (or column, with a multichannel) of [dest]
+    from a single aspiration in [src].
+    conditioning_vol: aspirated in excess and dispensed back to [src] before the
+    first dispense, so all the dispenses start with the plunger going down
+    disposal_vol: kept in the tip after the last dispense and blown out in [waste_pool]
+    air_gap_vol: air gap taken before moving to each destination (0 for none)
+    blow_out: if False, the disposal volume stays in the tip (with no air gap after
+    the last dispense) to be used in the next aspiration of the same reagent
+    Returns the volume dispensed per channel.
+    '''
+    pipette.aspirate(len(dest) * volume + conditioning_vol + disposal_vol,
+                     src.bottom(pickup_height), rate = reagent.flow_rate_aspirate)
+    if conditioning_vol > 0:
+        pipette.dispense(conditioning_vol, src.bottom(pickup_height),
+                         rate = reagent.flow_rate_dispense)
+    if touch_tip == True:
+        pipette.touch_tip(speed=20, v_offset=-5)
+    if air_gap_vol > 0:
+        pipette.move_to(src.top(z=5))
+        pipette.aspirate(air_gap_vol)  # air gap
+    for i, d in enumerate(dest):
+        if air_gap_vol > 0:
+            pipette.dispense(air_gap_vol, d.top())
         drop = d.top(z = disp_height)
-        pipette.dispense(volume, drop)
-        pipette.move_to(d.top(z=5))
-        pipette.aspirate(5)  # air gap
+        pipette.dispense(volume, drop, rate = reagent.flow_rate_dispense)
+        if air_gap_vol > 0 and (blow_out == True or i < len(dest) - 1):
+            pipette.move_to(d.top(z=5))
+            pipette.aspirate(air_gap_vol)  # air gap
+    if blow_out == False:
+        return (len(dest) * volume)
     try:
         pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
     except:
         pipette.blow_out(waste_pool.bottom(pickup_height + 3))
     return (len(dest) * volume)
 
-def divide_volume(volume,max_vol):
-    num_transfers=math.ceil(volume/max_vol)
-    vol_roundup=math.ceil(volume/num_transfers)
-    last_vol=volume-vol_roundup*(num_transfers-1)
-    vol_list=[vol_roundup for v in range(1,num_transfers)]
+def divide_volume(volume, max_vol, air_gap_vol = 0, tip_capacity = None,
+                  disposal_vol = 0):
+    '''
+    Split [volume] in the minimum number of transfers (trips) of similar volume.
+    max_vol: maximum volume of the pipette
+    air_gap_vol, disposal_vol: volume taken in each trip that is not dispensed
+    tip_capacity: volume of the tips; the trip is limited by the smallest of both
+    '''
+    if tip_capacity == None:
+        tip_capacity = max_vol
+    trip_vol = min(max_vol, tip_capacity) - air_gap_vol - disposal_vol
+    if trip_vol < 1:
+        # The trips are rounded up to whole µl, so none would fit
+        raise ValueError('A trip of ' + str(min(max_vol, tip_capacity)) +
+                         ' µl has no room left for liquid after ' +
+                         str(air_gap_vol) + ' µl of air gap and ' +
+                         str(disposal_vol) + ' µl of disposal volume')
+    num_transfers = math.ceil(volume / trip_vol)
+    while math.ceil(volume / num_transfers) > trip_vol:
+        num_transfers += 1
+    vol_roundup = math.ceil(volume / num_transfers)
+    last_vol = volume - vol_roundup * (num_transfers - 1)
+    vol_list = [vol_roundup for v in range(1, num_transfers)]
     vol_list.append(last_vol)
     return vol_list
 
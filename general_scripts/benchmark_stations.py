@@ -0,0 +1,96 @@
+import sys
+import os
+import json
+import argparse
+from sweep_stations import sweep, station_files
+
+# Regression benchmark of the stations.
+# Every station is simulated at representative sample counts and its efficiency
+# metrics are compared with the stored baseline. The script exits with an error
+# when a metric is worse than the baseline by more than the tolerance, or when a
+# station fails. Failed runs are not stored in the baseline.
+#
+# Usage: python benchmark_stations.py [--update] [-t 0.02] [-m duration_s=0.05]
+
+SAMPLES = [8, 48, 95]
+# Metrics compared, lower is better for all of them
+METRICS = ['commands', 'duration_s', 'tips', 'dead_volume_ul', 'travel_m']
+TOLERANCE = 0.02  # relative
+
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+
+
+def run_benchmark(files = None, samples = SAMPLES):
+    '''
+    {station: {num_samples: {status, metric: value}}} for [files] and [samples]
+    '''
+    results = {}
+    for row in sweep(files or station_files(), samples):
+        metrics = {'status': row['status']}
+        metrics.update({m: row[m] for m in METRICS if m in row})
+        results.setdefault(row['station'], {})[str(row['num_samples'])] = metrics
+    return results
+
+
+def compare(results, baseline, tolerance = TOLERANCE, metric_tolerance = {}):
+    '''
+    List of regressions of [results] against [baseline], as text lines.
+    A station that fails is a regression too.
+    '''
+    regressions = []
+    for station, runs in sorted(results.items()):
+        for n, metrics in runs.items():
+            base = baseline.get(station, {}).get(n)
+            name = station + ' (' + n + ' samples)'
+            if metrics['status'] != 'ok':
+                regressions.append(name + ': ' + metrics['status'])
+                continue
+            if base == None:
+                continue
+            for m in METRICS:
+                if base.get(m) == None:
+                    continue
+                limit = base[m] * (1 + metric_tolerance.get(m, tolerance))
+                if metrics[m] > limit + 1e-9:
+                    regressions.append(name + ': ' + m + ' ' + str(base[m]) + ' -> ' +
+                                       str(metrics[m]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Station efficiency benchmark')
+    parser.add_argument('stations', nargs = '*', help = 'station files (default: all)')
+    parser.add_argument('--update', action = 'store_true',
+                        help = 'store the results as the new baseline')
+    parser.add_argument('-t', '--tolerance', type = float, default = TOLERANCE)
+    parser.add_argument('-m', '--metric-tolerance', action = 'append', default = [],
+                        help = 'tolerance of one metric, i.e. duration_s=0.05')
+    args = parser.parse_args()
+    results = run_benchmark(args.stations)
+    if args.update:
+        baseline = {}
+        if os.path.isfile(baseline_file):
+            with open(baseline_file) as f:
+                baseline = json.load(f)
+        for station, runs in results.items():
+            for n, metrics in runs.items():
+                # A failed run is never the baseline: the last good run, if any, is kept
+                if metrics['status'] != 'ok':
+                    print('Warning: not stored, ' + station + ' (' + n + ' samples): ' +
+                          metrics['status'], file = sys.stderr)
+                    continue
+                baseline.setdefault(station, {})[n] = metrics
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent = 1, sort_keys = True)
+        print('Baseline updated: ' + baseline_file)
+        sys.exit(0)
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    metric_tolerance = {m.split('=')[0]: float(m.split('=')[1])
+                        for m in args.metric_tolerance}
+    regressions = compare(results, baseline, args.tolerance, metric_tolerance)
+    for r in regressions:
+        print('REGRESSION ' + r)
+    print(str(len(regressions)) + ' regressions in ' + str(len(results)) + ' stations')
+    sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,86 @@
+import os
+import sys
+import ast
+import difflib
+import inspect
+import textwrap
+import collections
+from mock_opentrons import repo_path
+from sweep_stations import station_files
+
+# Check of the helpers that are copied in the stations.
+# The stations cannot import a shared module on the robot, so the same helpers are
+# pasted in every station (automation/*_config/ and Kingfisher_protocols/), in
+# template/code_template.py and in functions/functions.py. Every copy of a helper is
+# compared by its syntax tree (comments, blank lines and the indentation of the
+# docstrings do not count) with the version most of the copies have, and the script
+# exits with an error when a copy drifts. A change in a helper has to be made in all
+# of its copies.
+#
+# Usage: python check_shared_helpers.py [file.py ...]
+
+# Functions and classes that must be the same in every file that has them
+SHARED_HELPERS = ['ReservoirState', 'LiquidLevel', 'divide_volume', 'tip_rule',
+                  'tip_schedule', 'footprint', 'low_arc_move', 'drop', 'log_command']
+OTHER_FILES = ['template/code_template.py', 'functions/functions.py']
+
+
+def helper_files():
+    return station_files() + [os.path.join(repo_path, f) for f in OTHER_FILES]
+
+
+def helpers(path):
+    '''
+    {name: [normalized tree, source]} of the SHARED_HELPERS defined in [path]
+    '''
+    with open(path) as f:
+        source = f.read().replace('$', '_')  # placeholders of the automation templates
+    found = {}
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in SHARED_HELPERS:
+            code = textwrap.dedent(' ' * node.col_offset +
+                                   ast.get_source_segment(source, node))
+            for n in ast.walk(node):
+                if isinstance(n, (ast.FunctionDef, ast.ClassDef)) and len(n.body) > 0 and \
+                        isinstance(n.body[0], ast.Expr) and \
+                        isinstance(n.body[0].value, ast.Constant) and \
+                        isinstance(n.body[0].value.value, str):
+                    n.body[0].value.value = inspect.cleandoc(n.body[0].value.value)
+            found[node.name] = [ast.dump(node), code]
+    return found
+
+
+def check(files):
+    '''
+    Drift of the copies of the SHARED_HELPERS in [files], as text lines
+    '''
+    copies = collections.defaultdict(dict)
+    for f in files:
+        for name, copy in helpers(f).items():
+            copies[name][f] = copy
+    problems = []
+    for name in SHARED_HELPERS:
+        variants = collections.Counter([tree for tree, code in copies[name].values()])
+        if len(variants) < 2:
+            continue
+        reference = variants.most_common(1)[0][0]
+        reference_file = [f for f, c in copies[name].items() if c[0] == reference][0]
+        for f, (tree, code) in sorted(copies[name].items()):
+            if tree != reference:
+                problems.append(name + ' in ' + os.path.relpath(f, repo_path) +
+                                ' differs from ' + os.path.relpath(reference_file, repo_path) +
+                                ' and ' + str(variants[reference] - 1) + ' more copies:')
+                problems += ['    ' + line for line in difflib.unified_diff(
+                    copies[name][reference_file][1].splitlines(), code.splitlines(),
+                    lineterm = '', n = 1)][2:]
+    return problems, copies
+
+
+if __name__ == '__main__':
+    files = sys.argv[1:] or helper_files()
+    problems, copies = check(files)
+    for line in problems:
+        print(line)
+    for name in SHARED_HELPERS:
+        print(name + ': ' + str(len(copies[name])) + ' copies')
+    sys.exit(1 if len(problems) > 0 else 0)
@@ -0,0 +1,86 @@
+import os
+import re
+import sys
+import ast
+import math
+import types
+from sweep_stations import station_files
+
+# Check of the trip plans of the plate filling stations.
+# divide_volume is taken out of every station that has it, and is called with the
+# arguments of the station's own calls (pipette max volume, air gap, tip capacity...).
+# A plan fails when it takes more trips than the lists the stations had hard-coded
+# before divide_volume planned them.
+#
+# Usage: python check_trip_plans.py [Station_file.py ...]
+
+# Volume lists of the stations before divide_volume, per station and volume in µl
+BASELINE_PLANS = {
+    'Station_KB_PlateFilling_pathogen': {300: [150, 150], 450: [150, 150, 150]},
+    'Station_KB_PlateFilling_viral_path2': {1000: [170, 170, 170, 170, 170, 150]}
+}
+
+
+def station_name(path):
+    return re.sub(r'_(v\d+|tec)$', '', os.path.splitext(os.path.basename(path))[0])
+
+
+def trip_plans(path):
+    '''
+    [volume, plan] of every divide_volume call of the station in [path]
+    '''
+    with open(path) as f:
+        tree = ast.parse(f.read().replace('$', '_'))
+    namespace = {'math': math}
+    calls = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name == 'divide_volume':
+            exec(compile(ast.Module([node], []), path, 'exec'), namespace)
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                isinstance(node.targets[0], ast.Name):
+            value = node.value
+            if isinstance(value, ast.Constant) and isinstance(value.value, (int, float)):
+                namespace[node.targets[0].id] = value.value
+            elif isinstance(value, ast.Call) and getattr(value.func, 'attr', '') == \
+                    'load_instrument':
+                # Max volume from the pipette name, as p300_multi_gen2
+                name = value.args[0].value
+                namespace[node.targets[0].id] = types.SimpleNamespace(
+                    max_volume = int(re.match(r'p(\d+)', name).group(1)))
+        elif isinstance(node, ast.Call) and getattr(node.func, 'id', '') == 'divide_volume':
+            calls.append(node)
+    plans = []
+    for call in calls:
+        args = [eval(compile(ast.Expression(a), path, 'eval'), namespace) for a in call.args]
+        kwargs = {k.arg: eval(compile(ast.Expression(k.value), path, 'eval'), namespace)
+                  for k in call.keywords}
+        plans.append([args[0], namespace['divide_volume'](*args, **kwargs)])
+    return plans
+
+
+def check_station(path):
+    '''
+    Problems of the trip plans of the station in [path], compared with BASELINE_PLANS
+    '''
+    baseline = BASELINE_PLANS.get(station_name(path), {})
+    problems = []
+    for volume, plan in trip_plans(path):
+        if sum(plan) != volume:
+            problems.append(str(volume) + ' µl planned as ' + str(plan))
+        elif volume in baseline and len(plan) > len(baseline[volume]):
+            problems.append(str(volume) + ' µl planned as ' + str(plan) + ', ' +
+                            str(len(plan)) + ' trips instead of ' +
+                            str(len(baseline[volume])) + ' ' + str(baseline[volume]))
+    return problems
+
+
+if __name__ == '__main__':
+    files = sys.argv[1:] or [f for f in station_files() if 'PlateFilling' in f]
+    failed = 0
+    for f in files:
+        plans = trip_plans(f)
+        problems = check_station(f)
+        failed += len(problems) > 0
+        print(os.path.basename(f) + ': ' + ('; '.join(problems) if problems else 'OK ' +
+              ', '.join([str(v) + ' µl in ' + str(len(p)) for v, p in plans])))
+    sys.exit(1 if failed > 0 else 0)
@@ -0,0 +1,190 @@
+import sys
+import os
+import re
+import json
+import hashlib
+import difflib
+import argparse
+from mock_opentrons import run_station, repo_path, Well
+from sweep_stations import station_files
+
+# Golden command stream snapshots of the stations.
+# The command stream of a protocol (mock_opentrons) is normalized to one text line
+# per command, stored as a diffable text file plus a short hash in snapshots/, and
+# the copies of the same station in Kingfisher_protocols/ and automation/*_config/
+# are compared command by command. A station that fails is not stored as a snapshot
+# and fails the check.
+#
+# Usage: python command_snapshots.py [--update | --check] [-n 48]
+# Without options the pairs of copies of every station are compared.
+
+NUM_SAMPLES = 48
+# Commands that do not move the robot or change the liquids
+IGNORED = ['comment', 'sleep', 'set_rail_lights', 'set_button_light']
+
+snapshot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots')
+
+
+def format_value(value):
+    if hasattr(value, 'point'):
+        well = value.labware
+        if isinstance(well, Well):
+            offset = value.point - well.bottom().point
+            return (well.parent.load_name + '@' + well.parent.slot + ':' +
+                    well.display_name + '+(' +
+                    ','.join([str(round(v, 2)) for v in offset]) + ')')
+        return str(value)
+    if isinstance(value, float):
+        return str(round(value, 2))
+    return str(value)
+
+
+def normalize(ctx):
+    '''
+    Commands recorded in [ctx] as lines of 'target command field=value ...', with the
+    locations given as labware@slot:well+(offset from the bottom of the well)
+    '''
+    lines = []
+    for c in ctx.recorded_commands:
+        if c.name in IGNORED:
+            continue
+        target = getattr(c.target, 'name', None) or str(c.target)
+        fields = [format_value(a) for a in c.args]
+        fields += [k + '=' + format_value(v) for k, v in c.kwargs.items()
+                   if v != None and k != 'msg']
+        lines.append(' '.join([target, c.name] + fields))
+    return lines
+
+
+def stream_hash(lines):
+    return hashlib.sha1('\n'.join(lines).encode()).hexdigest()[:12]
+
+
+def snapshot_name(station, num_samples):
+    return os.path.splitext(os.path.basename(station))[0] + '_' + \
+        os.path.basename(os.path.dirname(station)) + '_' + str(num_samples) + '.txt'
+
+
+def record(station, num_samples):
+    '''
+    Normalized lines of [station] or the error that stopped it
+    '''
+    try:
+        return normalize(run_station(station, num_samples))
+    except Exception as e:
+        return ['ERROR ' + type(e).__name__ + ': ' + str(e).splitlines()[0]]
+
+
+def semantic_diff(a, b):
+    '''
+    Differences between two normalized streams [a] and [b]. Commands are aligned by
+    target and name, and the changes of the arguments of the aligned commands are
+    counted, so a value changed everywhere and a command added or removed everywhere
+    are reported once.
+    '''
+    skeleton_a = [' '.join(l.split(' ')[:2]) for l in a]
+    skeleton_b = [' '.join(l.split(' ')[:2]) for l in b]
+    changes = {}
+    removed = {}
+    added = {}
+    report = []
+    matcher = difflib.SequenceMatcher(None, skeleton_a, skeleton_b, autojunk = False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            for la, lb in zip(a[i1:i2], b[j1:j2]):
+                if la == lb:
+                    continue
+                fa, fb = la.split(' '), lb.split(' ')
+                for x, y in zip(fa[2:], fb[2:]):
+                    if x != y:
+                        # The same offset changed in every well is counted as one change
+                        well = re.compile(r':[A-P]\d+\+')
+                        if well.findall(x) == well.findall(y):
+                            x, y = well.sub(':*+', x), well.sub(':*+', y)
+                        key = (' '.join(fa[:2]), x, y)
+                        changes[key] = changes.get(key, 0) + 1
+        else:
+            for name in skeleton_a[i1:i2]:
+                removed[name] = removed.get(name, 0) + 1
+            for name in skeleton_b[j1:j2]:
+                added[name] = added.get(name, 0) + 1
+    # Commands added or removed in several places are counted together
+    for sign, counts in [('- ', removed), ('+ ', added)]:
+        for name in sorted(counts):
+            report.append(sign + str(counts[name]) + ' x ' + name)
+    for (command, x, y), count in sorted(changes.items(), key = lambda i: -i[1]):
+        report.append('~ ' + str(count) + ' x ' + command + ': ' + x + ' -> ' + y)
+    return report
+
+
+def station_pairs(files):
+    '''
+    Copies of the same station: Station_X_v1/_v2 in Kingfisher_protocols and
+    Station_X_tec in automation
+    '''
+    stations = {}
+    for f in files:
+        key = re.sub(r'_(v\d+|tec)$', '', os.path.splitext(os.path.basename(f))[0])
+        stations.setdefault(key, []).append(f)
+    return [sorted(v, key = lambda f: 'automation' in f) for v in stations.values()
+            if len(v) == 2]
+
+
+def load_index():
+    index_file = os.path.join(snapshot_path, 'index.json')
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            return json.load(f)
+    return {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Command stream snapshots')
+    parser.add_argument('--update', action = 'store_true', help = 'store the snapshots')
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'compare the stations with the stored snapshots')
+    parser.add_argument('-n', '--num-samples', type = int, default = NUM_SAMPLES)
+    args = parser.parse_args()
+    files = station_files()
+    streams = {f: record(f, args.num_samples) for f in files}
+    if args.update:
+        os.makedirs(snapshot_path, exist_ok = True)
+        index = load_index()
+        stored = 0
+        for f, lines in streams.items():
+            name = snapshot_name(os.path.relpath(f, repo_path), args.num_samples)
+            # A crash is never the golden stream: the last good snapshot, if any, is kept
+            if lines[0].startswith('ERROR '):
+                print('Warning: not stored, ' + os.path.relpath(f, repo_path) + ': ' +
+                      lines[0], file = sys.stderr)
+                continue
+            stored += 1
+            with open(os.path.join(snapshot_path, name), 'w') as s:
+                s.write('\n'.join(lines) + '\n')
+            index[name] = stream_hash(lines)
+        with open(os.path.join(snapshot_path, 'index.json'), 'w') as s:
+            json.dump(index, s, indent = 1, sort_keys = True)
+        print('Stored ' + str(stored) + ' snapshots in ' + snapshot_path)
+    elif args.check:
+        index = load_index()
+        changed = 0
+        for f, lines in streams.items():
+            name = snapshot_name(os.path.relpath(f, repo_path), args.num_samples)
+            if lines[0].startswith('ERROR ') and index.get(name) == None:
+                changed += 1
+                print(os.path.relpath(f, repo_path) + ' failed: ' + lines[0])
+            elif index.get(name) not in [None, stream_hash(lines)]:
+                changed += 1
+                print(os.path.relpath(f, repo_path) + ' changed:')
+                with open(os.path.join(snapshot_path, name)) as s:
+                    golden = s.read().splitlines()
+                for line in semantic_diff(golden, lines):
+                    print('    ' + line)
+        sys.exit(1 if changed > 0 else 0)
+    else:
+        for a, b in station_pairs(files):
+            report = semantic_diff(streams[a], streams[b])
+            print(os.path.relpath(a, repo_path) + ' vs ' + os.path.relpath(b, repo_path) +
+                  ': ' + (stream_hash(streams[a]) + ' ' + stream_hash(streams[b])))
+            for line in report or ['identical']:
+                print('    ' + line)
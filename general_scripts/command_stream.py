@@ -0,0 +1,203 @@
+import os
+import re
+import sys
+import copy
+import importlib.util
+
+# Command stream of the station protocols.
+# Command is the primitive command that mock_opentrons records for every pipette and
+# ProtocolContext call, and load_station imports a station file with the placeholders
+# of the automation templates replaced, for the simulation tools in this folder.
+#
+# The peephole passes find the commands of a recorded stream that can be left out
+# without changing what the robot does: the same moves, volumes and plunger positions.
+# They are measured with run_time_estimator, so the redundant calls can be removed
+# from the stations where they pay off. The stream is not sent to the robot: a
+# recording misses the calls that do not go through the API (gpio, time.sleep).
+#
+# Usage: python command_stream.py Station_file.py [num_samples]
+
+
+class Command:
+    '''
+    One primitive command of the stream.
+    target: object that executes it (a pipette or the ProtocolContext)
+    name: name of the method, args and kwargs: its arguments
+    '''
+    __slots__ = ['target', 'name', 'args', 'kwargs']
+
+    def __init__(self, target, name, args = (), kwargs = None):
+        self.target = target
+        self.name = name
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+
+    def location(self):
+        '''
+        Location argument of the command, None if it has none
+        '''
+        if 'location' in self.kwargs:
+            return self.kwargs['location']
+        for a in self.args:
+            if hasattr(a, 'point'):
+                return a
+        return None
+
+    def __repr__(self):
+        args = [repr(a) for a in self.args]
+        args += [k + '=' + repr(v) for k, v in self.kwargs.items()]
+        return self.name + '(' + ', '.join(args) + ')'
+
+
+################################################################################
+# Peephole passes: each one takes a list of commands and returns a new one
+def same_location(a, b):
+    return a != None and b != None and a.labware is b.labware and \
+        tuple(a.point) == tuple(b.point)
+
+
+def drop_redundant_moves(commands):
+    '''
+    A move_to with nothing but its location is dropped when the next command is of
+    the same pipette and in the same location: that command moves there by the same
+    path, and then does not move at all.
+    '''
+    out = []
+    for i, c in enumerate(commands):
+        if c.name == 'move_to' and i + 1 < len(commands) and \
+                not any([v for k, v in c.kwargs.items() if k != 'location']):
+            following = commands[i + 1]
+            if following.target is c.target and \
+                    same_location(following.location(), c.location()):
+                continue
+        out.append(c)
+    return out
+
+
+def drop_noop_delays(commands):
+    '''
+    Delays of 0 seconds are dropped and consecutive delays are merged in one.
+    '''
+    out = []
+    for c in commands:
+        seconds = c.kwargs.get('seconds', 0) + 60 * c.kwargs.get('minutes', 0)
+        if c.name != 'delay':
+            out.append(c)
+        elif seconds > 0:
+            if len(out) > 0 and out[-1].name == 'delay':
+                seconds += out[-1].kwargs['seconds']
+                out.pop()
+            out.append(Command(c.target, 'delay', kwargs = {'seconds': seconds}))
+    return out
+
+
+def drop_repeated_blow_outs(commands):
+    '''
+    A blow out right after another blow out of the same pipette, in the same place,
+    is dropped: the tip is already empty and the plunger in the blow out position.
+    '''
+    out = []
+    for c in commands:
+        prev = out[-1] if len(out) > 0 else None
+        if c.name == 'blow_out' and prev != None and prev.name == 'blow_out' and \
+                prev.target is c.target and (c.location() == None or
+                                             same_location(c.location(), prev.location())):
+            continue
+        out.append(c)
+    return out
+
+
+def drop_repeated_homes(commands):
+    '''
+    A home_plunger right after a home of the same pipette's plunger (a home_plunger
+    or a tip drop with home_after) is dropped.
+    '''
+    out = []
+    for c in commands:
+        prev = out[-1] if len(out) > 0 else None
+        if c.name == 'home_plunger' and prev != None and prev.target is c.target and \
+                (prev.name == 'home_plunger' or prev.kwargs.get('home_after') == True):
+            continue
+        out.append(c)
+    return out
+
+
+DEFAULT_PASSES = [drop_redundant_moves, drop_noop_delays, drop_repeated_blow_outs,
+                  drop_repeated_homes]
+
+
+def optimize(ctx, passes = DEFAULT_PASSES, model = None):
+    '''
+    Run [passes] in order over the commands recorded in [ctx] (mock_opentrons).
+    Returns the optimized commands and a report with, for every pass, its name, the
+    commands it dropped and the seconds saved by run_time_estimator.
+    '''
+    # Imported here, as run_time_estimator imports this module through mock_opentrons
+    from run_time_estimator import estimate
+    replay = copy.copy(ctx)
+    commands = ctx.recorded_commands
+    seconds = estimate(ctx, model)['total']
+    report = []
+    for p in passes:
+        optimized = p(commands)
+        replay.recorded_commands = optimized
+        optimized_seconds = estimate(replay, model)['total']
+        report.append([p.__name__, len(commands) - len(optimized),
+                       seconds - optimized_seconds])
+        commands, seconds = optimized, optimized_seconds
+    return commands, report
+
+
+_station_code = {}
+# Reagent overages set by rep_data, as the 1.1 factor the stations had before
+OVERAGE = {'mmix': 0.1, 'beads': 0.1}
+
+
+def station_code(path):
+    '''
+    Compiled code of the station in [path], with the placeholders of the automation
+    templates (and the NUM_SAMPLES number of the protocol copies) replaced by the
+    variables set by load_station. Each file is compiled once while it is not modified.
+    '''
+    key = (path, os.path.getmtime(path))
+    if key not in _station_code:
+        with open(path) as f:
+            d = f.read()
+        d = d.replace('$num_samples', '_num_samples')
+        d = re.sub(r'^NUM_SAMPLES = \d+', 'NUM_SAMPLES = _num_samples', d, count = 1,
+                   flags = re.M)
+        for placeholder in ['technician', 'date', 'run_id', 'mmix_overage',
+                            'beads_overage']:
+            d = d.replace('$' + placeholder, '_' + placeholder)
+        _station_code[key] = compile(d, path, 'exec')
+    return _station_code[key]
+
+
+def load_station(path, num_samples = 96, run_id = 'simulation', overage = None):
+    '''
+    Import a station file with its placeholders replaced as rep_data does in
+    input_file_tecnico_macs.py. NUM_SAMPLES is set to [num_samples] also in the
+    protocols where it is a number. [overage] is {reagent: fraction}, OVERAGE by default.
+    '''
+    overage = dict(OVERAGE, **(overage or {}))
+    name = os.path.splitext(os.path.basename(path))[0].replace('-', '_')
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader(name, loader = None))
+    module.__file__ = path
+    module.__dict__.update({'_num_samples': num_samples, '_technician': 'simulation',
+                            '_date': 'simulation', '_run_id': str(run_id),
+                            '_mmix_overage': overage['mmix'],
+                            '_beads_overage': overage['beads']})
+    exec(station_code(path), module.__dict__)
+    return module
+
+
+
+if __name__ == '__main__':
+    from mock_opentrons import run_station
+    ctx = run_station(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 96)
+    commands, report = optimize(ctx)
+    print('Recorded commands: ' + str(len(ctx.recorded_commands)))
+    for name, dropped, saved in report:
+        print(name + ': ' + str(dropped) + ' commands dropped, ' +
+              str(round(saved, 1)) + ' s saved')
@@ -0,0 +1,162 @@
+import os
+import sys
+import argparse
+from mock_opentrons import install, ProtocolContext, Time, Location, Point, slot_origin, \
+    TRASH_SLOT
+from command_stream import load_station
+from run_time_estimator import Gantry, estimate, labware_of, load_model, format_time
+
+# Deck layout optimizer of a station.
+# The station is run once against the mock and the moves of its command stream (the
+# transfer graph between labware) are replayed with the labware of every slot moved to
+# another one: the gantry travel of a layout is the travel of the same moves shifted
+# by the distance between the slots. A local search swaps the contents of two slots
+# while the estimated run time goes down, under the constraints:
+#   - the trash stays in slot 12
+#   - modules only in MODULE_SLOTS
+#   - labware taller than [tall] mm (the plates on modules) not in the front row, where
+#     it hides the deck from the operator
+#   - the slots given with --fix keep their labware
+# The best layout is then simulated again, as the station loads it, to confirm the
+# saving (the stations that plan their moves from the deck, as KA, adapt to it).
+#
+# Usage: python deck_layout.py Station_file.py [-n 96] [--fix 5,8] [--tall 100]
+
+SLOTS = [str(s) for s in range(1, 12)]
+MODULE_SLOTS = ['1', '3', '4', '6', '7', '9', '10']
+FRONT_ROW = ['1', '2', '3']
+TALL = 100  # mm over the deck
+
+
+class LayoutContext(ProtocolContext):
+    '''
+    ProtocolContext that loads the labware and modules of every slot in layout[slot]
+    and records the slots that had a module
+    '''
+    def __init__(self, api_level = '2.0', layout = None):
+        super().__init__(api_level)
+        self.layout = layout or {}
+        self.module_slots = []
+
+    def load_labware(self, load_name, location, label = None):
+        return super().load_labware(load_name, self.layout.get(str(location), str(location)),
+                                    label)
+
+    def load_module(self, module_name, location):
+        self.module_slots.append(str(location))
+        return super().load_module(module_name, self.layout.get(str(location), str(location)))
+
+
+def run_layout(path, num_samples = 96, layout = None):
+    '''
+    LayoutContext of the station in [path] run with the slots of [layout]
+    '''
+    install()
+    station = load_station(path, num_samples)
+    station.time = Time()
+    ctx = LayoutContext(station.metadata.get('apiLevel', '2.0'), layout)
+    try:
+        station.run(ctx)
+    except Exception as e:
+        # Errors of the final reports of some stations, once the liquids are moved
+        if len(ctx.recorded_commands) == 0:
+            raise
+        if layout == None:
+            print('Warning: ' + os.path.basename(path) + ' stopped after ' +
+                  str(len(ctx.recorded_commands)) + ' commands: ' + type(e).__name__ +
+                  ': ' + str(e), file = sys.stderr)
+    return ctx
+
+
+def moves(ctx, model):
+    '''
+    Commands of [ctx] that move the gantry
+    '''
+    return [c for c in ctx.recorded_commands
+            if c.name in model['overhead'] and c.kwargs.get('location') != None]
+
+
+def travel_seconds(ctx, path_moves, model, layout):
+    '''
+    Gantry travel seconds of [path_moves] with the labware of every slot in layout[slot]
+    '''
+    gantry = Gantry(ctx, model)
+    shift = {s: slot_origin(layout[s]) - slot_origin(s) for s in layout}
+    seconds = 0
+    for c in path_moves:
+        location = c.kwargs['location']
+        delta = shift.get(labware_of(location).slot, Point())
+        seconds += gantry.travel(c.target, Location(location.point + delta, location.labware),
+                                 c.kwargs.get('force_direct') == True)
+        if c.name == 'pick_up_tip':
+            gantry.tip(c.target, labware_of(location).tip_length)
+        elif c.name in ['drop_tip', 'return_tip']:
+            gantry.tip(c.target, 0)
+    return seconds * model['travel_factor']
+
+
+def allowed(layout, ctx, tall = TALL, fixed = []):
+    for slot in ctx.module_slots:
+        if layout[slot] not in MODULE_SLOTS:
+            return False
+    for slot, labware in ctx.deck.items():
+        if slot != TRASH_SLOT and getattr(labware, 'highest_z', 0) > tall and \
+                layout[slot] in FRONT_ROW:
+            return False
+    return all([layout[slot] == slot for slot in fixed])
+
+
+def optimize(ctx, model, tall = TALL, fixed = []):
+    '''
+    Layout {slot: new slot} with the lowest travel time found by swapping slots, and
+    the travel seconds of the original and of the proposed layout
+    '''
+    path_moves = moves(ctx, model)
+    layout = {s: s for s in SLOTS}
+    original = best = travel_seconds(ctx, path_moves, model, layout)
+    improved = True
+    while improved:
+        improved = False
+        candidate = None
+        for i, a in enumerate(SLOTS):
+            for b in SLOTS[i + 1:]:
+                if a not in ctx.deck and b not in ctx.deck:
+                    continue
+                swapped = dict(layout)
+                swapped[a], swapped[b] = layout[b], layout[a]
+                if not allowed(swapped, ctx, tall, fixed):
+                    continue
+                seconds = travel_seconds(ctx, path_moves, model, swapped)
+                if seconds < best - 0.01:
+                    best = seconds
+                    candidate = swapped
+        if candidate != None:
+            layout = candidate
+            improved = True
+    return layout, original, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Deck layout optimizer of a station')
+    parser.add_argument('station')
+    parser.add_argument('-n', '--num-samples', type = int, default = 96)
+    parser.add_argument('--fix', default = '', help = 'slots that keep their labware, i.e. 5,8')
+    parser.add_argument('--tall', type = float, default = TALL,
+                        help = 'mm over the deck of the labware kept out of the front row')
+    args = parser.parse_args()
+    model = load_model()
+    ctx = run_layout(args.station, args.num_samples)
+    fixed = [s for s in args.fix.split(',') if s != '']
+    layout, original, best = optimize(ctx, model, args.tall, fixed)
+    before = estimate(ctx, model)['total']
+    if all([layout[s] == s for s in layout]):
+        print('The current layout is the best one found (' + format_time(before) + ')')
+    else:
+        print('slot\tnew slot\tlabware')
+        for slot in SLOTS:
+            if layout[slot] != slot and slot in ctx.deck:
+                print(slot + '\t' + layout[slot] + '\t' + str(ctx.deck[slot]))
+        after = estimate(run_layout(args.station, args.num_samples, layout), model)['total']
+        print('Travel: ' + str(round(original, 1)) + ' s -> ' + str(round(best, 1)) + ' s')
+        print('Run time: ' + format_time(before) + ' -> ' + format_time(after) +
+              ', saves ' + str(round(before - after)) + ' s')
@@ -0,0 +1,156 @@
+import os
+import re
+import glob
+import json
+import argparse
+import numpy as np
+from mock_opentrons import run_station
+from run_time_estimator import MODEL, estimate, model_file
+
+# Fit of the timing model of run_time_estimator from real robot time logs.
+# Every run folder (RUNS/<run_name> as created by input_file_tecnico_macs.py) has the
+# generated station scripts in scripts/ and the *_time_log.txt files of the robots
+# in logs/. Each script is simulated with its own NUM_SAMPLES and the commands of
+# every STEP are counted; the overhead of each command type and the travel factor
+# are then fitted by non negative least squares to the real STEP times, and written
+# to timing_model.json, where run_time_estimator reads them from.
+#
+# Usage: python fit_timing_model.py RUNS/run_1 RUNS/run_2 ... [-o timing_model.json]
+
+# Coefficients that are fitted
+FEATURES = ['aspirate', 'dispense', 'blow_out', 'touch_tip', 'air_gap', 'mix', 'move_to',
+            'pick_up_tip', 'drop_tip', 'home_after', 'home_plunger', 'travel']
+
+
+def log_seconds(text):
+    '''
+    Seconds of a time log value as written by str(timedelta), i.e. 0:05:03.123456
+    '''
+    h, m, s = text.strip().split(':')
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def read_time_log(path):
+    '''
+    {STEP: seconds} of the executed STEPS of a *_time_log.txt file
+    '''
+    times = {}
+    with open(path) as f:
+        next(f)  # header
+        for line in f:
+            row = line.rstrip('\n').split('\t')
+            if len(row) >= 5 and row[1] == 'True' and row[4] != '':
+                times[int(row[0])] = log_seconds(row[4])
+    return times
+
+
+def run_scripts(run_folder):
+    '''
+    [script, time log] pairs of a run folder. The log of each script is the file_path
+    it writes in folder_path.
+    '''
+    pairs = []
+    for script in glob.glob(os.path.join(run_folder, 'scripts', '*.py')):
+        with open(script) as f:
+            names = re.findall(r"file_path = folder_path \+ '/([^']+)'", f.read())
+        for name in names:
+            log = os.path.join(run_folder, 'logs', name)
+            if os.path.isfile(log):
+                pairs.append([script, log])
+                break
+    return pairs
+
+
+def step_features(script):
+    '''
+    {STEP: [feature counts, fixed seconds]} of the simulation of [script].
+    The fixed seconds (plunger, delays and touch tip moves) are not fitted.
+    '''
+    with open(script) as f:
+        num_samples = int(re.search(r'^NUM_SAMPLES = (\d+)', f.read(), re.M).group(1))
+    ctx = run_station(script, num_samples)
+    # Pure kinematic model: no overheads and travel not scaled
+    model = json.loads(json.dumps(MODEL))
+    model['overhead'] = {k: 0 for k in model['overhead']}
+    result = estimate(ctx, model)
+    features = {}
+    for c, t, step in zip(ctx.recorded_commands, result['commands'],
+                          result['command_steps']):
+        counts = features.setdefault(step, [dict.fromkeys(FEATURES, 0), 0])[0]
+        if c.name in counts:
+            counts[c.name] += 1
+        if c.kwargs.get('home_after') == True:
+            counts['home_after'] += 1
+        counts['travel'] += t[0]
+        features[step][1] += t[1]
+    return features
+
+
+def nnls(A, b, iterations = 100):
+    '''
+    Least squares solution of A x = b with x >= 0, dropping the negative coefficients
+    '''
+    active = np.ones(A.shape[1], dtype = bool)
+    x = np.zeros(A.shape[1])
+    for i in range(iterations):
+        x[:] = 0
+        x[active] = np.linalg.lstsq(A[:, active], b, rcond = None)[0]
+        if np.all(x >= 0):
+            break
+        active &= x > 0
+    return x
+
+
+def fit(run_folders, regularization = 10):
+    '''
+    Fitted model and the real and predicted seconds of every STEP, with the fitted
+    and with the default model
+    '''
+    rows = []
+    fixed = []
+    real = []
+    for folder in run_folders:
+        for script, log in run_scripts(folder):
+            features = step_features(script)
+            for step, seconds in read_time_log(log).items():
+                if step in features:
+                    rows.append([features[step][0][k] for k in FEATURES])
+                    fixed.append(features[step][1])
+                    real.append(seconds)
+    if len(rows) == 0:
+        raise ValueError('No time logs found in the run folders')
+    A = np.array(rows, dtype = float)
+    fixed = np.array(fixed)
+    real = np.array(real)
+    default = np.array([MODEL['overhead'].get(k, MODEL['travel_factor'])
+                        for k in FEATURES])
+    used = np.any(A > 0, axis = 0)
+    # Commands that always go together (aspirate and dispense) cannot be told apart,
+    # so the coefficients are kept close to the default model with a ridge term
+    ridge = np.sqrt(regularization) * np.eye(np.sum(used))
+    coefficients = default.copy()
+    coefficients[used] = nnls(np.vstack([A[:, used], ridge]),
+                              np.concatenate([real - fixed, ridge.dot(default[used])]))
+    model = {'overhead': {k: round(float(v), 3) for k, v in zip(FEATURES[:-1],
+                                                                coefficients[:-1])},
+             'travel_factor': round(float(coefficients[-1]), 3)}
+    return model, real, fixed + A.dot(coefficients), fixed + A.dot(default)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Fit the run time estimator')
+    parser.add_argument('runs', nargs = '+', help = 'run folders with scripts/ and logs/')
+    parser.add_argument('-o', '--output', default = model_file)
+    args = parser.parse_args()
+    model, real, predicted, before = fit(args.runs)
+    error_before = np.mean(np.abs(before - real) / real) * 100
+    error_after = np.mean(np.abs(predicted - real) / real) * 100
+    print('STEPS fitted: ' + str(len(real)))
+    print('Mean error: ' + str(round(error_before, 1)) + '% with the default model, ' +
+          str(round(error_after, 1)) + '% fitted')
+    for k, v in model['overhead'].items():
+        print(k + '\t' + str(v) + ' s')
+    print('travel_factor\t' + str(model['travel_factor']))
+    with open(args.output, 'w') as f:
+        json.dump(model, f, indent = 1)
+    print('Model written to ' + args.output)
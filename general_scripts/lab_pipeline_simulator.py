@@ -0,0 +1,207 @@
+import os
+import json
+import heapq
+import argparse
+from mock_opentrons import run_station, repo_path
+from run_time_estimator import estimate
+from fit_timing_model import read_time_log
+
+# Discrete event simulation of the lab flow of a plate of samples:
+#   KA sample setup -> KB sample prep -------> KingFisher extraction -> KC qPCR setup -> qPCR
+#                      KB plate filling -----/
+# The plate filling of station B does not depend on the samples: both KB protocols
+# are queued when the sample setup ends and the extraction waits for both. Every transition between
+# stations has a technician handoff delay. The simulation reports samples per day,
+# the utilization of every resource and where the plates wait.
+#
+# Usage: python lab_pipeline_simulator.py [--robots KA=1,KB=1,KC=1] [--kingfishers 1]
+#        [--qpcr 1] [--handoff 5] [--samples 96] [--hours 24] [--durations file.json]
+
+# Station scripts used to estimate the durations of each kit
+STATION_FILES = {
+    'KF': {'KA': 'automation/KF_config/Station_KA_SampleSetup_pathogen_tec.py',
+           'KB_prep': 'automation/KF_config/Station_KB_sample-prep_pathogen_tec.py',
+           'KB_fill': 'automation/KF_config/Station_KB_PlateFilling_pathogen_tec.py',
+           'KC': 'automation/KF_config/Station_KC_qPCR_pathogen_tec.py'},
+    'KFVP': {'KA': 'automation/KFVP_config/Station_KA_SampleSetup_viral_path2_tec.py',
+             'KB_prep': 'automation/KFVP_config/Station_KB_sample_prep_viral_path2_tec.py',
+             'KB_fill': 'automation/KFVP_config/Station_KB_PlateFilling_viral_path2_tec.py',
+             'KC': 'automation/KFVP_config/Station_KC_qPCR_viral_path2_tec.py'}
+}
+# Minutes of the instruments that are not Opentrons robots
+KINGFISHER_MINUTES = 35
+QPCR_MINUTES = 75
+
+
+def station_durations(kit = 'KF', num_samples = 96):
+    '''
+    Estimated seconds of every station of [kit] for [num_samples]
+    '''
+    return {stage: estimate(run_station(os.path.join(repo_path, f), num_samples))['total']
+            for stage, f in STATION_FILES[kit].items()}
+
+
+def log_durations(logs):
+    '''
+    Seconds of every station from real time logs, as {stage: *_time_log.txt}
+    '''
+    return {stage: sum(read_time_log(path).values()) for stage, path in logs.items()}
+
+
+class Resource:
+    '''
+    [capacity] identical machines with a FIFO queue
+    '''
+    def __init__(self, sim, name, capacity):
+        self.sim = sim
+        self.name = name
+        self.capacity = capacity
+        self.busy = 0
+        self.busy_time = 0
+        self.queue = []
+        self.waits = []
+
+    def request(self, duration, done):
+        self.queue.append([self.sim.now, duration, done])
+        self._start()
+
+    def _start(self):
+        while self.busy < self.capacity and len(self.queue) > 0:
+            arrival, duration, done = self.queue.pop(0)
+            self.busy += 1
+            self.busy_time += duration
+            self.waits.append(self.sim.now - arrival)
+            self.sim.schedule(duration, self._release, done)
+
+    def _release(self, done):
+        self.busy -= 1
+        done()
+        self._start()
+
+
+class Simulation:
+    def __init__(self):
+        self.now = 0
+        self.events = []
+        self.count = 0
+
+    def schedule(self, delay, callback, *args):
+        self.count += 1
+        heapq.heappush(self.events, (self.now + delay, self.count, callback, args))
+
+    def run(self, until):
+        while len(self.events) > 0 and self.events[0][0] <= until:
+            self.now, count, callback, args = heapq.heappop(self.events)
+            callback(*args)
+        self.now = until
+
+
+def simulate_pipeline(durations, robots = {'KA': 1, 'KB': 1, 'KC': 1}, kingfishers = 1,
+                      qpcr = 1, handoff = 300, hours = 24, plates = None,
+                      release_interval = 0):
+    '''
+    Simulate [hours] of the lab. Plates are released every [release_interval] seconds
+    or, if 0, every time a KA robot is free, up to [plates] (no limit if None).
+    [durations] are the seconds of KA, KB_prep, KB_fill and KC; handoff is in seconds.
+    Returns the number of finished plates and the resources.
+    '''
+    sim = Simulation()
+    resources = {name: Resource(sim, name, count) for name, count in robots.items()}
+    resources['KingFisher'] = Resource(sim, 'KingFisher', kingfishers)
+    resources['qPCR'] = Resource(sim, 'qPCR', qpcr)
+    finished = []
+    horizon = hours * 3600
+    if plates == None:
+        # Enough plates to keep the lab busy for the whole horizon
+        plates = int(horizon / max(min(durations.values()), 1)) + 1
+
+    def plate(i):
+        ready = {'prep': False, 'fill': False}
+
+        def after(delay, step):
+            return lambda: sim.schedule(delay, step)
+
+        def join(part):
+            def done():
+                ready[part] = True
+                if all(ready.values()):
+                    sim.schedule(handoff, extraction)
+            return done
+
+        def extraction():
+            resources['KingFisher'].request(KINGFISHER_MINUTES * 60, after(handoff, qpcr_setup))
+
+        def qpcr_setup():
+            resources['KC'].request(durations['KC'], after(handoff, thermocycler))
+
+        def thermocycler():
+            resources['qPCR'].request(QPCR_MINUTES * 60, lambda: finished.append(sim.now))
+
+        def station_b():
+            resources['KB'].request(durations['KB_prep'], join('prep'))
+            resources['KB'].request(durations['KB_fill'], join('fill'))
+
+        def sample_setup_done():
+            if release_interval == 0 and i + robots['KA'] < plates:
+                sim.schedule(0, plate, i + robots['KA'])
+            sim.schedule(handoff, station_b)
+
+        resources['KA'].request(durations['KA'], sample_setup_done)
+
+    if release_interval == 0:
+        # A new plate is started every time a KA robot finishes one
+        for i in range(min(robots['KA'], plates)):
+            sim.schedule(0, plate, i)
+    else:
+        for i in range(plates):
+            sim.schedule(i * release_interval, plate, i)
+    sim.run(horizon)
+    return len(finished), resources
+
+
+def report(finished, resources, num_samples, hours):
+    print('Plates finished: ' + str(finished) + ' in ' + str(hours) + ' h, ' +
+          str(round(finished * num_samples * 24 / hours)) + ' samples/day')
+    print('resource\tmachines\tutilization\tmean wait (min)\tplates waiting')
+    bottleneck = None
+    for r in resources.values():
+        utilization = min(r.busy_time / (r.capacity * hours * 3600), 1)
+        wait = sum(r.waits) / len(r.waits) / 60 if len(r.waits) > 0 else 0
+        print('\t'.join([r.name, str(r.capacity), str(round(utilization * 100)) + '%',
+                         str(round(wait, 1)), str(len(r.queue))]))
+        # The resource where most plates are left waiting, or the busiest one
+        if bottleneck == None or [len(r.queue), utilization] > bottleneck[1:]:
+            bottleneck = [r.name, len(r.queue), utilization]
+    print('Bottleneck: ' + bottleneck[0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Lab pipeline simulation')
+    parser.add_argument('--kit', default = 'KF', choices = list(STATION_FILES))
+    parser.add_argument('--robots', default = 'KA=1,KB=1,KC=1')
+    parser.add_argument('--kingfishers', type = int, default = 1)
+    parser.add_argument('--qpcr', type = int, default = 1)
+    parser.add_argument('--handoff', type = float, default = 5, help = 'minutes')
+    parser.add_argument('--samples', type = int, default = 96, help = 'samples per plate')
+    parser.add_argument('--hours', type = float, default = 24)
+    parser.add_argument('--plates', type = int, default = None)
+    parser.add_argument('--interval', type = float, default = 0,
+                        help = 'minutes between plates')
+    parser.add_argument('--durations', default = None,
+                        help = 'json with the seconds of KA, KB_prep, KB_fill and KC, or '
+                        'with the path of their time logs')
+    args = parser.parse_args()
+    if args.durations != None:
+        with open(args.durations) as f:
+            durations = json.load(f)
+        if all([isinstance(v, str) for v in durations.values()]):
+            durations = log_durations(durations)
+    else:
+        durations = station_durations(args.kit, args.samples)
+    for stage, seconds in durations.items():
+        print(stage + '\t' + str(round(seconds / 60, 1)) + ' min')
+    robots = {r.split('=')[0]: int(r.split('=')[1]) for r in args.robots.split(',')}
+    finished, resources = simulate_pipeline(durations, robots, args.kingfishers, args.qpcr,
+                                            args.handoff * 60, args.hours, args.plates,
+                                            args.interval * 60)
+    report(finished, resources, args.samples, args.hours)
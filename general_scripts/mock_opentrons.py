@@ -0,0 +1,526 @@
+import sys
+import os
+import glob
+import json
+import types
+import collections
+from command_stream import Command, load_station
+
+# Headless mock of the opentrons API 2.0, to run the station protocols without the
+# opentrons package or a robot. Labware is loaded from the json definitions in
+# labware_simulate/ and Custom labware/, and every command of the protocol is
+# recorded in ctx.recorded_commands (command_stream.Command) with all its arguments.
+#
+# Usage: python mock_opentrons.py Station_file.py [num_samples]
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LABWARE_FOLDERS = [os.path.join(repo_path, 'labware_simulate'),
+                   os.path.join(repo_path, 'Custom labware')]
+
+# Front left corner of every slot of the OT-2 deck
+SLOT_WIDTH = 132.5
+SLOT_DEPTH = 90.5
+TRASH_SLOT = '12'
+
+# Labware offset of the modules used in the stations
+MODULE_OFFSETS = {'tempdeck': (-0.15, -0.15, 80.09),
+                  'temperature module': (-0.15, -0.15, 80.09),
+                  'magdeck': (0.125, -0.125, 82.25)}
+
+# name: max_volume, min_volume, channels, default flow rate (µl/s)
+PIPETTES = {
+    'p20_single_gen2': [20, 1, 1, 7.56],
+    'p20_multi_gen2': [20, 1, 8, 7.6],
+    'p300_single_gen2': [300, 20, 1, 92.86],
+    'p300_multi_gen2': [300, 20, 8, 94],
+    'p1000_single_gen2': [1000, 100, 1, 274.7]
+}
+
+# Opentrons labware that is not in our custom labware folders, defined as a grid
+# rows, columns, x and y of A1, x and y spacing, z of the bottom, depth, well
+# (diameter or [x, y]), volume, bottom shape, labware height, tip length
+BUILTIN_LABWARE = {
+    'nest_12_reservoir_15ml': [1, 12, 14.38, 42.78, 9, 0, 4.55, 26.85, [8.2, 71.2],
+                               15000, 'v', 31.4, None],
+    'opentrons_24_tuberack_generic_2ml_screwcap': [4, 6, 18.21, 75.43, 19.89, 19.28,
+                                                   42.05, 42, 8.5, 2000, 'v', 84, None],
+    'opentrons_24_aluminumblock_generic_2ml_screwcap': [4, 6, 20.75, 68.63, 17.25,
+                                                        17.25, 6.7, 42, 8.5, 2000, 'v',
+                                                        48.7, None],
+    'opentrons_96_tiprack_20ul': [8, 12, 14.38, 74.24, 9, 9, 25.49, 39.2, 3.27, 20,
+                                  'flat', 64.69, 39.2],
+    'opentrons_96_filtertiprack_20ul': [8, 12, 14.38, 74.24, 9, 9, 25.49, 39.2, 3.27,
+                                        20, 'flat', 64.69, 39.2],
+    'opentrons_96_filtertiprack_200ul': [8, 12, 14.38, 74.24, 9, 9, 5.39, 59.3, 5.23,
+                                         200, 'flat', 64.69, 59.3],
+    'opentrons_96_tiprack_300ul': [8, 12, 14.38, 74.24, 9, 9, 5.39, 59.3, 5.23, 300,
+                                   'flat', 64.49, 59.3],
+    'opentrons_96_filtertiprack_1000ul': [8, 12, 14.38, 74.24, 9, 9, 9.47, 88, 7.62,
+                                          1000, 'flat', 97.47, 88],
+    'opentrons_1_trash_1100ml_fixed': [1, 1, 82.84, 80, 0, 0, 0, 77, [172.86, 165.86],
+                                       1100000, 'flat', 82, None]
+}
+
+_registry = {}
+_labware = {}
+
+
+def grid_definition(load_name, rows, cols, x, y, x_spacing, y_spacing, z, depth, well,
+                    volume, bottom, height, tip_length):
+    '''
+    Labware definition with [rows] x [cols] wells, in the labware json format
+    '''
+    definition = {'parameters': {'loadName': load_name,
+                                 'isTiprack': tip_length != None},
+                  'metadata': {'displayName': load_name},
+                  'dimensions': {'xDimension': 127.76, 'yDimension': 85.48,
+                                 'zDimension': height},
+                  'cornerOffsetFromSlot': {'x': 0, 'y': 0, 'z': 0},
+                  'groups': [{'metadata': {'wellBottomShape': bottom}}],
+                  'ordering': [], 'wells': {}}
+    if tip_length != None:
+        definition['parameters']['tipLength'] = tip_length
+    for c in range(cols):
+        column = []
+        for r in range(rows):
+            name = 'ABCDEFGH'[r] + str(c + 1)
+            w = {'depth': depth, 'totalLiquidVolume': volume,
+                 'x': x + c * x_spacing, 'y': y - r * y_spacing, 'z': z}
+            if isinstance(well, list):
+                w.update({'shape': 'rectangular', 'xDimension': well[0],
+                          'yDimension': well[1]})
+            else:
+                w.update({'shape': 'circular', 'diameter': well})
+            definition['wells'][name] = w
+            column.append(name)
+        definition['ordering'].append(column)
+    return definition
+
+
+def labware_registry():
+    '''
+    {loadName: definition} of our labware json files, parsed the first time
+    '''
+    if len(_registry) == 0:
+        for folder in LABWARE_FOLDERS:
+            for f in glob.glob(os.path.join(folder, '**', '*.json'), recursive = True):
+                with open(f) as d:
+                    definition = json.load(d)
+                if 'parameters' in definition:
+                    _registry.setdefault(definition['parameters']['loadName'], definition)
+    return _registry
+
+
+def get_definition(load_name):
+    '''
+    Definition of [load_name], from our labware json files or BUILTIN_LABWARE
+    '''
+    if load_name in labware_registry():
+        return _registry[load_name]
+    if load_name in BUILTIN_LABWARE:
+        return grid_definition(load_name, *BUILTIN_LABWARE[load_name])
+    raise KeyError('Unknown labware ' + load_name)
+
+
+def slot_origin(slot):
+    n = int(slot) - 1
+    return Point((n % 3) * SLOT_WIDTH, (n // 3) * SLOT_DEPTH, 0)
+
+
+################################################################################
+# opentrons.types
+class Point(collections.namedtuple('Point', ['x', 'y', 'z'], defaults = [0, 0, 0])):
+    def __add__(self, other):
+        return Point(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return Point(self.x - other.x, self.y - other.y, self.z - other.z)
+
+
+class Location:
+    def __init__(self, point, labware):
+        self.point = point
+        self.labware = labware
+
+    def move(self, point):
+        return Location(self.point + point, self.labware)
+
+    def __repr__(self):
+        return (str(self.labware) + ' (' + ', '.join([str(round(v, 2))
+                                                      for v in self.point]) + ')')
+
+
+################################################################################
+# Labware
+class Well:
+    def __init__(self, parent, name, geometry, origin):
+        self.parent = parent
+        self.display_name = name
+        self._geometry = geometry
+        self.max_volume = geometry['totalLiquidVolume']
+        self.depth = geometry['depth']
+        self.diameter = geometry.get('diameter')
+        self._bottom = origin + Point(geometry['x'], geometry['y'], geometry['z'])
+
+    def top(self, z = 0):
+        return Location(self._bottom + Point(0, 0, self.depth + z), self)
+
+    def bottom(self, z = 0):
+        return Location(self._bottom + Point(0, 0, z), self)
+
+    def center(self):
+        return Location(self._bottom + Point(0, 0, self.depth / 2), self)
+
+    def __repr__(self):
+        return self.display_name + ' of ' + str(self.parent)
+
+
+class Labware:
+    def __init__(self, definition, slot, label = None, offset = Point()):
+        self._definition = definition
+        self.load_name = definition['parameters']['loadName']
+        self.name = label if label != None else self.load_name
+        self.slot = str(slot)
+        self.is_tiprack = definition['parameters'].get('isTiprack', False)
+        self.tip_length = definition['parameters'].get('tipLength', 0)
+        corner = definition['cornerOffsetFromSlot']
+        origin = slot_origin(slot) + offset + Point(corner['x'], corner['y'], corner['z'])
+        self.highest_z = origin.z + definition['dimensions']['zDimension']
+        self._ordering = definition['ordering']
+        self._wells = collections.OrderedDict()
+        for column in self._ordering:
+            for name in column:
+                self._wells[name] = Well(self, name, definition['wells'][name], origin)
+
+    def wells(self, *names):
+        if len(names) > 0:
+            return [self._wells[n] for n in names]
+        return list(self._wells.values())
+
+    def wells_by_name(self):
+        return dict(self._wells)
+
+    def __getitem__(self, name):
+        return self._wells[name]
+
+    def columns(self, *indexes):
+        columns = [[self._wells[n] for n in c] for c in self._ordering]
+        return [columns[i] for i in indexes] if len(indexes) > 0 else columns
+
+    def rows(self, *indexes):
+        rows = [list(r) for r in zip(*self.columns())]
+        return [rows[i] for i in indexes] if len(indexes) > 0 else rows
+
+    def __repr__(self):
+        return self.name + ' on ' + self.slot
+
+
+class Module:
+    def __init__(self, ctx, name, slot):
+        self._ctx = ctx
+        self.name = name
+        self.slot = str(slot)
+        self.labware = None
+        self.temperature = None
+
+    def load_labware(self, load_name, label = None):
+        self.labware = Labware(get_definition(load_name), self.slot, label,
+                               Point(*MODULE_OFFSETS.get(self.name, (0, 0, 0))))
+        self._ctx.deck[self.slot] = self.labware
+        return self.labware
+
+    def set_temperature(self, celsius):
+        self.temperature = celsius
+        self._ctx._record(self, 'set_temperature', celsius = celsius)
+
+    def deactivate(self):
+        self.temperature = None
+        self._ctx._record(self, 'deactivate')
+
+    def __repr__(self):
+        return self.name + ' on ' + self.slot
+
+
+################################################################################
+# Instruments
+class FlowRates:
+    def __init__(self, rate):
+        self.aspirate = rate
+        self.dispense = rate
+        self.blow_out = rate
+
+
+class InstrumentContext:
+    '''
+    Mock pipette. It keeps the tip and volume state and raises RuntimeError for the
+    errors the robot would stop at (no tip, volume above the maximum, no tips left).
+    '''
+    def __init__(self, ctx, name, mount, tip_racks):
+        self._ctx = ctx
+        self.name = name
+        self.mount = mount
+        self.max_volume, self.min_volume, self.channels, rate = PIPETTES[name]
+        self.flow_rate = FlowRates(rate)
+        self.tip_racks = list(tip_racks)
+        self.hw_pipette = {'has_tip': False, 'current_volume': 0,
+                           'max_volume': self.max_volume, 'channels': self.channels}
+        self.location = None
+        self._used_tips = set()
+
+    @property
+    def current_volume(self):
+        return self.hw_pipette['current_volume']
+
+    @property
+    def has_tip(self):
+        return self.hw_pipette['has_tip']
+
+    def _command(self, name, **kwargs):
+        self._ctx._record(self, name, **kwargs)
+        if kwargs.get('location') != None:
+            self.location = kwargs['location']
+            self._ctx.location_cache = kwargs['location']
+        return self
+
+    def _next_tip(self):
+        for rack in self.tip_racks:
+            for column in rack.columns():
+                free = [w for w in column if w not in self._used_tips]
+                if self.channels == 1 and len(free) > 0:
+                    self._used_tips.add(free[0])
+                    return free[0]
+                if self.channels > 1 and len(free) == len(column):
+                    self._used_tips.update(column)
+                    return column[0]
+        raise RuntimeError(self.name + ': no tips left in the tipracks')
+
+    def _change_volume(self, volume):
+        volume = self.current_volume + volume
+        if not self.has_tip:
+            raise RuntimeError(self.name + ': cannot aspirate or dispense without a tip')
+        if volume > self.max_volume + 1e-6 or volume < -1e-6:
+            raise RuntimeError(self.name + ': volume ' + str(volume) + ' out of range')
+        self.hw_pipette['current_volume'] = max(volume, 0)
+
+    def pick_up_tip(self, location = None):
+        if self.has_tip:
+            raise RuntimeError(self.name + ': a tip is already attached')
+        if location == None:
+            location = self._next_tip().top()
+        elif isinstance(location, Well):
+            self._used_tips.add(location)
+            location = location.top()
+        self.hw_pipette['has_tip'] = True
+        return self._command('pick_up_tip', location = location)
+
+    def drop_tip(self, location = None, home_after = True):
+        if location == None:
+            location = self._ctx.fixed_trash.wells()[0].top()
+        self.hw_pipette['has_tip'] = False
+        self.hw_pipette['current_volume'] = 0
+        return self._command('drop_tip', location = location, home_after = home_after)
+
+    def return_tip(self, home_after = True):
+        location = self.location
+        self.hw_pipette['has_tip'] = False
+        self.hw_pipette['current_volume'] = 0
+        return self._command('return_tip', location = location, home_after = home_after)
+
+    def reset_tipracks(self):
+        self._used_tips = set()
+        return self._command('reset_tipracks')
+
+    def aspirate(self, volume = None, location = None, rate = 1.0):
+        if volume == None:
+            volume = self.max_volume - self.current_volume
+        self._change_volume(volume)
+        return self._command('aspirate', volume = volume, location = location,
+                             rate = rate)
+
+    def dispense(self, volume = None, location = None, rate = 1.0):
+        if volume == None:
+            volume = self.current_volume
+        self._change_volume(-volume)
+        return self._command('dispense', volume = volume, location = location,
+                             rate = rate)
+
+    def blow_out(self, location = None):
+        self.hw_pipette['current_volume'] = 0
+        return self._command('blow_out', location = location)
+
+    def touch_tip(self, location = None, radius = 1.0, v_offset = -1.0, speed = 60.0):
+        return self._command('touch_tip', location = location, radius = radius,
+                             v_offset = v_offset, speed = speed)
+
+    def air_gap(self, volume = None, height = None):
+        if volume == None:
+            volume = self.max_volume - self.current_volume
+        self._change_volume(volume)
+        return self._command('air_gap', volume = volume, height = height)
+
+    def mix(self, repetitions = 1, volume = None, location = None, rate = 1.0):
+        return self._command('mix', repetitions = repetitions, volume = volume,
+                             location = location, rate = rate)
+
+    def move_to(self, location, force_direct = False, minimum_z_height = None,
+                speed = None):
+        return self._command('move_to', location = location, force_direct = force_direct,
+                             minimum_z_height = minimum_z_height, speed = speed)
+
+    def home(self):
+        self._ctx.location_cache = None
+        return self._command('home')
+
+    def home_plunger(self):
+        return self._command('home_plunger')
+
+    def __repr__(self):
+        return self.name + ' on ' + self.mount + ' mount'
+
+
+################################################################################
+# ProtocolContext
+class ProtocolContext:
+    def __init__(self, api_level = '2.0'):
+        global _current_context
+        self.api_level = api_level
+        self.deck = {}
+        self.loaded_instruments = {}
+        self.recorded_commands = []
+        self.location_cache = None
+        self.fixed_trash = Labware(get_definition('opentrons_1_trash_1100ml_fixed'),
+                                   TRASH_SLOT, 'Trash')
+        self.deck[TRASH_SLOT] = self.fixed_trash
+        _current_context = self
+
+    def _record(self, target, name, *args, **kwargs):
+        self.recorded_commands.append(Command(target, name, args, kwargs))
+
+    @property
+    def loaded_labwares(self):
+        return {int(slot): labware for slot, labware in self.deck.items()
+                if isinstance(labware, Labware)}
+
+    def is_simulating(self):
+        return True
+
+    def load_labware(self, load_name, location, label = None):
+        # Labware keeps no state of the run, so it is shared between runs
+        key = (load_name, str(location), label)
+        if key not in _labware:
+            _labware[key] = Labware(get_definition(load_name), location, label)
+        labware = _labware[key]
+        self.deck[str(location)] = labware
+        return labware
+
+    def load_module(self, module_name, location):
+        module = Module(self, module_name, location)
+        self.deck[str(location)] = module
+        return module
+
+    def load_instrument(self, instrument_name, mount, tip_racks = None, replace = False):
+        pipette = InstrumentContext(self, instrument_name, mount, tip_racks or [])
+        self.loaded_instruments[mount] = pipette
+        return pipette
+
+    def delay(self, seconds = 0, minutes = 0, msg = None):
+        self._record(self, 'delay', seconds = seconds, minutes = minutes)
+
+    def comment(self, msg):
+        self._record(self, 'comment', msg)
+
+    def pause(self, msg = None):
+        self._record(self, 'pause', msg)
+
+    def home(self):
+        self.location_cache = None
+        self._record(self, 'home')
+
+    def __repr__(self):
+        return 'ctx'
+
+
+################################################################################
+# GPIO backend and time, recorded in the last created context
+_current_context = None
+
+
+class GPIO(types.ModuleType):
+    def set_rail_lights(self, on = True):
+        _current_context._record(self, 'set_rail_lights', on)
+
+    def set_button_light(self, red = False, green = False, blue = False):
+        _current_context._record(self, 'set_button_light', red, green, blue)
+
+    def __repr__(self):
+        return 'gpio'
+
+
+gpio = GPIO('opentrons.drivers.rpi_drivers.gpio')
+
+
+class Time(types.ModuleType):
+    '''
+    time module for the stations: sleep is recorded instead of waited
+    '''
+    def __init__(self):
+        super().__init__('time')
+        import time
+        self.time = time.time
+        self.perf_counter = time.perf_counter
+
+    def sleep(self, seconds):
+        _current_context._record(gpio, 'sleep', seconds = seconds)
+
+
+def install():
+    '''
+    Register the mock as the opentrons package in sys.modules
+    '''
+    modules = {}
+    for name in ['opentrons', 'opentrons.types', 'opentrons.protocol_api',
+                 'opentrons.protocol_api.labware', 'opentrons.drivers',
+                 'opentrons.drivers.rpi_drivers']:
+        modules[name] = types.ModuleType(name)
+    modules['opentrons.drivers.rpi_drivers.gpio'] = gpio
+    modules['opentrons.types'].Point = Point
+    modules['opentrons.types'].Location = Location
+    api = modules['opentrons.protocol_api']
+    api.ProtocolContext = ProtocolContext
+    api.InstrumentContext = InstrumentContext
+    api.Labware = Labware
+    api.Well = Well
+    api.labware = modules['opentrons.protocol_api.labware']
+    api.labware.get_labware_definition = \
+        lambda load_name, namespace = None, version = None: get_definition(load_name)
+    modules['opentrons'].types = modules['opentrons.types']
+    modules['opentrons'].protocol_api = api
+    modules['opentrons'].drivers = modules['opentrons.drivers']
+    modules['opentrons.drivers'].rpi_drivers = modules['opentrons.drivers.rpi_drivers']
+    modules['opentrons.drivers.rpi_drivers'].gpio = gpio
+    sys.modules.update(modules)
+
+
+def run_station(path, num_samples = 96, run_id = 'simulation', overage = None,
+                settings = None):
+    '''
+    Run the station protocol in [path] for [num_samples] against the mock, with the
+    reagent [overage] of load_station and the station variables in [settings]
+    ({name: value}, e.g. {'low_arc': False}) replaced. Returns the ProtocolContext with
+    the recorded commands.
+    '''
+    install()
+    station = load_station(path, num_samples, run_id, overage)
+    station.time = Time()
+    station.__dict__.update(settings or {})
+    ctx = ProtocolContext(station.metadata.get('apiLevel', '2.0'))
+    station.run(ctx)
+    return ctx
+
+
+if __name__ == '__main__':
+    ctx = run_station(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 96)
+    for c in ctx.recorded_commands:
+        if c.name != 'comment':
+            print(str(c.target) + '.' + repr(c))
+    print('Recorded commands: ' + str(len(ctx.recorded_commands)))
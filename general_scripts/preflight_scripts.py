@@ -0,0 +1,152 @@
+import os
+import re
+import sys
+import ast
+import glob
+import builtins
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from mock_opentrons import labware_registry, BUILTIN_LABWARE
+
+# Preflight check of the scripts of a run folder, before they are sent to the robots.
+# Every script is parsed with ast (in parallel) and checked for:
+#   - $placeholders that rep_data did not replace
+#   - syntax errors
+#   - names that are used but never defined
+#   - a STEPS dict with consecutive steps, 'Execute' and 'description' in each one,
+#     and as many 'STEP += 1' as steps
+#   - labware loadNames that are not in our labware folders or the opentrons ones
+#
+# Usage: python preflight_scripts.py RUNS/run_name [RUNS/other_run ...]
+#        python preflight_scripts.py script.py ...
+
+PLACEHOLDER = re.compile(r'\$[a-zA-Z_]+')
+
+
+def bound_names(tree):
+    '''
+    Every name bound anywhere in [tree]. Scopes are not told apart, so a name is only
+    reported as undefined when nothing in the script defines it.
+    '''
+    names = set(dir(builtins)) | {'__file__', '__name__'}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add((alias.asname or alias.name).split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name != None:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+    return names
+
+
+def check_names(tree):
+    defined = bound_names(tree)
+    problems = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and \
+                node.id not in defined:
+            problems.append([node.lineno, 'undefined name ' + node.id])
+    return problems
+
+
+def check_steps(tree):
+    problems = []
+    steps = None
+    increments = 0
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Dict) and \
+                any([isinstance(t, ast.Name) and t.id == 'STEPS' for t in node.targets]):
+            steps = node
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name) and \
+                node.target.id == 'STEP' and isinstance(node.op, ast.Add):
+            increments += 1
+    if steps == None:
+        return [[1, 'no STEPS dict']]
+    keys = []
+    for key, value in zip(steps.value.keys, steps.value.values):
+        if not isinstance(key, ast.Constant) or not isinstance(key.value, int):
+            problems.append([steps.lineno, 'STEPS key is not a number'])
+            continue
+        keys.append(key.value)
+        fields = [k.value for k in getattr(value, 'keys', []) if isinstance(k, ast.Constant)]
+        for field in ['Execute', 'description']:
+            if field not in fields:
+                problems.append([key.lineno, 'STEP ' + str(key.value) + ' has no ' + field])
+    if keys != list(range(1, len(keys) + 1)):
+        problems.append([steps.lineno, 'STEPS are not numbered 1 to ' + str(len(keys)) +
+                         ': ' + str(keys)])
+    if increments != len(keys):
+        problems.append([steps.lineno, str(len(keys)) + ' STEPS but ' + str(increments) +
+                         ' STEP += 1'])
+    return problems
+
+
+def check_labware(tree, known):
+    problems = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+                node.func.attr in ['load_labware', 'load_labware_by_name'] and \
+                len(node.args) > 0 and isinstance(node.args[0], ast.Constant):
+            if node.args[0].value not in known:
+                problems.append([node.lineno, 'unknown labware ' + str(node.args[0].value)])
+    return problems
+
+
+def check_script(path):
+    '''
+    [line, problem] of the script in [path], sorted by line
+    '''
+    with open(path) as f:
+        source = f.read()
+    problems = []
+    for i, line in enumerate(source.splitlines()):
+        for placeholder in PLACEHOLDER.findall(line):
+            problems.append([i + 1, 'placeholder ' + placeholder + ' not replaced'])
+    try:
+        tree = ast.parse(source, path)
+    except SyntaxError as e:
+        return sorted(problems + [[e.lineno or 0, 'syntax error: ' + e.msg]])
+    known = set(labware_registry()) | set(BUILTIN_LABWARE)
+    problems += check_names(tree) + check_steps(tree) + check_labware(tree, known)
+    return sorted(problems)
+
+
+def run_scripts(paths):
+    '''
+    Scripts of the run folders in [paths] (RUNS/run_name/scripts/*.py) and of the
+    scripts given directly
+    '''
+    scripts = []
+    for p in paths:
+        if os.path.isdir(p):
+            scripts += sorted(glob.glob(os.path.join(p, 'scripts', '*.py')) or
+                              glob.glob(os.path.join(p, '*.py')))
+        else:
+            scripts.append(p)
+    return scripts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Preflight check of run scripts')
+    parser.add_argument('paths', nargs = '+', help = 'run folders or scripts')
+    parser.add_argument('-w', '--workers', type = int, default = None)
+    args = parser.parse_args()
+    scripts = run_scripts(args.paths)
+    with ProcessPoolExecutor(max_workers = args.workers) as pool:
+        results = list(pool.map(check_script, scripts))
+    failed = 0
+    for script, problems in zip(scripts, results):
+        if len(problems) == 0:
+            print(os.path.basename(script) + ': OK')
+            continue
+        failed += 1
+        for line, problem in problems:
+            print(os.path.basename(script) + ':' + str(line) + ': ' + problem)
+    sys.exit(1 if failed > 0 else 0)
@@ -0,0 +1,209 @@
+import os
+import sys
+import math
+import json
+import argparse
+import numpy as np
+from mock_opentrons import run_station, repo_path
+
+# Monte Carlo model of the overage of the reagents loaded in the stations.
+# The station is simulated with a candidate overage (the $beads_overage and
+# $mmix_overage placeholders) and every calc_height call of the reagent is recorded:
+# the well chosen by its ReservoirState, the volume and the height of the tip.
+# Then the run is repeated [trials] times with random pipetting errors and errors
+# filling the wells: a trial runs dry when the liquid left in a well is below the tip
+# of an aspiration. The dead volume (the tip never goes below min_height) and the
+# volume left in a well when the station moves to the next one (Reagent.unused)
+# come out of the station code itself. The minimum overage that keeps the
+# probability of running dry under the target is searched from 0 upwards.
+# input_file_tecnico_macs.py loads the bigger of the table and the 1.1x rule, and
+# warns about the sample counts where no overage reaches the target.
+#
+# Usage: python reagent_overage.py [--kit KF] [--reagent mmix] [-n 96] [--target 0.99]
+#        python reagent_overage.py --table [--samples 2-96] (writes reagent_overage.json)
+
+# Station and Reagent name of every reagent sized by input_file_tecnico_macs.py
+REAGENTS = {
+    'KF': {'beads': ['automation/KF_config/Station_KB_sample-prep_pathogen_tec.py',
+                     'Magnetic beads and Lysis'],
+           'mmix': ['automation/KF_config/Station_KC_qPCR_pathogen_tec.py',
+                    'Master Mix']},
+    'KFVP': {'beads': ['automation/KFVP_config/Station_KB_sample_prep_viral_path2_tec.py',
+                       'Magnetic beads and binding solution'],
+             'mmix': ['automation/KFVP_config/Station_KC_qPCR_viral_path2_tec.py',
+                      'Master Mix']}
+}
+TARGET = 0.99  # probability of not running dry
+TRIALS = 5000
+# Assumed errors, not measured in our robots: the table is only as good as these
+PIPETTING_CV = 0.02  # random error of every aspiration, relative
+PIPETTING_BIAS = 0.0  # systematic error of the pipette, relative
+FILLING_CV = 0.01  # error of the technician filling the wells, relative
+
+table_file = os.path.join(repo_path, 'automation', 'reagent_overage.json')
+_warned = []
+
+
+def record_aspirations(station, reagent_name, num_samples, overage):
+    '''
+    Run [station] with the [overage] of its reagents and return the Reagent object
+    named [reagent_name] and its aspirations, as [well, volume, tip height, min_height]
+    '''
+    calls = []
+    reagents = {}
+
+    def profiler(frame, event, arg):
+        code = frame.f_code
+        if event == 'return' and code.co_name == 'calc_height':
+            reagent = frame.f_locals['reagent']
+            if reagent.name == reagent_name:
+                reagents[reagent_name] = reagent
+                calls.append([reagent.col, frame.f_locals['aspirate_volume'], arg[0],
+                              frame.f_locals['min_height']])
+
+    sys.setprofile(profiler)
+    try:
+        run_station(station, num_samples, overage = overage)
+    except Exception as e:
+        # Errors of the final reports of some stations, once the reagent is dispensed
+        if len(calls) == 0:
+            raise
+        if station not in _warned:
+            _warned.append(station)
+            print('Warning: ' + os.path.basename(station) + ' stopped after ' +
+                  str(len(calls)) + ' aspirations: ' + type(e).__name__ + ': ' + str(e),
+                  file = sys.stderr)
+    finally:
+        sys.setprofile(None)
+    if reagent_name not in reagents:
+        raise ValueError(reagent_name + ' is not aspirated in ' + station)
+    return reagents[reagent_name], calls
+
+
+def heights(level, volumes):
+    '''
+    Vectorized LiquidLevel.height of [volumes]
+    '''
+    table_volumes = np.arange(len(level.table)) * level.step
+    return np.interp(volumes, table_volumes, level.table, left = 0)
+
+
+def dry_probability(reagent, calls, trials = TRIALS, cv = PIPETTING_CV,
+                    bias = PIPETTING_BIAS, filling_cv = FILLING_CV, seed = 0):
+    '''
+    Fraction of [trials] in which an aspiration of [calls] finds the liquid below the
+    tip. The same [seed] gives the same errors to every overage, so the probability
+    only changes with the overage. Wells that cannot hold the volume always fail.
+    '''
+    if reagent.vol_well_original > reagent.level.max_volume:
+        return 1.0
+    rng = np.random.default_rng(seed)
+    loaded = np.full((trials, reagent.num_wells), reagent.vol_well_original)
+    volumes = loaded * (1 + filling_cv * rng.standard_normal(loaded.shape))
+    dry = np.zeros(trials, dtype = bool)
+    for well, volume, tip_height, min_height in calls:
+        volumes[:, well] -= volume * (1 + bias + cv * rng.standard_normal(trials))
+        dry |= (volumes[:, well] < 0) | \
+            (heights(reagent.level, volumes[:, well]) < tip_height)
+    return float(np.mean(dry))
+
+
+def evaluate(kit, reagent, num_samples, overage, **errors):
+    '''
+    Probability of running dry and volumes of [reagent] of [kit] loaded with [overage]
+    '''
+    station, name = REAGENTS[kit][reagent]
+    r, calls = record_aspirations(os.path.join(repo_path, station), name, num_samples,
+                                  {reagent: overage})
+    needed = sum([c[1] for c in calls])
+    return {'overage': round(overage, 4),
+            'dry_probability': dry_probability(r, calls, **errors),
+            'loaded_ul': round(r.reagent_reservoir_volume, 1),
+            'needed_ul': round(needed, 1),
+            'wells': r.num_wells,
+            'dead_volume_ul': round(r.level.volume(calls[0][3]) * r.num_wells, 1),
+            'unused_ul': round(sum(r.unused), 1)}
+
+
+def recommend(kit, reagent, num_samples, target = TARGET, resolution = 0.005,
+              maximum = 0.5, **errors):
+    '''
+    Minimum overage (multiple of [resolution]) of [reagent] with a probability of not
+    running dry of at least [target], and its evaluation. The overages are tried in
+    order because the probability is not monotonic: a bigger overage can move a well
+    switch and leave less liquid over the tip in the last aspiration of a well.
+    '''
+    for i in range(int(round(maximum / resolution)) + 1):
+        result = evaluate(kit, reagent, num_samples, i * resolution, **errors)
+        if 1 - result['dry_probability'] >= target:
+            return result
+    raise ValueError('No overage up to ' + str(maximum) + ' reaches the target')
+
+
+def parse_range(text):
+    '''
+    '2-96' or '8,48,96' as a list of sample counts
+    '''
+    if '-' in text:
+        first, last = text.split('-')
+        return list(range(int(first), int(last) + 1))
+    return [int(n) for n in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Monte Carlo reagent overage')
+    parser.add_argument('--kit', default = None, choices = list(REAGENTS))
+    parser.add_argument('--reagent', default = None, choices = ['beads', 'mmix'])
+    parser.add_argument('-n', '--num-samples', type = int, default = 96)
+    parser.add_argument('--target', type = float, default = TARGET,
+                        help = 'probability of not running dry')
+    parser.add_argument('--trials', type = int, default = TRIALS)
+    parser.add_argument('--cv', type = float, default = PIPETTING_CV)
+    parser.add_argument('--bias', type = float, default = PIPETTING_BIAS)
+    parser.add_argument('--filling-cv', type = float, default = FILLING_CV)
+    parser.add_argument('--table', action = 'store_true',
+                        help = 'write the overage of every sample count to ' + table_file)
+    parser.add_argument('--samples', default = '2-96', help = 'sample counts of the table')
+    args = parser.parse_args()
+    errors = {'trials': args.trials, 'cv': args.cv, 'bias': args.bias,
+              'filling_cv': args.filling_cv}
+    kits = [args.kit] if args.kit != None else list(REAGENTS)
+    reagents = [args.reagent] if args.reagent != None else ['beads', 'mmix']
+    if args.table:
+        table = {}
+        for kit in kits:
+            for reagent in reagents:
+                overages = table.setdefault(kit, {}).setdefault(reagent, {})
+                for n in parse_range(args.samples):
+                    try:
+                        overages[str(n)] = recommend(kit, reagent, n, args.target,
+                                                     **errors)['overage']
+                    except Exception as e:
+                        # input_file_tecnico_macs.py keeps the 1.1x rule for these
+                        print(kit + ' ' + reagent + ' ' + str(n) + ' samples: ' + str(e))
+                print(kit + ' ' + reagent + ': ' + str(len(overages)) + ' sample counts')
+        with open(table_file, 'w') as f:
+            json.dump(table, f, indent = 1, sort_keys = True)
+        print('Overage table written to ' + table_file)
+        sys.exit(0)
+    print('kit\treagent\toverage\tP(dry)\tloaded (ul)\tneeded (ul)\twells\t'
+          'dead volume (ul)\tunused (ul)')
+    for kit in kits:
+        for reagent in reagents:
+            current = evaluate(kit, reagent, args.num_samples, 0.1, **errors)
+            try:
+                best = recommend(kit, reagent, args.num_samples, args.target, **errors)
+            except ValueError as e:
+                best = None
+            for label, r in [['1.1x', current], ['recommended', best]]:
+                if r != None:
+                    print('\t'.join([kit, reagent + ' (' + label + ')', str(r['overage']),
+                                     str(round(r['dry_probability'], 4)),
+                                     str(r['loaded_ul']), str(r['needed_ul']),
+                                     str(r['wells']), str(r['dead_volume_ul']),
+                                     str(r['unused_ul'])]))
+            if best == None:
+                print(kit + ' ' + reagent + ': no overage reaches the target')
+            else:
+                print(kit + ' ' + reagent + ': ' +
+                      str(round(current['loaded_ul'] - best['loaded_ul'])) + ' ul saved')
@@ -0,0 +1,143 @@
+import re
+import json
+import difflib
+import argparse
+from mock_opentrons import run_station
+from run_time_estimator import estimate, load_model
+
+# Replay of a real run against the simulator.
+# With journal = True the stations write every command of the robot with the time it
+# started and finished (*_journal.jsonl, next to the time log). The journal is aligned
+# with the command stream simulated for the same script, and the actual duration of
+# every command is compared with the one predicted by run_time_estimator, to find the
+# motions that take longer than expected (slow touch tips, unexpected homing, ...).
+#
+# Usage: python replay_journal.py script.py KC_qPCR_time_log_journal.jsonl [-n 96] [--top 20]
+
+# Journal names of the commands that the mock records with another name
+NAMES = {'tempdeck_set_temp': 'set_temperature', 'tempdeck_deactivate': 'deactivate'}
+# Commands recorded by the mock that do not go through the robot command broker
+NOT_JOURNALED = ['set_rail_lights', 'set_button_light', 'sleep']
+
+
+def command_name(message_name):
+    '''
+    Mock command name of a broker message name, i.e. command.PICK_UP_TIP -> pick_up_tip
+    '''
+    name = message_name.split('.')[-1].lower()
+    return NAMES.get(name, name)
+
+
+def read_journal(path):
+    '''
+    [name, text, start, end] of the top level commands of a journal. The commands run
+    inside another one (the aspirates of a mix) are part of its time.
+    '''
+    commands = []
+    open_commands = []
+    with open(path) as f:
+        for line in f:
+            event = json.loads(line)
+            if event['event'] == 'before':
+                open_commands.append(event)
+            elif len(open_commands) > 0:
+                start = open_commands.pop()
+                if len(open_commands) == 0:
+                    commands.append([command_name(start['name']), start['text'],
+                                     start['t'], event['t']])
+    return commands
+
+
+def align_key(name, text):
+    # Comments are aligned by their text, so the alignment is anchored at every step
+    return 'comment ' + text if name == 'comment' else name
+
+
+def replay(script, journal, num_samples = None, model = None):
+    '''
+    Commands of [journal] aligned with the simulation of [script], as
+    [step, name, text, actual seconds, predicted seconds]. The commands that were not
+    simulated have None as predicted time, the simulated ones that did not run None as
+    actual time. Also returns the seconds between commands (Python code, sleeps).
+    '''
+    if num_samples == None:
+        with open(script) as f:
+            num_samples = int(re.search(r'^NUM_SAMPLES = (\d+)', f.read(), re.M).group(1))
+    ctx = run_station(script, num_samples)
+    result = estimate(ctx, model or load_model())
+    simulated = [[step, c, sum(t)] for c, t, step in zip(ctx.recorded_commands,
+                                                         result['commands'],
+                                                         result['command_steps'])
+                 if c.name not in NOT_JOURNALED]
+    actual = read_journal(journal)
+    idle = sum([b[2] - a[3] for a, b in zip(actual, actual[1:])])
+    keys_a = [align_key(s[1].name, str(s[1].args[0]) if len(s[1].args) > 0 else '')
+              for s in simulated]
+    keys_b = [align_key(a[0], a[1]) for a in actual]
+    rows = []
+    step = 0
+    matcher = difflib.SequenceMatcher(None, keys_a, keys_b, autojunk = False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            for s, a in zip(simulated[i1:i2], actual[j1:j2]):
+                step = s[0]
+                rows.append([step, a[0], a[1], a[3] - a[2], s[2]])
+            continue
+        for s in simulated[i1:i2]:
+            step = s[0]
+            rows.append([step, s[1].name, '', None, s[2]])
+        for a in actual[j1:j2]:
+            rows.append([step, a[0], a[1], a[3] - a[2], None])
+    return rows, idle
+
+
+def summary(rows):
+    '''
+    {name: [commands, actual seconds, predicted seconds]} of the aligned commands
+    '''
+    names = {}
+    for step, name, text, actual, predicted in rows:
+        if actual != None and predicted != None:
+            n = names.setdefault(name, [0, 0, 0])
+            n[0] += 1
+            n[1] += actual
+            n[2] += predicted
+    return names
+
+
+def outliers(rows, top = 20):
+    '''
+    [top] commands with the most seconds over the prediction. The commands that ran but
+    were not simulated (an unexpected home) count all their time.
+    '''
+    ran = [r for r in rows if r[3] != None]
+    return sorted(ran, key = lambda r: -(r[3] - (r[4] or 0)))[:top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Compare a run journal with the simulation')
+    parser.add_argument('script', help = 'station script of the run')
+    parser.add_argument('journal', help = '*_journal.jsonl written by the station')
+    parser.add_argument('-n', '--num-samples', type = int, default = None,
+                        help = 'NUM_SAMPLES of the run (read from the script by default)')
+    parser.add_argument('--top', type = int, default = 20)
+    args = parser.parse_args()
+    rows, idle = replay(args.script, args.journal, args.num_samples)
+    matched = [r for r in rows if r[3] != None and r[4] != None]
+    print('Commands: ' + str(len(matched)) + ' aligned, ' +
+          str(len([r for r in rows if r[4] == None])) + ' not simulated, ' +
+          str(len([r for r in rows if r[3] == None])) + ' simulated but not run')
+    print('Actual ' + str(round(sum([r[3] for r in matched]))) + ' s, predicted ' +
+          str(round(sum([r[4] for r in matched]))) + ' s, ' + str(round(idle)) +
+          ' s between commands')
+    print('command\tcount\tactual (s)\tpredicted (s)\tactual/predicted')
+    for name, (count, actual, predicted) in sorted(summary(rows).items(),
+                                                   key = lambda i: -i[1][1]):
+        print('\t'.join([name, str(count), str(round(actual, 1)), str(round(predicted, 1)),
+                         str(round(actual / predicted, 2)) if predicted > 0 else '-']))
+    print('Top ' + str(args.top) + ' outliers:')
+    print('step\tcommand\tactual (s)\tpredicted (s)\ttext')
+    for step, name, text, actual, predicted in outliers(rows, args.top):
+        print('\t'.join([str(step), name, str(round(actual, 2)),
+                         'not simulated' if predicted == None else str(round(predicted, 2)),
+                         text[:80]]))
@@ -0,0 +1,295 @@
+import sys
+import os
+import re
+import math
+import json
+from mock_opentrons import run_station, Well, Point
+from command_stream import load_station
+
+# Run time estimator for the stations.
+# The command stream recorded with mock_opentrons is walked with a model of the OT-2
+# gantry (axis speeds, accelerations and arcs between labware) and of the plunger
+# (flow rates), plus a fixed overhead per command. The duration is reported per STEP,
+# as the stations split them with their 'Step n: description' comments.
+#
+# The time the stations with low_arc_move save moving between labware in low arcs (over
+# the labware near the path instead of over the highest one of the deck) is reported
+# as a run with low_arc = True against one with low_arc = False, whatever the station
+# default is, and so is the time that would still be saved if every move between
+# labware was a low arc. The plunger homing of the tip drops is reported against a
+# home after every drop.
+#
+# Usage: python run_time_estimator.py Station_file.py [num_samples ...]
+
+# Default OT-2 model. Speeds in mm/s, accelerations in mm/s2, times in s.
+# The overheads and travel_factor are the coefficients fitted from real time logs
+# by fit_timing_model.py and can be loaded from a json file with load_model.
+MODEL = {
+    'x_speed': 600, 'y_speed': 400, 'z_speed': 125,
+    'x_acceleration': 3000, 'y_acceleration': 2000, 'z_acceleration': 1500,
+    'arc_clearance': 10,  # mm over the labware when moving between wells
+    'low_arc_margin': 15,  # mm around the wells of a labware that a low arc keeps clear of
+    'travel_factor': 1.0,
+    'overhead': {
+        'aspirate': 0.3, 'dispense': 0.3, 'blow_out': 0.5, 'touch_tip': 0.3,
+        'air_gap': 0.3, 'mix': 0.3, 'move_to': 0.1, 'pick_up_tip': 3.0,
+        'drop_tip': 2.0, 'return_tip': 2.0, 'home': 8.0, 'set_temperature': 0,
+        'home_after': 2.5, 'home_plunger': 2.5
+    }
+}
+
+model_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'timing_model.json')
+
+
+def load_model(path = model_file):
+    '''
+    MODEL updated with the coefficients stored in [path], if it exists
+    '''
+    model = json.loads(json.dumps(MODEL))
+    if os.path.isfile(path):
+        with open(path) as f:
+            fitted = json.load(f)
+        model['overhead'].update(fitted.pop('overhead', {}))
+        model.update(fitted)
+    return model
+
+
+def axis_time(distance, speed, acceleration):
+    '''
+    Time of a trapezoidal (or triangular, for short moves) speed profile
+    '''
+    distance = abs(distance)
+    if distance == 0:
+        return 0
+    if distance < speed**2 / acceleration:
+        return 2 * math.sqrt(distance / acceleration)
+    return distance / speed + speed / acceleration
+
+
+def labware_of(location):
+    if location == None:
+        return None
+    return location.labware.parent if isinstance(location.labware, Well) else location.labware
+
+
+class Gantry:
+    '''
+    Position of every pipette and travel time and distance of the moves.
+    With [low_arc] the moves between labware arc over the labware near their path
+    instead of over the highest labware of the deck, as low_arc_move of the stations.
+    '''
+    def __init__(self, ctx, model, low_arc = False):
+        self.model = model
+        self.low_arc = low_arc
+        self.positions = {}
+        self.locations = {}
+        self.tip_lengths = {}
+        self.distance = 0
+        self.deck_height = max([getattr(l, 'highest_z', 0) for l in ctx.deck.values()] +
+                               [0])
+        self.footprints = []
+        for labware in ctx.deck.values() if low_arc else []:
+            if hasattr(labware, 'wells'):
+                points = [w.top().point for w in labware.wells()]
+                margin = model['low_arc_margin']
+                self.footprints.append([min([p.x for p in points]) - margin,
+                                        max([p.x for p in points]) + margin,
+                                        min([p.y for p in points]) - margin,
+                                        max([p.y for p in points]) + margin,
+                                        labware.highest_z])
+
+    def path_height(self, start, end, reach = 0):
+        '''
+        Top of the highest labware near the straight path from [start] to [end], with
+        channels up to [reach] mm in front of the first one (multichannel pipettes)
+        '''
+        steps = int(math.hypot(end.x - start.x, end.y - start.y) / 5) + 1
+        path = [[start.x + (end.x - start.x) * i / steps,
+                 start.y + (end.y - start.y) * i / steps] for i in range(steps + 1)]
+        top = 0
+        for x0, x1, y0, y1, z in self.footprints:
+            if z > top and any([x0 <= x <= x1 and y0 <= y <= y1 + reach for x, y in path]):
+                top = z
+        return top
+
+    def tip(self, pipette, tip_length):
+        '''
+        Attach a tip of [tip_length] to [pipette] (0 to drop it). The positions are of
+        the end of the pipette: the end of a new tip is under the position of the pick
+        up, inside the rack, and the nozzle is over the position of the drop.
+        '''
+        position = self.positions.get(pipette)
+        if position != None:
+            self.positions[pipette] = position - Point(0, 0, tip_length -
+                                                       self.tip_lengths.get(pipette, 0))
+        self.tip_lengths[pipette] = tip_length
+
+    def travel(self, pipette, location, direct = False):
+        '''
+        Move [pipette] to [location] and return the seconds it takes. [direct] moves and
+        moves within a well are direct, moves within a labware arc over it and the rest
+        arc over the highest labware of the deck (or the labware near the path).
+        '''
+        if location == None:
+            return 0
+        m = self.model
+        start = self.positions.get(pipette)
+        end = location.point
+        previous = self.locations.get(pipette)
+        self.positions[pipette] = end
+        self.locations[pipette] = location
+        if start == None:
+            return 0
+        dx = end.x - start.x
+        dy = end.y - start.y
+        if direct:
+            self.distance += math.sqrt(dx**2 + dy**2 + (end.z - start.z)**2)
+            return max(axis_time(dx, m['x_speed'], m['x_acceleration']),
+                       axis_time(dy, m['y_speed'], m['y_acceleration']),
+                       axis_time(end.z - start.z, m['z_speed'], m['z_acceleration']))
+        if previous != None and previous.labware is location.labware:
+            z_path = [end.z - start.z]
+        else:
+            if previous != None and labware_of(previous) is labware_of(location):
+                safe = labware_of(location).highest_z + m['arc_clearance']
+            elif self.low_arc:
+                reach = 9 * (getattr(pipette, 'channels', 1) - 1)
+                safe = self.path_height(start, end, reach) + m['arc_clearance']
+            else:
+                safe = self.deck_height + m['arc_clearance']
+            safe = max(safe, start.z, end.z)
+            z_path = [safe - start.z, safe - end.z]
+        self.distance += math.hypot(dx, dy) + sum([abs(z) for z in z_path])
+        t = max(axis_time(dx, m['x_speed'], m['x_acceleration']),
+                axis_time(dy, m['y_speed'], m['y_acceleration']))
+        t += sum([axis_time(z, m['z_speed'], m['z_acceleration']) for z in z_path])
+        return t
+
+
+def command_time(c, gantry, model):
+    '''
+    [travel, action] seconds of the command [c]
+    '''
+    kw = c.kwargs
+    name = c.name
+    if name == 'delay':
+        return [0, kw.get('seconds', 0) + 60 * kw.get('minutes', 0)]
+    if name == 'sleep':
+        return [0, kw.get('seconds', 0)]
+    if name not in model['overhead']:
+        return [0, 0]
+    travel = gantry.travel(c.target, kw.get('location'), kw.get('force_direct') == True)
+    if name == 'pick_up_tip':
+        gantry.tip(c.target, getattr(labware_of(kw['location']), 'tip_length', 0))
+    elif name in ['drop_tip', 'return_tip']:
+        gantry.tip(c.target, 0)
+    action = model['overhead'][name]
+    flow = getattr(c.target, 'flow_rate', None)
+    if name in ['aspirate', 'dispense', 'air_gap']:
+        rate = flow.aspirate if name != 'dispense' else flow.dispense
+        action += kw['volume'] / (rate * kw.get('rate', 1.0))
+    elif name == 'mix':
+        volume = kw['volume'] if kw['volume'] != None else c.target.max_volume
+        action += kw['repetitions'] * volume * (1 / (flow.aspirate * kw['rate']) +
+                                               1 / (flow.dispense * kw['rate']))
+    elif name == 'blow_out':
+        action += c.target.max_volume * 0.05 / flow.blow_out
+    elif name == 'touch_tip':
+        location = gantry.locations.get(c.target)
+        well = location.labware if location != None else None
+        width = getattr(well, 'diameter', None) or 5
+        # Down to v_offset and four sides of the well at [speed]
+        action += 6 * kw['radius'] * width / 2 / kw['speed']
+    if kw.get('home_after') == True:
+        action += model['overhead']['home_after']
+    return [travel * model['travel_factor'], action]
+
+
+def estimate(ctx, model = None, low_arc = False):
+    '''
+    Walk the recorded commands of [ctx] (a mock_opentrons ProtocolContext), with the
+    moves between labware as low arcs if [low_arc].
+    Returns a dictionary with
+        steps: [step, description, seconds] of every STEP executed
+        total: seconds of the whole protocol
+        travel: gantry travel distance in mm
+        commands: [travel, action] seconds of every recorded command
+        command_steps: STEP of every recorded command (0 out of the STEPS)
+    '''
+    if model == None:
+        model = load_model()
+    gantry = Gantry(ctx, model, low_arc)
+    # Steps start with their 'Step n: description' comment or, in the stations that
+    # only comment when a step ends, with the end of the previous one
+    steps = [[None, 'Setup', 0]]
+    times = []
+    owners = []
+    for c in ctx.recorded_commands:
+        if c.name == 'comment':
+            m = re.match(r'Step (\d+): (.*)', str(c.args[0]))
+            if m != None and ' took ' not in m.group(2):
+                steps.append([int(m.group(1)), m.group(2), 0])
+            elif m != None:
+                if steps[-1][0] == None:
+                    steps[-1][:2] = [int(m.group(1)), m.group(2).split(' took ')[0]]
+                steps.append([None, 'Other', 0])
+        t = command_time(c, gantry, model)
+        times.append(t)
+        owners.append(steps[-1])
+        steps[-1][2] += sum(t)
+    steps = [[0 if s[0] == None else s[0]] + s[1:] for s in steps
+             if s[0] != None or s[2] > 0]
+    return {'steps': steps, 'total': sum([s[2] for s in steps]),
+            'travel': gantry.distance, 'commands': times,
+            'command_steps': [0 if s[0] == None else s[0] for s in owners]}
+
+
+def format_time(seconds):
+    return str(int(seconds // 3600)) + ':' + str(int(seconds % 3600 // 60)).zfill(2) + \
+        ':' + str(int(seconds % 60)).zfill(2)
+
+
+def homing(ctx, model = None):
+    '''
+    [tip drops, plunger homes, seconds of the homes, seconds with a home after every
+    drop] of the recorded commands of [ctx]
+    '''
+    if model == None:
+        model = load_model()
+    drops = 0
+    homes = 0
+    seconds = 0
+    for c in ctx.recorded_commands:
+        if c.name in ['drop_tip', 'return_tip']:
+            drops += 1
+        if c.kwargs.get('home_after') == True:
+            homes += 1
+            seconds += model['overhead']['home_after']
+        elif c.name == 'home_plunger':
+            homes += 1
+            seconds += model['overhead']['home_plunger']
+    return [drops, homes, seconds, drops * model['overhead']['home_after']]
+
+
+if __name__ == '__main__':
+    samples = [int(n) for n in sys.argv[2:]] or [96]
+    for n in samples:
+        ctx = run_station(sys.argv[1], n)
+        result = estimate(ctx)
+        print('NUM_SAMPLES ' + str(n))
+        for step, description, seconds in result['steps']:
+            print('\t'.join([str(step), description, format_time(seconds)]))
+        print('Total\t' + format_time(result['total']) + '\t' +
+              str(round(result['travel'] / 1000, 1)) + ' m of travel')
+        if 'low_arc' in vars(load_station(sys.argv[1], n)):
+            high_arc = estimate(run_station(sys.argv[1], n, settings = {'low_arc': False}))
+            low_arcs = estimate(run_station(sys.argv[1], n, settings = {'low_arc': True}))
+            print('Low arcs\t' + format_time(low_arcs['total']) + ' with low_arc = True, ' +
+                  format_time(high_arc['total']) + ' with low_arc = False\t' +
+                  str(round(high_arc['total'] - low_arcs['total'])) + ' s saved')
+        low_arc = estimate(ctx, low_arc = True)
+        print('All low arcs\t' + format_time(low_arc['total']) + '\t' +
+              str(round(result['total'] - low_arc['total'])) + ' s more to save')
+        drops, homes, seconds, every_drop = homing(ctx)
+        print('Homing\t' + str(homes) + ' plunger homes for ' + str(drops) + ' drops\t' +
+              str(round(every_drop - seconds)) + ' s saved')
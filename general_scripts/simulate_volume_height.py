@@ -1,96 +1,205 @@
 import math
+import time
+import argparse
 import numpy as np
+from mock_opentrons import get_definition
 
-#Simulation of remaining volume in eppendorf tubes with mastermix and the calculated aspiration height
-
-class Reagent:
-    def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
-                 reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                  tip_recycling = 'none'):
-        self.name = name
-        self.flow_rate_aspirate = flow_rate_aspirate
-        self.flow_rate_dispense = flow_rate_dispense
-        self.rinse = bool(rinse)
-        self.reagent_reservoir_volume = reagent_reservoir_volume
-        self.delay = delay
-        self.num_wells = num_wells
-        self.col = 0
-        self.vol_well = 0
-        self.h_cono = h_cono
-        self.v_cono = v_fondo
-        self.unused=[]
-        self.tip_recycling = tip_recycling
-        self.vol_well_original = reagent_reservoir_volume / num_wells
-
-def calc_height(reagent, cross_section_area, aspirate_volume, min_height=0.5):
-    #nonlocal ctx
-    #ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                #'< needed volume ' + str(aspirate_volume) + '?')
-    if reagent.vol_well < aspirate_volume + 50:
-        reagent.unused.append(reagent.vol_well)
-        #ctx.comment('Next column should be picked')
-        #ctx.comment('Previous to change: ' + str(reagent.col))
-        # column selector position; intialize to required number
-        reagent.col = reagent.col + 1
-        #ctx.comment(str('After change: ' + str(reagent.col)))
-        reagent.vol_well = reagent.vol_well_original
-        #ctx.comment('New volume:' + str(reagent.vol_well))
-        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                #- reagent.h_cono
-        reagent.vol_well = reagent.vol_well - aspirate_volume
-        #ctx.comment('Remaining volume:' + str(reagent.vol_well))
-        if height < min_height:
-            height = min_height
-        col_change = True
+# Simulation of the remaining volume of a reagent aspirated from tubes (or reservoir
+# wells) and of the calculated aspiration height.
+# The trajectories of every number of samples of a range (tube, remaining volume and
+# height of every aspiration) are computed in one array pass of samples x aspirations,
+# with the height formulas used by the stations side by side:
+#   form1: cylinder over the cone, (volume - v_cono) / area
+#   form2: form1 - h_cono
+#   level: geometric model of LiquidLevel (calc_height), [immersion] mm under the surface
+# Each formula is compared with the real surface of the liquid: an aspiration with the
+# tip over the surface takes air. The defaults are the master mix screwcaps of station C.
+#
+# Usage: python simulate_volume_height.py [--samples 1-96] [--volume 20] [--plot 96]
+#        [--labware opentrons_24_aluminumblock_generic_2ml_screwcap] [-o file.txt]
+
+FORMULAS = ['form1', 'form2', 'level']
+
+
+def well_geometry(load_name):
+    '''
+    Cross section area and depth of the wells of [load_name], as LiquidLevel reads them
+    '''
+    definition = get_definition(load_name)
+    well = definition['wells'][definition['ordering'][0][0]]
+    if well['shape'] == 'circular':
+        return math.pi * well['diameter']**2 / 4, well['depth']
+    return well['xDimension'] * well['yDimension'], well['depth']
+
+
+def level_volume(heights, shape, area, h_bottom):
+    '''
+    LiquidLevel.volume of an array of [heights]
+    '''
+    h = np.minimum(heights, h_bottom)
+    if shape == 'flat' or h_bottom <= 0:
+        v = np.zeros_like(h)
+    elif shape in ['cone', 'v']:
+        v = area * h**3 / (3 * h_bottom**2)
+    elif shape == 'prism':
+        v = area * h**2 / (2 * h_bottom)
     else:
-        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-        reagent.vol_well = reagent.vol_well - aspirate_volume
-        #ctx.comment('Calculated height is ' + str(height))
-        if height < min_height:
-            height = min_height
-        #ctx.comment('Used height is ' + str(height))
-        col_change = False
-    return height, col_change
-
-
-#Defined variables
-##################
-total_NUM_SAMPLES = 96
-air_gap_vol = 5
-
-f=open('simulation_volumes_mmix.txt', 'w')
-print('initial_samples','sample','height','tube','remaining_vol', file=f)
-
-for simulation in range(total_NUM_SAMPLES):
-    NUM_SAMPLES=simulation+1
-    # Tune variables
-    volume_mmix = 20  # Volume of transfered master mix
-    volume_mmix_available = (NUM_SAMPLES * 1.1 * volume_mmix)  # Total volume needed
-    num_wells = math.ceil(volume_mmix_available/2000)
-    volume_mmix_available = volume_mmix_available + 50*num_wells
-    diameter_screwcap = 8.25  # Diameter of the screwcap
-    volume_cone = 50  # Volume in ul that fit in the screwcap cone
-    x_offset = [0,0]
-    # Calculated variables
-    area_section_screwcap = (np.pi * diameter_screwcap**2) / 4
-    h_cone = (volume_cone * 3 / area_section_screwcap)
-    # Reagents and their characteristics
-    MMIX = Reagent(name = 'Master Mix',
-                      rinse = False,
-                      flow_rate_aspirate = 1,
-                      flow_rate_dispense = 1,
-                      reagent_reservoir_volume = volume_mmix_available,
-                      num_wells = math.ceil(volume_mmix_available/2000), #change with num samples
-                      delay = 0,
-                      h_cono = h_cone,
-                      v_fondo = volume_cone  # V cono
-                      )
-    MMIX.vol_well = MMIX.vol_well_original
-    num_col=1
-    for i in range(NUM_SAMPLES):
-        [pickup_height,col_change]=calc_height(MMIX, area_section_screwcap, volume_mmix)
-        if col_change==True:
-            num_col+=1
-        print(NUM_SAMPLES, i+1, round(pickup_height,2),num_col, round(MMIX.vol_well,0), file=f)
-
-f.close()
+        r_sphere = (area / math.pi + h_bottom**2) / (2 * h_bottom)
+        v = math.pi * h**2 * (3 * r_sphere - h) / 3
+    return v + area * np.maximum(heights - h_bottom, 0)
+
+
+def level_height(volumes, shape, area, h_bottom, depth, resolution = 4000):
+    '''
+    LiquidLevel.height of an array of [volumes]
+    '''
+    heights = np.linspace(0, depth, resolution)
+    return np.interp(volumes, level_volume(heights, shape, area, h_bottom), heights)
+
+
+def simulate(samples, volume = 20, overage = 0.1, security_volume = 50, capacity = 2000,
+             margin = 50, area = None, v_cono = 50, shape = 'cone', depth = 40,
+             min_height = 0.5, immersion = 1):
+    '''
+    Trajectories of the aspirations of [volume] for every number of [samples].
+    The reagent is loaded as samples * volume * (1 + overage) plus [security_volume]
+    for each tube of [capacity] it needs, split in tubes, and the next tube is used when
+    the current one has less than volume + [margin] (0 is the rule of ReservoirState).
+    Returns {column: array of samples x aspirations}, masked after the last sample.
+    '''
+    samples = np.asarray(samples)[:, None]
+    loaded = samples * volume * (1 + overage)
+    total = loaded + security_volume * np.ceil(loaded / capacity)
+    tubes = np.ceil(total / capacity)
+    per_tube = total / tubes
+    per_tube_aspirations = np.maximum(np.floor((per_tube - margin) / volume), 1)
+    sample = np.arange(samples.max())[None, :]
+    mask = sample >= samples
+    remaining = per_tube - (sample % per_tube_aspirations + 1) * volume
+    h_cono = v_cono * 3 / area
+    surface = level_height(remaining, shape, area, h_cono, depth)
+    heights = {'form1': (remaining - v_cono) / area,
+               'form2': (remaining - v_cono) / area - h_cono,
+               'level': surface - immersion}
+    result = {'initial_samples': np.broadcast_to(samples, mask.shape),
+              'sample': np.broadcast_to(sample + 1, mask.shape),
+              'tube': sample // per_tube_aspirations + 1,
+              'tubes_loaded': np.broadcast_to(tubes, mask.shape),
+              'remaining_vol': remaining,
+              'surface': surface}
+    for formula, height in heights.items():
+        result[formula] = np.maximum(height, min_height)
+    return {k: np.ma.masked_array(v, mask) for k, v in result.items()}
+
+
+def compare(result, min_height = 0.5):
+    '''
+    [formula, aspirations at [min_height], aspirations over the surface, worst
+    distance over the surface in mm] of every formula
+    '''
+    rows = []
+    for formula in FORMULAS:
+        over = result[formula] - result['surface']
+        rows.append([formula, int(np.ma.sum(result[formula] <= min_height)),
+                     int(np.ma.sum(over > 0)), round(float(max(over.max(), 0)), 2)])
+    return rows
+
+
+def write_table(result, path):
+    with open(path, 'w') as f:
+        print(' '.join(['initial_samples', 'sample', 'tube', 'remaining_vol'] + FORMULAS),
+              file = f)
+        keep = ~np.ma.getmaskarray(result['sample'])
+        values = [result[c][keep] for c in ['initial_samples', 'sample', 'tube']]
+        values += [np.round(result['remaining_vol'][keep])]
+        values += [np.round(result[formula][keep], 2) for formula in FORMULAS]
+        for row in zip(*values):
+            print(' '.join([str(int(v)) for v in row[:4]] + [str(v) for v in row[4:]]),
+                  file = f)
+
+
+def plot(result, num_samples, path, v_cono = 50):
+    '''
+    Remaining volume and pickup height of every formula for [num_samples], as the old
+    plot_simulation.R did. Needs matplotlib.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    row = int(np.flatnonzero(result['initial_samples'][:, 0] == num_samples)[0])
+    n = int(num_samples)
+    sample = np.asarray(result['sample'][row, :n])
+    fig, ax = plt.subplots(figsize = (8, 6))
+    ax.bar(sample, np.asarray(result['remaining_vol'][row, :n]), color = '#66c2a5')
+    ax.axhline(v_cono, linestyle = ':', color = 'red')
+    ax.set_xlabel('Sample number')
+    ax.set_ylabel('Remaining volume in μl')
+    heights = ax.twinx()
+    for formula in FORMULAS:
+        heights.plot(sample, np.asarray(result[formula][row, :n]), label = formula)
+    heights.plot(sample, np.asarray(result['surface'][row, :n]), 'k--', label = 'surface')
+    heights.set_ylabel('Pickup height in mm')
+    heights.legend(loc = 'upper right')
+    tubes = np.asarray(result['tube'][row, :n])
+    for tube in np.unique(tubes):
+        ax.annotate('Tube ' + str(tube), (np.mean(sample[tubes == tube]), ax.get_ylim()[1]),
+                    ha = 'center', va = 'bottom')
+    fig.savefig(path)
+
+
+def parse_range(text):
+    '''
+    '1-96' or '8,48,96' as a list of sample counts
+    '''
+    if '-' in text:
+        first, last = text.split('-')
+        return list(range(int(first), int(last) + 1))
+    return [int(n) for n in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Liquid height simulation')
+    parser.add_argument('--samples', default = '1-96')
+    parser.add_argument('--labware', default = 'opentrons_24_aluminumblock_generic_2ml_screwcap')
+    parser.add_argument('--shape', default = 'cone',
+                        help = 'bottom of the wells as in LiquidLevel: flat, cone, sphere, '
+                        'prism or v')
+    parser.add_argument('--diameter', type = float, default = None,
+                        help = 'mm, instead of the wells of the labware')
+    parser.add_argument('--volume', type = float, default = 20, help = 'ul per aspiration')
+    parser.add_argument('--overage', type = float, default = 0.1)
+    parser.add_argument('--security-volume', type = float, default = 50)
+    parser.add_argument('--capacity', type = float, default = 2000, help = 'ul per tube')
+    parser.add_argument('--margin', type = float, default = 50,
+                        help = 'ul left to move to the next tube (0 as ReservoirState)')
+    parser.add_argument('--v-cono', type = float, default = 50,
+                        help = 'ul that fit in the bottom of the tube')
+    parser.add_argument('--min-height', type = float, default = 0.5)
+    parser.add_argument('--immersion', type = float, default = 1)
+    parser.add_argument('-o', '--output', default = None, help = 'text file of the trajectories')
+    parser.add_argument('--plot', type = int, default = None,
+                        help = 'number of samples to plot (needs matplotlib)')
+    parser.add_argument('--plot-file', default = 'simulated_volume_heights.png')
+    args = parser.parse_args()
+    area, depth = well_geometry(args.labware)
+    if args.diameter != None:
+        area = math.pi * args.diameter**2 / 4
+    start = time.time()
+    result = simulate(parse_range(args.samples), args.volume, args.overage,
+                      args.security_volume, args.capacity, args.margin, area, args.v_cono,
+                      args.shape, depth, args.min_height, args.immersion)
+    elapsed = time.time() - start
+    print('Simulated ' + str(int(result['sample'].count())) + ' aspirations in ' +
+          str(round(elapsed * 1000, 1)) + ' ms')
+    missing = np.ma.sum(result['tube'] > result['tubes_loaded'])
+    if missing > 0:
+        print('Warning: ' + str(int(missing)) + ' aspirations from tubes that are not loaded')
+    print('formula\tat min height\tover the surface\tmax over the surface (mm)')
+    for row in compare(result, args.min_height):
+        print('\t'.join([str(v) for v in row]))
+    if args.output != None:
+        write_table(result, args.output)
+        print('Trajectories written to ' + args.output)
+    if args.plot != None:
+        plot(result, args.plot, args.plot_file, args.v_cono)
+        print('Plot written to ' + args.plot_file)
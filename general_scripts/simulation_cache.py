@@ -0,0 +1,167 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+from mock_opentrons import run_station, get_definition
+from command_snapshots import normalize
+from sweep_stations import station_metrics
+from run_time_estimator import load_model, model_file
+
+# Content addressed cache of the simulations of the station scripts.
+# The key is a hash of the protocol source (with the values of rep_data that do not
+# change the commands, run_id, technician and date, put back as placeholders), of the
+# definitions of the labware it names, of NUM_SAMPLES and of the simulator itself.
+# An entry keeps the normalized command stream (command_snapshots), the metrics
+# (sweep_stations) and the status of the run, and the least recently used entries are
+# removed when the cache is over its size.
+#
+# Usage: python simulation_cache.py RUNS/run_name/scripts/*.py [-n 96] [--max-mb 200]
+#        python simulation_cache.py --clear
+
+cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'covid19clinic', 'simulations')
+MAX_BYTES = 200 * 1024 * 1024
+# Files of the simulator: a change in any of them invalidates the cache
+SIMULATOR_FILES = ['mock_opentrons.py', 'command_stream.py', 'run_time_estimator.py',
+                   'sweep_stations.py', 'command_snapshots.py']
+# Values written by rep_data that do not change the commands of the protocol
+RUN_VALUES = [[r'^run_id = .*$', 'run_id = $run_id'],
+              [r"'technician': .*$", "'technician': '$technician',"],
+              [r"'date': .*$", "'date': '$date'"]]
+
+_simulator_hash = []
+
+
+def simulator_hash():
+    if len(_simulator_hash) == 0:
+        h = hashlib.sha256()
+        folder = os.path.dirname(os.path.abspath(__file__))
+        for name in SIMULATOR_FILES:
+            with open(os.path.join(folder, name), 'rb') as f:
+                h.update(f.read())
+        if os.path.isfile(model_file):
+            with open(model_file, 'rb') as f:
+                h.update(f.read())
+        _simulator_hash.append(h.hexdigest())
+    return _simulator_hash[0]
+
+
+def script_samples(source):
+    '''
+    NUM_SAMPLES of a script generated by rep_data, None in the templates
+    '''
+    m = re.search(r'^NUM_SAMPLES = (\d+)', source, re.M)
+    return int(m.group(1)) if m != None else None
+
+
+def simulation_key(path, num_samples = None):
+    '''
+    Hash of the script in [path], the labware it names and [num_samples] (read from
+    the script if None). Returns the key and the number of samples.
+    '''
+    with open(path) as f:
+        source = f.read()
+    if num_samples == None:
+        num_samples = script_samples(source)
+        if num_samples == None:
+            raise ValueError(path + ' has no NUM_SAMPLES, give it with -n')
+    for pattern, placeholder in RUN_VALUES:
+        source = re.sub(pattern, placeholder, source, flags = re.M)
+    labware = []
+    for name in sorted(set(re.findall(r"['\"]([a-z0-9_.]+)['\"]", source))):
+        try:
+            labware.append([name, get_definition(name)])
+        except KeyError:
+            pass
+    h = hashlib.sha256(json.dumps([source, labware, num_samples, simulator_hash()],
+                                  sort_keys = True).encode())
+    return h.hexdigest(), num_samples
+
+
+def simulate(path, num_samples):
+    '''
+    Cache entry of a new simulation of [path]
+    '''
+    entry = {'station': os.path.basename(path), 'num_samples': num_samples,
+             'metrics': {}, 'commands': []}
+    try:
+        ctx = run_station(path, num_samples)
+        entry['commands'] = normalize(ctx)
+        entry['metrics'] = station_metrics(ctx, load_model())
+        entry['status'] = 'ok'
+    except Exception as e:
+        entry['status'] = type(e).__name__ + ': ' + str(e).splitlines()[0]
+    return entry
+
+
+def evict(folder = cache_path, max_bytes = MAX_BYTES):
+    '''
+    Remove the least recently used entries until the cache is under [max_bytes]
+    '''
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith('.json'):
+            stat = os.stat(os.path.join(folder, name))
+            entries.append([stat.st_mtime, stat.st_size, name])
+    total = sum([e[1] for e in entries])
+    removed = 0
+    for mtime, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(folder, name))
+        total -= size
+        removed += 1
+    return removed
+
+
+def cached_simulation(path, num_samples = None, folder = cache_path, max_bytes = MAX_BYTES):
+    '''
+    Simulation of [path] from the cache, or simulated and stored on a miss.
+    Returns the entry (status, metrics, commands) with 'hit' True if it was cached.
+    '''
+    key, num_samples = simulation_key(path, num_samples)
+    entry_file = os.path.join(folder, key + '.json')
+    if os.path.isfile(entry_file):
+        with open(entry_file) as f:
+            entry = json.load(f)
+        os.utime(entry_file)  # most recently used
+        entry['hit'] = True
+        return entry
+    entry = simulate(path, num_samples)
+    entry['key'] = key
+    os.makedirs(folder, exist_ok = True)
+    with open(entry_file + '.tmp', 'w') as f:
+        json.dump(entry, f)
+    os.replace(entry_file + '.tmp', entry_file)
+    evict(folder, max_bytes)
+    entry['hit'] = False
+    return entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Cached simulation of station scripts')
+    parser.add_argument('scripts', nargs = '*')
+    parser.add_argument('-n', '--num-samples', type = int, default = None,
+                        help = 'NUM_SAMPLES of the templates (read from the scripts)')
+    parser.add_argument('--cache', default = cache_path)
+    parser.add_argument('--max-mb', type = float, default = MAX_BYTES / 1024 / 1024)
+    parser.add_argument('--clear', action = 'store_true', help = 'remove every entry')
+    args = parser.parse_args()
+    if args.clear:
+        if os.path.isdir(args.cache):
+            print('Removed ' + str(evict(args.cache, 0)) + ' entries')
+        sys.exit(0)
+    failed = 0
+    for script in args.scripts:
+        start = time.time()
+        entry = cached_simulation(script, args.num_samples, args.cache,
+                                  args.max_mb * 1024 * 1024)
+        if entry['status'] != 'ok':
+            failed += 1
+        print('\t'.join([os.path.basename(script), entry['status'],
+                         'hit' if entry['hit'] else 'miss',
+                         str(round((time.time() - start) * 1000)) + ' ms'] +
+                        [k + '=' + str(v) for k, v in entry['metrics'].items()]))
+    sys.exit(1 if failed > 0 else 0)
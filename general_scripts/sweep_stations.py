@@ -0,0 +1,122 @@
+import sys
+import os
+import re
+import csv
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from mock_opentrons import run_station, repo_path
+from run_time_estimator import estimate, load_model
+
+# Parameter sweep of the stations over NUM_SAMPLES.
+# Every Station_* protocol is run against mock_opentrons for every sample count in a
+# process pool and the metrics of each run are collected in one tsv table.
+#
+# Usage: python sweep_stations.py [-s 1-96] [-w workers] [-o table.tsv] [stations...]
+
+STATION_GLOBS = ['Kingfisher_protocols/*/Station_*.py', 'automation/*_config/Station_*.py']
+
+COLUMNS = ['station', 'num_samples', 'status', 'commands', 'tips', 'volume_ul',
+           'column_switches', 'dead_volume_ul', 'travel_m', 'duration_s']
+
+
+def station_files():
+    files = []
+    for g in STATION_GLOBS:
+        files += sorted(glob.glob(os.path.join(repo_path, g)))
+    return files
+
+
+def station_metrics(ctx, model = None):
+    '''
+    Metrics of a run recorded with mock_opentrons:
+        commands: number of commands sent to the robot (comments not included)
+        tips: tips used, counting every channel
+        volume_ul: volume taken out of the labware that is aspirated from
+        column_switches: times calc_height changed the reagent column or tube
+        dead_volume_ul: volume stranded in the columns left at the end (Reagent.unused)
+        travel_m, duration_s: gantry travel and duration from run_time_estimator
+    '''
+    commands = [c for c in ctx.recorded_commands if c.name != 'comment']
+    tips = sum([c.target.channels for c in commands if c.name == 'pick_up_tip'])
+    net = {}
+    for c in commands:
+        if c.name in ['aspirate', 'dispense'] and c.kwargs.get('location') != None:
+            labware = c.kwargs['location'].labware
+            labware = getattr(labware, 'parent', labware)
+            sign = 1 if c.name == 'aspirate' else -1
+            net[labware] = net.get(labware, 0) + sign * c.kwargs['volume'] * c.target.channels
+    switches = 0
+    stranded = {}
+    for c in ctx.recorded_commands:
+        if c.name == 'comment':
+            # The last stranded volume of each reagent, its wells can be drawn again
+            m = re.match(r'Stranded volume of (.+): ([\d.e+-]+)$', str(c.args[0]))
+            if m != None:
+                stranded[m.group(1)] = float(m.group(2))
+            elif str(c.args[0]) == 'Next column should be picked':
+                switches += 1
+    dead_volume = sum(stranded.values())
+    result = estimate(ctx, model)
+    return {'commands': len(commands), 'tips': tips,
+            'volume_ul': round(sum([v for v in net.values() if v > 0]), 1),
+            'column_switches': switches, 'dead_volume_ul': round(dead_volume, 1),
+            'travel_m': round(result['travel'] / 1000, 2),
+            'duration_s': round(result['total'], 1)}
+
+
+def simulate(task):
+    '''
+    Run one station for one sample count. Errors of the protocol are reported in the
+    status column instead of stopping the sweep.
+    '''
+    path, num_samples, model = task
+    row = {'station': os.path.relpath(path, repo_path), 'num_samples': num_samples}
+    try:
+        row.update(station_metrics(run_station(path, num_samples), model))
+        row['status'] = 'ok'
+    except Exception as e:
+        row['status'] = type(e).__name__ + ': ' + str(e).splitlines()[0]
+    return row
+
+
+def sweep(files, samples, workers = None):
+    model = load_model()
+    tasks = [(f, n, model) for f in files for n in samples]
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        return list(pool.map(simulate, tasks, chunksize = 8))
+
+
+def parse_range(text):
+    '''
+    '1-96' or '8,48,95' to a list of sample counts
+    '''
+    samples = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            samples += list(range(int(first), int(last) + 1))
+        else:
+            samples.append(int(part))
+    return samples
+
+
+def write_table(rows, output):
+    writer = csv.DictWriter(output, COLUMNS, delimiter = '\t', extrasaction = 'ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Simulate the stations over NUM_SAMPLES')
+    parser.add_argument('stations', nargs = '*', help = 'station files (default: all)')
+    parser.add_argument('-s', '--samples', default = '1-96')
+    parser.add_argument('-w', '--workers', type = int, default = None)
+    parser.add_argument('-o', '--output', default = None)
+    args = parser.parse_args()
+    rows = sweep(args.stations or station_files(), parse_range(args.samples), args.workers)
+    if args.output != None:
+        with open(args.output, 'w', newline = '') as f:
+            write_table(rows, f)
+    else:
+        write_table(rows, sys.stdout)